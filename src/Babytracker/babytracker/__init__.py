@@ -4,49 +4,83 @@ from pyramid.config import Configurator
 from pyramid.authentication import AuthTktAuthenticationPolicy
 from pyramid.authorization import ACLAuthorizationPolicy
 from pyramid.session import UnencryptedCookieSessionFactoryConfig
+from pyramid.settings import asbool
 
-from sqlalchemy import engine_from_config
-
-from babytracker.models import DBSession, Base, Root
-from babytracker.security import validate_user
+from babytracker.models import DBSession, Root, upgrade_schema, check_schema
+from babytracker.security import Request, validate_user, configure_principal_cache
+from babytracker.security import BearerTokenAuthenticationPolicy
+from babytracker.renderers import json_renderer_factory
+from babytracker.passwords import configure_password_hashing
+from babytracker.assets import StaticAssets, load_manifest
+from babytracker.database import create_engine_from_settings
+from babytracker.events import configure_events
+from babytracker.views.metrics import metrics
 
 def setup_database(settings):
     if 'DATABASE_URL' in os.environ: # Used on Heroku
         settings['sqlalchemy.url'] = os.environ['DATABASE_URL']
 
-    engine = engine_from_config(settings, 'sqlalchemy.')
+    engine = create_engine_from_settings(settings)
     DBSession.configure(bind=engine)
-
-    Base.metadata.create_all(engine)
+    return engine
 
 def main(global_config, **settings):
     """ This function returns a Pyramid WSGI application.
     """
 
-    setup_database(settings)
+    engine = setup_database(settings)
+
+    # Migrations are run with migrate_Babytracker, so each worker only needs
+    # to check the schema version when it starts
+    if asbool(settings.get('database-auto-migrate', False)):
+        upgrade_schema(engine)
+    else:
+        check_schema(engine)
+
+    configure_principal_cache(settings)
+    configure_password_hashing(settings)
+    configure_events(settings)
 
     session_factory = UnencryptedCookieSessionFactoryConfig(
         secret=settings.get('session-secret', 'secret'),
     )
 
-    authn_policy = AuthTktAuthenticationPolicy(
-        secret=settings.get('authentication-secret', 'secret'),
-        callback=validate_user,
+    authn_policy = BearerTokenAuthenticationPolicy(
+        AuthTktAuthenticationPolicy(
+            secret=settings.get('authentication-secret', 'secret'),
+            callback=validate_user,
+        ),
+        secret=settings.get('token-secret', settings.get('authentication-secret', 'secret')),
+        timeout=int(settings.get('token-timeout', 86400)),
     )
     authz_policy = ACLAuthorizationPolicy()
 
     config = Configurator(
         settings=settings,
         root_factory=Root,
+        request_factory=Request,
         session_factory=session_factory,
         authentication_policy=authn_policy,
         authorization_policy=authz_policy
     )
 
-    config.add_static_view('static', 'static', cache_max_age=3600)
+    config.add_renderer('json', json_renderer_factory)
+
+    # Serve assets built by build_static_Babytracker if there are any
+    manifest = load_manifest(settings.get('static-build-dir'))
+    if manifest is not None:
+        config.registry.asset_manifest = manifest
+        config.add_route('static', '/static/*subpath')
+        config.add_view(StaticAssets(settings['static-build-dir'], manifest), route_name='static')
+    else:
+        config.add_static_view('static', 'static', cache_max_age=3600)
 
     config.add_route('api', '/api/*traverse')
 
+    if asbool(settings.get('metrics', False)):
+        config.add_route('metrics', '/metrics')
+        config.add_view(metrics, route_name='metrics', renderer='json')
+
     config.scan()
     return config.make_wsgi_app()
 
@@ -0,0 +1,260 @@
+import os
+import re
+import json
+import gzip
+import hashlib
+import posixpath
+import mimetypes
+
+from cStringIO import StringIO
+
+from pyramid.httpexceptions import HTTPNotFound
+from pyramid.response import Response
+
+try:
+    import brotli
+except ImportError: # pragma: no cover
+    brotli = None
+
+MANIFEST = 'manifest.json'
+
+# Extensions of files worth compressing. Images and fonts already are.
+COMPRESSED_TYPES = ('.css', '.js', '.html', '.htm', '.svg', '.txt', '.json', '.xml',)
+
+# Pages are requested by their own names, so they are not fingerprinted and
+# keep a short cache lifetime. Everything they refer to is.
+PAGE_TYPES = ('.html', '.htm',)
+
+# Pre-compressed variants, most preferred first
+ENCODINGS = (('br', '.br',), ('gzip', '.gz',),)
+
+HASH_LENGTH = 12
+
+ONE_YEAR = 365 * 24 * 60 * 60
+
+_css_reference = re.compile(r"""url\(\s*(['"]?)([^'"()]+)\1\s*\)""")
+_html_reference = re.compile(r"""((?:src|href)\s*=\s*)(['"])([^'"]+)\2""", re.IGNORECASE)
+
+# Building
+
+def fingerprint(path, data):
+    """Return ``path`` with a hash of ``data`` inserted before the extension
+    """
+    base, ext = posixpath.splitext(path)
+    return '%s.%s%s' % (base, hashlib.md5(data).hexdigest()[:HASH_LENGTH], ext,)
+
+def _resolve(reference, path, manifest):
+    """Return the fingerprinted equivalent of a relative ``reference`` made
+    from the file at ``path``, or ``None`` if there is none.
+    """
+    if not reference or reference.startswith(('/', '#', 'data:',)) or ':' in reference.split('/')[0]:
+        return None
+
+    suffix = ''
+    for separator in ('#', '?',):
+        if separator in reference:
+            reference, rest = reference.split(separator, 1)
+            suffix = separator + rest + suffix
+
+    directory = posixpath.dirname(path)
+    target = manifest.get(posixpath.normpath(posixpath.join(directory, reference)))
+    if target is None:
+        return None
+
+    return posixpath.relpath(target, directory or '.') + suffix
+
+def rewrite_references(path, data, manifest):
+    """Point relative ``url()``, ``src`` and ``href`` references in the CSS
+    or HTML file at ``path`` to the fingerprinted files in ``manifest``.
+    """
+    ext = posixpath.splitext(path)[1].lower()
+
+    if ext == '.css':
+        def replace(match):
+            target = _resolve(match.group(2), path, manifest)
+            if target is None:
+                return match.group(0)
+            return 'url(%s%s%s)' % (match.group(1), target, match.group(1),)
+        return _css_reference.sub(replace, data)
+
+    if ext in PAGE_TYPES:
+        def replace(match):
+            target = _resolve(match.group(3), path, manifest)
+            if target is None:
+                return match.group(0)
+            return '%s%s%s%s' % (match.group(1), match.group(2), target, match.group(2),)
+        return _html_reference.sub(replace, data)
+
+    return data
+
+def _build_order(path):
+    # Stylesheets refer to images and pages refer to everything, so
+    # fingerprint the things they refer to first.
+    ext = posixpath.splitext(path)[1].lower()
+    if ext in PAGE_TYPES:
+        return (2, path,)
+    if ext == '.css':
+        return (1, path,)
+    return (0, path,)
+
+def _write(output_dir, path, data):
+    filename = os.path.join(output_dir, *path.split('/'))
+    directory = os.path.dirname(filename)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    with open(filename, 'wb') as f:
+        f.write(data)
+
+    if posixpath.splitext(path)[1].lower() not in COMPRESSED_TYPES:
+        return
+
+    buf = StringIO()
+    with gzip.GzipFile(filename='', mode='wb', fileobj=buf, compresslevel=9, mtime=0) as f:
+        f.write(data)
+    variants = [('.gz', buf.getvalue(),)]
+
+    if brotli is not None:
+        variants.append(('.br', brotli.compress(data),))
+
+    for suffix, compressed in variants:
+        if len(compressed) < len(data):
+            with open(filename + suffix, 'wb') as f:
+                f.write(compressed)
+
+def build_assets(static_dir, output_dir):
+    """Copy the assets in ``static_dir`` to ``output_dir``, adding a copy of
+    each under a name containing a hash of its contents, plus gzip (and,
+    if the ``brotli`` module is installed, brotli) compressed variants.
+    References between stylesheets, pages and other assets are rewritten to
+    the fingerprinted names.
+
+    Writes and returns a manifest mapping each original path, relative to
+    ``static_dir``, to its fingerprinted path. Files from earlier builds
+    are left in place for clients which still refer to them.
+    """
+    paths = []
+    for directory, dirnames, filenames in os.walk(static_dir):
+        dirnames.sort()
+        relative = os.path.relpath(directory, static_dir)
+        for filename in filenames:
+            if filename.startswith('.'):
+                continue
+            if relative == os.curdir:
+                paths.append(filename)
+            else:
+                paths.append('/'.join(relative.split(os.sep) + [filename]))
+
+    manifest = {}
+    for path in sorted(paths, key=_build_order):
+        with open(os.path.join(static_dir, *path.split('/')), 'rb') as f:
+            data = rewrite_references(path, f.read(), manifest)
+
+        _write(output_dir, path, data)
+
+        if posixpath.splitext(path)[1].lower() not in PAGE_TYPES:
+            manifest[path] = fingerprint(path, data)
+            _write(output_dir, manifest[path], data)
+
+    with open(os.path.join(output_dir, MANIFEST), 'wb') as f:
+        json.dump(manifest, f, indent=0, sort_keys=True)
+
+    return manifest
+
+def load_manifest(output_dir):
+    """Return the manifest of assets built into ``output_dir``, or ``None``
+    if they have not been built.
+    """
+    if not output_dir:
+        return None
+
+    try:
+        with open(os.path.join(output_dir, MANIFEST), 'rb') as f:
+            return json.load(f)
+    except IOError:
+        return None
+
+# Serving
+
+def asset_url(request, path):
+    """URL of the asset at ``path``, relative to the ``static`` directory.
+    Built assets are referred to by their fingerprinted names.
+    """
+    manifest = getattr(request.registry, 'asset_manifest', None)
+    if manifest is None:
+        return request.static_url('babytracker:static/' + path)
+    return request.route_url('static', subpath=manifest.get(path, path))
+
+class _FileIter(object):
+
+    block_size = 64 * 1024
+
+    def __init__(self, f):
+        self.f = f
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        data = self.f.read(self.block_size)
+        if not data:
+            raise StopIteration
+        return data
+
+    def close(self):
+        self.f.close()
+
+class StaticAssets(object):
+    """View serving assets built by ``build_assets()`` from
+    ``output_dir``. Fingerprinted files never change, so they may be cached
+    for good; anything else is cached for ``cache_max_age`` seconds.
+    Compressed variants are served to clients which accept them.
+    """
+
+    def __init__(self, output_dir, manifest, cache_max_age=3600):
+        self.output_dir = os.path.abspath(output_dir)
+        self.fingerprinted = frozenset(manifest.values())
+        self.cache_max_age = cache_max_age
+
+    def __call__(self, context, request):
+        subpath = request.matchdict['subpath']
+        if not subpath or any(
+            not segment or segment.startswith('.') or '/' in segment or os.sep in segment
+            for segment in subpath
+        ):
+            raise HTTPNotFound()
+
+        path = '/'.join(subpath)
+        filename = os.path.join(self.output_dir, *subpath)
+        if path == MANIFEST or not os.path.isfile(filename):
+            raise HTTPNotFound()
+
+        content_type, encoding = mimetypes.guess_type(filename, strict=False)
+        response = Response(
+            content_type=content_type or 'application/octet-stream',
+            conditional_response=True,
+        )
+
+        served = filename
+        for name, suffix in ENCODINGS:
+            if os.path.isfile(filename + suffix):
+                response.vary = ('Accept-Encoding',)
+                if name in request.accept_encoding:
+                    served = filename + suffix
+                    response.content_encoding = name
+                    break
+
+        stat = os.stat(served)
+        response.app_iter = _FileIter(open(served, 'rb'))
+        response.content_length = stat.st_size
+        response.last_modified = stat.st_mtime
+        response.etag = '%s-%s-%s' % (
+            int(stat.st_mtime), stat.st_size, response.content_encoding or 'identity',
+        )
+
+        if path in self.fingerprinted:
+            response.headers['Cache-Control'] = 'public, max-age=%d, immutable' % ONE_YEAR
+        else:
+            response.cache_expires = self.cache_max_age
+
+        return response
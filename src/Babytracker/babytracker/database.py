@@ -0,0 +1,128 @@
+import time
+import threading
+
+from pyramid.settings import asbool
+
+from sqlalchemy import engine_from_config, event, exc
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+class PoolMetrics(object):
+    """Process-wide counters of connection pool activity: connections made,
+    checked out and in, time spent waiting for a connection, checkouts
+    which timed out, connections found dead on checkout and pools discarded
+    after a database disconnect.
+    """
+
+    counters = ('connects', 'checkouts', 'checkins', 'timeouts', 'invalidations', 'disposals',)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            for name in self.counters:
+                setattr(self, name, 0)
+            self.wait_time = 0.0
+            self.max_wait_time = 0.0
+
+    def increment(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def waited(self, seconds):
+        with self._lock:
+            self.wait_time += seconds
+            self.max_wait_time = max(self.max_wait_time, seconds)
+
+    def snapshot(self, engine=None):
+        """Return the counters, plus the current state of ``engine``'s pool
+        if it is a ``QueuePool``.
+        """
+        with self._lock:
+            metrics = dict((name, getattr(self, name),) for name in self.counters)
+            metrics['wait_time'] = self.wait_time
+            metrics['max_wait_time'] = self.max_wait_time
+
+        pool = getattr(engine, 'pool', None)
+        if isinstance(pool, QueuePool):
+            metrics['pool_size'] = pool.size()
+            metrics['checked_in'] = pool.checkedin()
+            metrics['checked_out'] = pool.checkedout()
+            metrics['overflow'] = max(pool.overflow(), 0)
+
+        return metrics
+
+pool_metrics = PoolMetrics()
+
+class InstrumentedQueuePool(QueuePool):
+    """``QueuePool`` which records how long checkouts wait for a connection
+    in ``pool_metrics``.
+    """
+
+    def _do_get(self):
+        start = time.time()
+        try:
+            return QueuePool._do_get(self)
+        except exc.TimeoutError:
+            pool_metrics.increment('timeouts')
+            raise
+        finally:
+            pool_metrics.waited(time.time() - start)
+
+    def dispose(self):
+        # Called when a query fails because the database went away, after
+        # which the engine replaces the pool, and on shutdown
+        pool_metrics.increment('disposals')
+        QueuePool.dispose(self)
+
+def _count_connect(dbapi_connection, connection_record):
+    pool_metrics.increment('connects')
+
+def _count_checkout(dbapi_connection, connection_record, connection_proxy):
+    pool_metrics.increment('checkouts')
+
+def _count_checkin(dbapi_connection, connection_record):
+    pool_metrics.increment('checkins')
+
+def _ping(dbapi_connection, connection_record, connection_proxy):
+    # Make sure a connection still works before handing it out, so one left
+    # over from before a database restart is replaced rather than failing
+    # the request.
+    try:
+        cursor = dbapi_connection.cursor()
+        cursor.execute("SELECT 1")
+        cursor.close()
+    except Exception, e:
+        pool_metrics.increment('invalidations')
+        raise exc.DisconnectionError(str(e))
+
+def create_engine_from_settings(settings):
+    """Create the engine for ``sqlalchemy.url``, with an instrumented pool
+    configured by the ``database-pool-size``, ``database-max-overflow``,
+    ``database-pool-timeout`` and ``database-pool-recycle`` settings, and
+    connections checked on checkout if ``database-pre-ping`` is set.
+
+    SQLite keeps SQLAlchemy's default pool, which does not share
+    connections between threads, so the pool settings do not apply to it.
+    """
+    kw = {}
+    if not make_url(settings['sqlalchemy.url']).drivername.startswith('sqlite'):
+        kw.update(
+            poolclass=InstrumentedQueuePool,
+            pool_size=int(settings.get('database-pool-size', 5)),
+            max_overflow=int(settings.get('database-max-overflow', 10)),
+            pool_timeout=int(settings.get('database-pool-timeout', 30)),
+            pool_recycle=int(settings.get('database-pool-recycle', -1)),
+        )
+
+    engine = engine_from_config(settings, 'sqlalchemy.', **kw)
+
+    if asbool(settings.get('database-pre-ping', False)):
+        event.listen(engine.pool, 'checkout', _ping)
+    event.listen(engine.pool, 'connect', _count_connect)
+    event.listen(engine.pool, 'checkout', _count_checkout)
+    event.listen(engine.pool, 'checkin', _count_checkin)
+
+    return engine
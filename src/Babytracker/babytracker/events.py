@@ -0,0 +1,179 @@
+import time
+import Queue
+import logging
+import threading
+import transaction
+
+from pyramid.path import DottedNameResolver
+from pyramid.settings import asbool
+
+from sqlalchemy import select, func
+
+from babytracker.models import DBSession, changes
+
+log = logging.getLogger(__name__)
+
+def baby_channel(baby_id):
+    return 'baby-%d' % baby_id
+
+class Subscription(object):
+    """Messages published to one channel since subscribing. Close it when
+    done so that the broker stops queueing messages for it.
+    """
+
+    def __init__(self, broker, channel):
+        self.broker = broker
+        self.channel = channel
+        self._queue = Queue.Queue()
+
+    def put(self, message):
+        self._queue.put(message)
+
+    def get(self, timeout):
+        """Return the next message, waiting up to ``timeout`` seconds for
+        one, or ``None`` if there is none.
+        """
+        try:
+            return self._queue.get(timeout=timeout)
+        except Queue.Empty:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+class LocalBroker(object):
+    """Publish/subscribe within one process. Messages published by one
+    worker are not seen by clients connected to another, so use a broker
+    which fans out between workers, such as ``PollingBroker``, when running
+    several.
+    """
+
+    def __init__(self, settings=None):
+        self._lock = threading.Lock()
+        self._subscriptions = {}
+
+    def publish(self, channel, message):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            subscription.put(message)
+
+    def subscribe(self, channel):
+        subscription = Subscription(self, channel)
+        with self._lock:
+            self._subscriptions.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.channel, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self._subscriptions.pop(subscription.channel, None)
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(s) for s in self._subscriptions.values())
+
+class PollingBroker(LocalBroker):
+    """Broker which also passes on changes made by other workers, by
+    polling the ``changes`` table every ``events-poll-interval`` seconds.
+    There is one query per interval per worker with subscribers, however
+    many clients are connected.
+    """
+
+    def __init__(self, settings=None):
+        LocalBroker.__init__(self, settings)
+        self.interval = float((settings or {}).get('events-poll-interval', 1))
+        self.last_seq = None
+        self._thread = None
+
+    def subscribe(self, channel):
+        subscription = LocalBroker.subscribe(self, channel)
+
+        # Started in the worker, since threads do not survive forking
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                if self.last_seq is None:
+                    self.poll()
+                self._thread = threading.Thread(target=self._run, name='PollingBroker')
+                self._thread.daemon = True
+                self._thread.start()
+
+        return subscription
+
+    def poll(self):
+        """Publish a message for each baby with changes since the last
+        poll. Returns the number of messages published.
+        """
+        c = changes.c
+        engine = DBSession.bind
+
+        if self.last_seq is None:
+            self.last_seq = engine.execute(select([func.max(c.seq)])).scalar() or 0
+            return 0
+
+        rows = engine.execute(
+            select([c.baby_id, func.max(c.seq)]).where(c.seq>self.last_seq).group_by(c.baby_id)
+        ).fetchall()
+
+        for baby_id, seq in rows:
+            self.last_seq = max(self.last_seq, seq)
+            LocalBroker.publish(self, baby_channel(baby_id), {'baby_id': baby_id, 'seq': seq})
+
+        return len(rows)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._subscriptions:
+                    self._thread = None
+                    return
+            try:
+                self.poll()
+            except Exception:
+                log.exception("Failed to poll for changes")
+
+broker = LocalBroker()
+
+# Whether @@events streams are served. Each open stream holds a sync worker
+# for up to stream_timeout seconds, so only enable them with gevent or
+# eventlet workers; otherwise clients poll @@changes.
+streams_enabled = True
+
+# Event streams end after this many seconds, and clients reconnect. Keep it
+# below the gunicorn worker timeout.
+stream_timeout = 25
+
+# Seconds between comments sent to keep idle streams open through proxies
+keepalive_interval = 10
+
+def configure_events(settings):
+    """Set up the broker from the ``events-broker`` setting, the dotted name
+    of a broker class or factory called with the settings (by default
+    ``LocalBroker``), the ``events-streams`` setting, whether to serve
+    event streams at all, and the ``events-stream-timeout`` and
+    ``events-keepalive`` settings, in seconds.
+    """
+    global broker, streams_enabled, stream_timeout, keepalive_interval
+
+    factory = DottedNameResolver(None).maybe_resolve(
+        settings.get('events-broker', 'babytracker.events:LocalBroker'))
+    broker = factory(settings)
+    streams_enabled = asbool(settings.get('events-streams', True))
+    stream_timeout = int(settings.get('events-stream-timeout', 25))
+    keepalive_interval = int(settings.get('events-keepalive', 10))
+
+def publish_changes(baby_id, transaction_manager=transaction.manager):
+    """Tell subscribers to the baby's channel that it or its entries have
+    changed, once the current transaction of ``transaction_manager`` has
+    been committed.
+    """
+    def publish(success):
+        if success:
+            broker.publish(baby_channel(baby_id), {'baby_id': baby_id})
+    transaction_manager.get().addAfterCommitHook(publish)
+
+def subscribe(baby_id):
+    return broker.subscribe(baby_channel(baby_id))
@@ -1,4 +1,7 @@
+from functools import partial
+
 from pyramid.renderers import get_renderer
+from pyramid.settings import asbool
 
 from pyramid.events import subscriber
 from pyramid.events import BeforeRender
@@ -6,20 +9,62 @@ from pyramid.events import NewRequest
 
 from pyramid.security import authenticated_userid
 
+from babytracker.assets import asset_url
+
+_layout = None
+
+def get_layout(request):
+    """Return the main layout macro. It is looked up once per process,
+    unless templates are being reloaded.
+    """
+    global _layout
+
+    if _layout is None:
+        layout = get_renderer('templates/layout.pt').implementation()
+
+        settings = getattr(getattr(request, 'registry', None), 'settings', None) or {}
+        if asbool(settings.get('reload_templates', False)):
+            return layout
+
+        _layout = layout
+
+    return _layout
+
+def is_page(event):
+    """Whether a BeforeRender event is for an HTML page, rather than an
+    API or other JSON response, which don't use the layout.
+    """
+    if event.get('renderer_name') == 'json':
+        return False
+
+    request = event.get('request')
+    route = getattr(request, 'matched_route', None)
+    if route is not None and route.name == 'api':
+        return False
+
+    return True
+
 @subscriber(BeforeRender)
 def add_base_template(event):
-    layout = get_renderer('templates/layout.pt').implementation()
-    event.update({'layout': layout})
+    if is_page(event):
+        event.update({'layout': get_layout(event.get('request'))})
 
 @subscriber(BeforeRender)
 def add_login_status(event):
-    event.update({'authenticated_userid': authenticated_userid(event['request'])})
+    if is_page(event):
+        event.update({'authenticated_userid': authenticated_userid(event['request'])})
+
+@subscriber(BeforeRender)
+def add_asset_url(event):
+    if is_page(event):
+        event.update({'asset_url': partial(asset_url, event['request'])})
 
 def api_access_control(request, response):
     """Set CORS Access-Control-* headers if the request itself did not for
     requests coming into on the /api route.
 
-    By default, we allow all origins, credentials and the Content-Type header.
+    By default, we allow all origins, credentials and the Content-Type header,
+    and expose the Link header used for paging.
     """
     if request.matched_route is not None and request.matched_route.name == 'api':
         if 'Access-Control-Allow-Origin' not in response.headers:
@@ -27,7 +72,9 @@ def api_access_control(request, response):
         if 'Access-Control-Allow-Credentials' not in response.headers:
             response.headers['Access-Control-Allow-Credentials'] = 'true'
         if 'Access-Control-Allow-Headers' not in response.headers:
-            response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
+            response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization, If-None-Match, If-Modified-Since'
+        if 'Access-Control-Expose-Headers' not in response.headers:
+            response.headers['Access-Control-Expose-Headers'] = 'Link, ETag, Last-Modified'
 
 @subscriber(NewRequest)
 def add_api_access_control(event):
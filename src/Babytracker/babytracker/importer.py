@@ -0,0 +1,274 @@
+import re
+import csv
+import inspect
+import json
+import datetime
+import logging
+import dateutil.parser
+import transaction
+
+from sqlalchemy.exc import DBAPIError
+from zope.sqlalchemy import ZopeTransactionExtension
+
+from babytracker import models
+from babytracker.events import publish_changes
+
+log = logging.getLogger(__name__)
+
+FORMATS = ('csv', 'ndjson',)
+
+# Entries are inserted and committed this many at a time
+BATCH_SIZE = 1000
+
+# At most this many invalid rows are reported
+MAX_ERRORS = 100
+
+# Columns which are not entry fields: the API's URL of an exported entry
+IGNORED_COLUMNS = ('url', 'id',)
+
+_datetime_format = re.compile(r'^(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d)(?::(\d\d)(?:\.(\d{1,6}))?)?$')
+
+def parse_datetime(value):
+    """Parse a date/time string into a naive ``datetime``. ISO 8601 dates as
+    exported are parsed directly; anything else goes through
+    ``dateutil``, which is much slower. Raises ``ValueError`` if it cannot
+    be parsed.
+    """
+    match = _datetime_format.match(value)
+    if match is not None:
+        year, month, day, hour, minute, second, fraction = match.groups()
+        return datetime.datetime(int(year), int(month), int(day), int(hour), int(minute),
+            int(second or 0), int((fraction or '0').ljust(6, '0')))
+
+    try:
+        # XXX: As for the API, we strip timezone to make naive dates
+        return dateutil.parser.parse(value).replace(tzinfo=None)
+    except (AttributeError, TypeError, OverflowError,):
+        raise ValueError(value)
+
+def _minutes(value):
+    return datetime.timedelta(minutes=int(value or 0))
+
+class EntryParser(object):
+    """Turns rows of an import file, dicts of strings or JSON values, into
+    ``(entry_class, kwargs)`` tuples for creating entries. The fields of
+    each entry type are looked up once, rather than for every row.
+    """
+
+    def __init__(self):
+        self.fields = {}
+
+    def converters(self, entry_type):
+        converters = self.fields.get(entry_type)
+        if converters is None:
+            factory = models.lookup_entry_type(entry_type)
+            if factory is None:
+                raise ValueError(u"Unknown entry_type: %s" % entry_type)
+
+            converters = {}
+            for name, convert in factory.json_fields:
+                if name in ('start', 'end', 'note',):
+                    continue
+                type_ = getattr(factory, name).property.columns[0].type.python_type
+                converters[name] = _minutes if type_ is datetime.timedelta else type_
+
+            # Constructor arguments without defaults, other than the baby
+            args, varargs, varkw, defaults = inspect.getargspec(factory.__init__)
+            required = [name for name in args[2:len(args) - len(defaults or ())] if name != 'start']
+
+            converters = self.fields[entry_type] = (factory, converters, required,)
+        return converters
+
+    def __call__(self, row):
+        """Raises ``ValueError`` with a message suitable for returning to
+        the client if the row is invalid. Empty values are ignored, since
+        CSV files have a column for every field of any entry type.
+        """
+        entry_type = row.get('entry_type')
+        start = row.get('start')
+        if not entry_type or not start:
+            raise ValueError("Row with 'entry_type' and 'start' expected")
+
+        factory, converters, required = self.converters(entry_type)
+
+        kwargs = {'note': None, 'end': None}
+
+        try:
+            kwargs['start'] = parse_datetime(start)
+        except (ValueError, TypeError,):
+            raise ValueError("Invalid start date")
+
+        for key, value in row.items():
+            if value is None or value == '' or key in ('entry_type', 'start',) or key in IGNORED_COLUMNS:
+                continue
+
+            if key == 'end':
+                try:
+                    kwargs['end'] = parse_datetime(value)
+                except (ValueError, TypeError,):
+                    raise ValueError("Invalid end date")
+            elif key == 'note':
+                if not isinstance(value, basestring):
+                    raise ValueError("Invalid note")
+                kwargs['note'] = value
+            else:
+                convert = converters.get(key)
+                if convert is None:
+                    raise ValueError(u"Unknown property %s of type %s" % (key, entry_type,))
+                try:
+                    kwargs[key] = convert(value)
+                except (TypeError, ValueError,), e:
+                    raise ValueError(u"Incompatible property %s of type %s: %s" % (key, entry_type, str(e)))
+
+        for name in required:
+            if name not in kwargs:
+                raise ValueError(u"Missing property %s of type %s" % (name, entry_type,))
+
+        return factory, kwargs
+
+def read_csv(f):
+    """Generator of the rows of a UTF-8 CSV file with a header row, as
+    dicts, read a line at a time
+    """
+    reader = csv.reader(f)
+    try:
+        header = reader.next()
+    except StopIteration:
+        return
+
+    if header and header[0].startswith('\xef\xbb\xbf'): # Byte order mark
+        header[0] = header[0][3:]
+    header = [name.strip() for name in header]
+
+    for row in reader:
+        if not row:
+            continue
+        try:
+            yield dict(zip(header, [value.decode('utf-8') for value in row]))
+        except UnicodeDecodeError:
+            yield ValueError("Invalid UTF-8")
+
+def read_ndjson(f):
+    """Generator of the rows of a newline-delimited JSON file, as dicts,
+    read a line at a time
+    """
+    for line in f:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield ValueError("Invalid JSON")
+            continue
+        if not isinstance(row, dict):
+            yield ValueError("JSON object expected")
+            continue
+        yield row
+
+READERS = {
+    'csv': read_csv,
+    'ndjson': read_ndjson,
+}
+
+class ImportResult(object):
+    """The outcome of ``import_entries()``. ``offset`` is the number of rows
+    of the file which have been dealt with, including those skipped at the
+    start, so an interrupted import can be resumed from there. ``errors`` is
+    a list of ``(row number, message)`` tuples for rows which were not
+    imported, counting rows from 1.
+    """
+
+    def __init__(self, offset):
+        self.offset = offset
+        self.imported = 0
+        self.errors = []
+        self.error_count = 0
+        self.failed = None
+
+    def add_error(self, row_number, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append((row_number, message,))
+
+    def to_json_dict(self):
+        data = {
+            'offset': self.offset,
+            'imported': self.imported,
+            'error_count': self.error_count,
+            'errors': [{'row': row, 'error': message} for row, message in self.errors],
+        }
+        if self.failed is not None:
+            data['error'] = self.failed
+        return data
+
+def import_entries(baby_id, f, format, offset=0, batch_size=None, progress=None):
+    """Import entries for the baby from the CSV or NDJSON file ``f``, read
+    incrementally. The first ``offset`` rows are skipped. Invalid rows are
+    reported and skipped.
+
+    Entries are created ``batch_size`` at a time, each batch in its own
+    transaction, so that a failure only loses the current batch. Batches use
+    their own session and transaction manager, leaving the thread's current
+    transaction, e.g. that of ``pyramid_tm``, alone. ``progress``, if given,
+    is called with the ``ImportResult`` after each batch is committed.
+    Returns the ``ImportResult``.
+    """
+    batch_size = batch_size or BATCH_SIZE
+    parse = EntryParser()
+    result = ImportResult(offset)
+    batch = []
+    row_number = 0
+
+    # The session is made by DBSession's factory, so that the summaries and
+    # changes are kept up to date as entries are flushed
+    manager = transaction.TransactionManager()
+    session = models.DBSession.session_factory(
+        extension=ZopeTransactionExtension(transaction_manager=manager))
+
+    for row in READERS[format](f):
+        row_number += 1
+        if row_number <= offset:
+            continue
+
+        try:
+            if isinstance(row, ValueError):
+                raise row
+            batch.append(parse(row))
+        except ValueError, e:
+            result.add_error(row_number, e.args[0])
+
+        if len(batch) >= batch_size:
+            if not _import_batch(manager, session, baby_id, batch, result, row_number, progress):
+                return result
+            batch = []
+
+    if batch:
+        _import_batch(manager, session, baby_id, batch, result, row_number, progress)
+    else:
+        result.offset = max(result.offset, row_number)
+
+    return result
+
+def _import_batch(manager, session, baby_id, batch, result, row_number, progress):
+    try:
+        with manager:
+            baby = session.query(models.Baby).get(baby_id)
+            if baby is None:
+                raise ValueError("Baby not found")
+
+            session.add_all([factory(baby=baby, **kwargs) for factory, kwargs in batch])
+            session.flush()
+
+            if batch:
+                publish_changes(baby_id, manager)
+    except (DBAPIError, ValueError,), e:
+        log.exception("Import failed at row %d", result.offset + 1)
+        result.failed = u"Import failed at row %d: %s" % (result.offset + 1, e,)
+        return False
+
+    result.imported += len(batch)
+    result.offset = row_number
+    if progress is not None:
+        progress(result)
+    return True
@@ -6,6 +6,16 @@ VIEW_PERMISSION = 'view'
 EDIT_PERMISSION = 'edit'
 SIGNUP_PERMISSION = 'signup'
 
+# Principal of requests authenticated with an API bearer token
+BEARER_TOKEN = 'bearer-token'
+
+def baby_principal(user_email, baby_id):
+    """Principal given to bearer tokens which may be used for a baby. It
+    names the baby's owner too, so that a token does not carry over to
+    another user's baby if the baby is deleted and its id reused.
+    """
+    return u'baby:%s:%d' % (user_email, baby_id,)
+
 # Interfaces
 
 class IJSONCapable(Interface):
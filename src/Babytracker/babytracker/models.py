@@ -1,37 +1,273 @@
-import hashlib
-from datetime import timedelta
+from collections import namedtuple
+from datetime import datetime, time, timedelta
 
-from sqlalchemy import Column, ForeignKey, desc
-from sqlalchemy import  String, Enum, Integer, Date, DateTime, Interval
+from sqlalchemy import MetaData, Table, Column, ForeignKey, Index, desc, or_, and_, func, case, select, event
+from sqlalchemy import  String, Enum, Integer, Date, DateTime, Interval, Boolean
+from sqlalchemy.sql.expression import FunctionElement
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.orm import scoped_session, sessionmaker
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy.orm import relationship, backref, validates, joinedload
+from sqlalchemy.orm.attributes import set_committed_value, get_history
 from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.engine.reflection import Inspector
 
 from zope.interface import implements
 from zope.sqlalchemy import ZopeTransactionExtension
 
-from pyramid.security import Everyone, Authenticated, Allow, Deny, DENY_ALL
+from pyramid.security import Everyone, Authenticated, Allow, Deny, DENY_ALL, ALL_PERMISSIONS
 
+from babytracker import passwords
 from babytracker.interfaces import IJSONCapable
 from babytracker.interfaces import VIEW_PERMISSION, EDIT_PERMISSION, SIGNUP_PERMISSION
+from babytracker.interfaces import BEARER_TOKEN, baby_principal
 
 DBSession = scoped_session(sessionmaker(extension=ZopeTransactionExtension()))
 Base = declarative_base()
 
+# Schema versions. A database created before the schema was versioned is
+# at version 0, and ``MIGRATIONS[n]`` upgrades a database from version n to
+# n + 1. Migrations should leave the schema usable by the previous release,
+# since workers running it may still be serving requests.
 
-class Root(object):
-    """Root factory
+class SchemaVersionError(Exception):
+    """The database schema is older than the code, and needs upgrading with
+    ``migrate_Babytracker``.
+    """
+
+schema_version = Table('schema_version', Base.metadata,
+    Column('version', Integer, nullable=False),
+)
+
+def get_schema_version(engine):
+    """The version of the schema of the database, without inspecting it
+    """
+    try:
+        return engine.execute(select([schema_version.c.version])).scalar() or 0
+    except DBAPIError: # no schema_version table
+        return 0
+
+def check_schema(engine):
+    """Raise ``SchemaVersionError`` if the database needs upgrading. This is
+    a single query, cheap enough to run whenever a worker starts.
+    """
+    version = get_schema_version(engine)
+    if version < SCHEMA_VERSION:
+        raise SchemaVersionError(
+            "The database schema is at version %d, but version %d is required. "
+            "Run migrate_Babytracker to upgrade it." % (version, SCHEMA_VERSION,)
+        )
+    return version
+
+def upgrade_schema(engine):
+    """Run the migrations needed to bring the database up to
+    ``SCHEMA_VERSION``, recording each version as it is reached. Does
+    nothing to a database which is up to date. Returns the version.
+    """
+    version = get_schema_version(engine)
+    while version < SCHEMA_VERSION:
+        MIGRATIONS[version](engine)
+        version += 1
+
+        connection = engine.connect()
+        try:
+            with connection.begin():
+                connection.execute(schema_version.delete())
+                connection.execute(schema_version.insert(), version=version)
+        finally:
+            connection.close()
+
+    return version
+
+def _schema_version_1():
+    """The tables at schema version 1, frozen so that migration 1 creates
+    the same schema whatever has been added to the models since.
+    """
+    metadata = MetaData()
+
+    Table('users', metadata,
+        Column('id', Integer, primary_key=True),
+        Column('email', String, unique=True),
+        Column('name', String),
+        Column('password', String),
+    )
+    Table('schema_version', metadata,
+        Column('version', Integer, nullable=False),
+    )
+    Table('babies', metadata,
+        Column('id', Integer, primary_key=True),
+        Column('dob', Date),
+        Column('name', String),
+        Column('slug', String),
+        Column('gender', Enum('m', 'f', name='genders')),
+        Column('version', Integer),
+        Column('modified', DateTime),
+        Column('user_id', Integer, ForeignKey('users.id')),
+        Index('ix_babies_user_id_slug', 'user_id', 'slug', unique=True),
+    )
+    Table('entries', metadata,
+        Column('id', Integer, primary_key=True),
+        Column('type', String),
+        Column('start', DateTime),
+        Column('end', DateTime, nullable=True),
+        Column('note', String, nullable=True),
+        Column('baby_id', Integer, ForeignKey('babies.id')),
+        Column('left_duration', Interval),
+        Column('right_duration', Interval),
+        Column('amount', Integer),
+        Column('topup', Integer),
+        Column('duration', Interval),
+        Column('contents', Enum('wet', 'dirty', 'none', name='nappy_states')),
+        Index('ix_entries_baby_id_start', 'baby_id', 'start'),
+        Index('ix_entries_baby_id_type_start', 'baby_id', 'type', 'start'),
+    )
+    Table('daily_summaries', metadata,
+        Column('baby_id', Integer, ForeignKey('babies.id'), primary_key=True),
+        Column('day', Date, primary_key=True),
+        *[Column(name, Integer, nullable=False, default=0) for name in (
+            'feeds', 'left_duration', 'right_duration', 'bottle_amount', 'topup_amount',
+            'sleeps', 'sleep_duration', 'nappy_changes', 'wet_nappies', 'dirty_nappies',
+        )]
+    )
+
+    return metadata
+
+def _upgrade_unversioned(engine):
+    """Schema version 1: create any tables, columns and indexes missing
+    from a database created before the schema was versioned.
+
+    This works from the tables in ``_schema_version_1()`` rather than the
+    models, so that later tables and columns are left to their own
+    migrations. ``create_all()`` skips tables that already exist, so columns
+    and indexes added to an existing table have to be created separately.
+    Columns are added as nullable, and any data they need is filled in before
+    indexes are created. A new ``daily_summaries`` table is filled in from
+    existing entries.
     """
+    metadata = _schema_version_1()
+    missing = set(metadata.tables) - set(Inspector.from_engine(engine).get_table_names())
+
+    metadata.create_all(engine)
+
+    inspector = Inspector.from_engine(engine)
+    for table in metadata.sorted_tables:
+        existing = set(column['name'] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing:
+                engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                    table.name, column.name, column.type.compile(dialect=engine.dialect),
+                ))
+
+    babies = metadata.tables['babies']
+    _fill_baby_slugs(engine, babies)
+
+    if 'daily_summaries' in missing:
+        for (baby_id,) in engine.execute(select([babies.c.id])).fetchall():
+            refresh_daily_summaries(engine, baby_id)
+
+    for table in metadata.sorted_tables:
+        existing = set(index['name'] for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(engine)
+
+def _fill_baby_slugs(engine, babies):
+    """Set ``slug`` in the ``babies`` table for babies created before it
+    existed, making duplicates unique so that the ``(user_id, slug)`` index
+    can be created.
+    """
+    rows = engine.execute(
+        babies.select().where(babies.c.slug==None).order_by(babies.c.id)
+    ).fetchall()
+
+    for row in rows:
+        base = slug = Baby.normalize_name(row.name or u'baby')
+        i = 1
+        while engine.execute(babies.select().where(and_(
+            babies.c.user_id==row.user_id,
+            babies.c.slug==slug,
+        ))).first() is not None:
+            i += 1
+            slug = u"%s-%d" % (base, i,)
+
+        engine.execute(babies.update().where(babies.c.id==row.id).values(slug=slug))
+
+def _create_changes(engine):
+    """Schema version 2: add the ``changes`` table, with a change for each
+    existing baby and entry so that clients can sync them from the start.
+    """
+    changes.create(engine, checkfirst=True)
+    if engine.execute(select([func.count(changes.c.seq)])).scalar():
+        return
+
+    babies = Baby.__table__
+    entries = Entry.__table__
+
+    for row in engine.execute(select([babies.c.id, babies.c.user_id]).order_by(babies.c.id)).fetchall():
+        engine.execute(changes.insert(), kind='baby', object_id=row.id, baby_id=row.id,
+            user_id=row.user_id, deleted=False)
+
+        entry_ids = engine.execute(
+            select([entries.c.id]).where(entries.c.baby_id==row.id).order_by(entries.c.id)
+        ).fetchall()
+        if entry_ids:
+            engine.execute(changes.insert(), [
+                dict(kind='entry', object_id=entry_id, baby_id=row.id, user_id=None, deleted=False)
+                for (entry_id,) in entry_ids
+            ])
+
+MIGRATIONS = (
+    _upgrade_unversioned,
+    _create_changes,
+)
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+# SQL helpers for aggregating entries. Postgres has native intervals and
+# date formatting; SQLite stores intervals as datetimes relative to the epoch.
+
+class interval_seconds(FunctionElement):
+    """The number of seconds in an ``Interval`` value
+    """
+    type = Integer()
+    name = 'interval_seconds'
 
-    _instance = None
+@compiles(interval_seconds)
+def _compile_interval_seconds(element, compiler, **kw):
+    return "EXTRACT(EPOCH FROM %s)" % compiler.process(element.clauses)
 
-    # Singleton factory - this class has no state anyway, but want to be
-    # able to record lineage to it via ``__parent__``
-    def __new__(cls, request=None):
-        if cls._instance is None:
-            cls._instance = object.__new__(cls)
-        return cls._instance
+@compiles(interval_seconds, 'sqlite')
+def _compile_interval_seconds_sqlite(element, compiler, **kw):
+    return "CAST(strftime('%%s', %s) AS INTEGER)" % compiler.process(element.clauses)
+
+class time_period(FunctionElement):
+    """The day (``YYYY-MM-DD``) or hour (``YYYY-MM-DDTHH:00:00``) of a
+    ``DateTime`` value, as an ISO formatted string
+    """
+    type = String()
+    name = 'time_period'
+
+    def __init__(self, expr, period='day'):
+        self.period = period
+        super(time_period, self).__init__(expr)
+
+@compiles(time_period)
+def _compile_time_period(element, compiler, **kw):
+    format = element.period == 'hour' and 'YYYY-MM-DD"T"HH24:00:00' or 'YYYY-MM-DD'
+    return "to_char(%s, '%s')" % (compiler.process(element.clauses), format,)
+
+@compiles(time_period, 'sqlite')
+def _compile_time_period_sqlite(element, compiler, **kw):
+    format = element.period == 'hour' and '%Y-%m-%dT%H:00:00' or '%Y-%m-%d'
+    return "strftime('%s', %s)" % (format, compiler.process(element.clauses),)
+
+class Root(object):
+    """Root factory, called with each request
+    """
+
+    def __init__(self, request=None):
+        self.request = request
 
     # Traversal
 
@@ -42,11 +278,17 @@ class Root(object):
         if '@' not in name or name.startswith('@'): # view or not an email address
             raise KeyError(name)
 
-        session = DBSession()
-        try:
-            return session.query(User).filter_by(email=name).one()
-        except NoResultFound:
-            raise KeyError(name)
+        # Re-use the user already loaded for authentication, if any
+        user = getattr(self.request, 'user', None)
+        if user is None or user.email != name:
+            session = DBSession()
+            try:
+                user = session.query(User).options(joinedload('babies')).filter_by(email=name).one()
+            except NoResultFound:
+                raise KeyError(name)
+
+        user._parent = self
+        return user
 
     # Security
 
@@ -76,23 +318,31 @@ class User(Base):
 
     @classmethod
     def _hash_password(self, password):
-        return hashlib.sha1(password).hexdigest()
+        return passwords.hash_password(password)
 
     @classmethod
     def authenticate(cls, email, password):
         """Attempt to find and return a ``User`` object with the given username
         and password. The password should be in plain text as entered by
         the user. Returns ``None`` if no user could be found.
+
+        Passwords stored with a legacy or out of date hash are hashed again
+        when the user logs in successfully.
         """
         session = DBSession()
         try:
-            return session.query(User).filter_by(
-                email=email,
-                password=cls._hash_password(password)
-            ).one()
+            user = session.query(User).filter_by(email=email).one()
         except NoResultFound:
             return None
 
+        if not passwords.verify_password(password, user.password):
+            return None
+
+        if passwords.needs_rehash(user.password):
+            user.change_password(password)
+
+        return user
+
     def change_password(self, new_password):
         """Set a new password. ``new_password`` should be in plain text. The
         password will be stored hashed.
@@ -107,13 +357,65 @@ class User(Base):
 
     @property
     def __parent__(self):
-        return Root()
+        if self._parent is None:
+            return Root()
+        return self._parent
 
     def __getitem__(self, name):
-        for baby in self.babies:
-            if baby.__name__ == name:
-                return baby
-        raise KeyError(name)
+        baby = self.find_baby(name)
+        if baby is None:
+            raise KeyError(name)
+        return baby
+
+    def find_baby(self, slug):
+        """Return the baby with the given slug (normalised name), or
+        ``None``.
+        """
+
+        # Avoid a query if the babies have been loaded already
+        if 'babies' in self.__dict__:
+            for baby in self.babies:
+                if baby.slug == slug:
+                    return baby
+            return None
+
+        session = DBSession()
+        return session.query(Baby).filter_by(user_id=self.id, slug=slug).first()
+
+    def list_baby_changes(self, since, limit=None):
+        """Return ``ChangeRecord`` tuples for babies of this user added,
+        changed or deleted after sequence number ``since``, oldest first.
+        """
+        return _list_changes(and_(changes.c.user_id==self.id, changes.c.kind=='baby'), since, limit)
+
+    def last_baby_change(self):
+        """The sequence number of the latest change to one of this user's
+        babies, or 0
+        """
+        return _last_change(and_(changes.c.user_id==self.id, changes.c.kind=='baby'))
+
+    def list_entries_between(self, babies, start, end, entry_type=None):
+        """Like ``Baby.list_entries_between()``, for several of the user's
+        ``babies`` in one query. Returns a dict of lists of ``EntryRecord``
+        tuples, most recent first, keyed by baby id.
+        """
+        result = dict((baby.id, [],) for baby in babies)
+        if not result:
+            return result
+
+        session = DBSession()
+        entries = Entry.__table__.c
+
+        query = select([entries.baby_id] + [entries[name] for name in EntryRecord._fields]).where(
+            entries.baby_id.in_(result.keys())
+        )
+        query = _filter_entries(query, start, end, entry_type)
+        query = query.order_by(desc(entries.start), desc(entries.id))
+
+        for row in session.execute(query):
+            result[row[0]].append(EntryRecord._make(row[1:]))
+
+        return result
 
     # Security
 
@@ -139,11 +441,22 @@ class Baby(Base):
     id = Column(Integer, primary_key=True)
     dob = Column(Date)
     name = Column(String)
+    slug = Column(String)
     gender = Column(Enum('m', 'f', name='genders'))
 
+    # Incremented whenever the baby or any of its entries change. Used to
+    # answer conditional requests without loading entries.
+    version = Column(Integer, default=1)
+    modified = Column(DateTime, default=datetime.utcnow)
+
     user_id = Column(Integer, ForeignKey('users.id'))
     user = relationship("User", backref=backref('babies', order_by=id))
 
+    # Used for traversal, and to keep names unique for each user
+    __table_args__ = (
+        Index('ix_babies_user_id_slug', 'user_id', 'slug', unique=True),
+    )
+
     def __init__(self, user, dob, name, gender):
         self.user = user
         self.dob = dob
@@ -153,9 +466,15 @@ class Baby(Base):
 
     # Operations
 
-    def get_entries_between(self, start, end, entry_type=None):
+    def get_entries_between(self, start, end, entry_type=None, after=None):
         """Return a list of entries in reverse order between the start and end
-        datetimes, inclusive
+        datetimes, inclusive.
+
+        Entries are ordered by ``start`` and then ``id``, both descending, so
+        that the ordering is stable. Pass the ``(start, id)`` of the last
+        entry seen as ``after`` to continue listing from the entry after it.
+        Entries without a ``start`` have no place in the ordering, and are
+        left out.
         """
         session = DBSession()
 
@@ -167,20 +486,132 @@ class Baby(Base):
 
         if start is not None:
             query = query.filter(cls.start>=start)
+        else:
+            query = query.filter(cls.start!=None)
         if end is not None:
             query = query.filter(cls.start<=end)
 
-        return query.order_by(desc(cls.start))
+        if after is not None:
+            after_start, after_id = after
+            query = query.filter(or_(
+                cls.start<after_start,
+                and_(cls.start==after_start, cls.id<after_id),
+            ))
+
+        return query.order_by(desc(cls.start), desc(cls.id))
+
+    def list_entries_between(self, start, end, entry_type=None, after=None, limit=None):
+        """Like ``get_entries_between()``, but return a list of read-only
+        ``EntryRecord`` tuples rather than ORM objects, for listings. Only
+        the columns of the ``entries`` table are selected, and nothing is
+        added to the session. ``limit`` is the maximum number of records.
+        """
+        session = DBSession()
+        entries = Entry.__table__.c
+
+        query = select([entries[name] for name in EntryRecord._fields]).where(entries.baby_id==self.id)
+        query = _filter_entries(query, start, end, entry_type)
+
+        if after is not None:
+            after_start, after_id = after
+            # The redundant bound on start lets the (baby_id, start) index
+            # skip straight to the page, rather than scanning from the start
+            query = query.where(and_(entries.start<=after_start, or_(
+                entries.start<after_start,
+                and_(entries.start==after_start, entries.id<after_id),
+            )))
+
+        query = query.order_by(desc(entries.start), desc(entries.id))
+        if limit is not None:
+            query = query.limit(limit)
+
+        return [EntryRecord._make(row) for row in session.execute(query)]
+
+    def get_summary(self, start, end, period='day'):
+        """Return a list of dicts summarising the entries between the start
+        and end datetimes, inclusive, for each day or hour (``period``) that
+        has entries, most recent first. Durations are in minutes and amounts
+        in ml. The aggregation happens in the database.
+        """
+        session = DBSession()
+        entries = Entry.__table__.c
+
+        bucket = time_period(entries.start, period)
+        query = session.query(bucket, *summary_columns()).filter(entries.baby_id==self.id)
+
+        if start is not None:
+            query = query.filter(entries.start>=start)
+        else:
+            query = query.filter(entries.start!=None)
+        if end is not None:
+            query = query.filter(entries.start<=end)
+
+        query = query.group_by(bucket).order_by(desc(bucket))
+
+        return [summary_json(row[0], row[1:]) for row in query]
+
+    def get_entry_records(self, entry_ids):
+        """Return a dict of ``EntryRecord`` tuples for those of the given
+        entry ids which belong to this baby, keyed by id.
+        """
+        if not entry_ids:
+            return {}
+
+        session = DBSession()
+        entries = Entry.__table__.c
+
+        query = select([entries[name] for name in EntryRecord._fields]).where(and_(
+            entries.baby_id==self.id,
+            entries.id.in_(entry_ids),
+        ))
+
+        return dict((row.id, EntryRecord._make(row),) for row in session.execute(query))
+
+    def list_changes(self, since, limit=None):
+        """Return ``ChangeRecord`` tuples for changes to this baby and its
+        entries after sequence number ``since``, oldest first.
+        """
+        return _list_changes(changes.c.baby_id==self.id, since, limit)
+
+    def last_change(self):
+        """The sequence number of the latest change to this baby or its
+        entries, or 0
+        """
+        return _last_change(changes.c.baby_id==self.id)
+
+    def get_daily_summary(self, start, end):
+        """Like ``get_summary()`` for whole days from the ``start`` date to
+        the ``end`` date, inclusive, but read from the precalculated
+        ``daily_summaries`` table.
+        """
+        session = DBSession()
+        summaries = daily_summaries.c
+
+        query = select([summaries.day] + [summaries[name] for name in SUMMARY_FIELDS]).where(summaries.baby_id==self.id)
+
+        if start is not None:
+            query = query.where(summaries.day>=start)
+        if end is not None:
+            query = query.where(summaries.day<=end)
+
+        query = query.order_by(desc(summaries.day))
+
+        return [summary_json(row[0].isoformat(), row[1:]) for row in session.execute(query)]
 
     @staticmethod
     def normalize_name(name):
         return name.strip().lower().replace(' ', '-')
 
+    @validates('name')
+    def _update_slug(self, key, name):
+        self.slug = self.normalize_name(name)
+        return name
+
     # Traversal
 
     @property
     def __name__(self):
-        return self.normalize_name(self.name)
+        return self.slug
 
     @property
     def __parent__(self):
@@ -190,15 +621,32 @@ class Baby(Base):
         entry_id = None
         try:
             entry_id = int(name)
-        except:
+        except (TypeError, ValueError,):
             raise KeyError(name)
 
+        # get() returns the entry from the identity map if it has been loaded
+        # already. Since entries are loaded with_polymorphic, this is an
+        # instance of the right subclass with all its columns.
         session = DBSession()
-        try:
-            return session.query(Entry).filter_by(id=entry_id).one()
-        except NoResultFound:
+        entry = session.query(Entry).get(entry_id)
+        if entry is None or entry.baby_id != self.id:
             raise KeyError(name)
 
+        # We know the parent already; don't load it again for traversal
+        set_committed_value(entry, 'baby', self)
+        return entry
+
+    # Security
+
+    @property
+    def __acl__(self):
+        # Bearer tokens list the babies they can be used for. Other requests
+        # are checked against the user's ACL.
+        return [
+            (Allow, baby_principal(self.user.email, self.id), (VIEW_PERMISSION, EDIT_PERMISSION,)),
+            (Deny, BEARER_TOKEN, ALL_PERMISSIONS),
+        ]
+
     # JSON representation
 
     def to_json_dict(self):
@@ -208,6 +656,14 @@ class Baby(Base):
             'gender': self.gender,
         }
 
+# Conversion of entry attributes to JSON values
+
+def _isoformat(value):
+    return value.isoformat() if value is not None else None
+
+def _minutes(value):
+    return value.seconds / 60 if value is not None else None
+
 # Registry of entry types - used as class decorator
 _entry_types = {}
 def entry_type(cls):
@@ -221,6 +677,9 @@ def entry_type(cls):
 def lookup_entry_type(name, default=None):
     return _entry_types.get(name, default)
 
+def entry_type_names():
+    return sorted(_entry_types)
+
 class Entry(Base):
     implements(IJSONCapable)
     __tablename__ = 'entries'
@@ -235,7 +694,15 @@ class Entry(Base):
     baby_id = Column(Integer, ForeignKey('babies.id'))
     baby = relationship("Baby", backref=backref('entries', order_by=start.desc))
 
-    __mapper_args__ = {'polymorphic_on': type}
+    # Load the columns of all entry types up front, rather than one query
+    # per entry when a subclass attribute is first accessed
+    __mapper_args__ = {'polymorphic_on': type, 'with_polymorphic': '*'}
+
+    # Support ``Baby.get_entries_between()``, with and without a type
+    __table_args__ = (
+        Index('ix_entries_baby_id_start', 'baby_id', 'start'),
+        Index('ix_entries_baby_id_type_start', 'baby_id', 'type', 'start'),
+    )
 
     def __init__(self, baby, start, end=None, note=None):
         self.baby = baby
@@ -258,13 +725,20 @@ class Entry(Base):
 
     # JSON representation
 
+    # Attributes included in the JSON representation, with a function to
+    # convert each value or ``None``. Entry types extend this.
+    json_fields = (
+        ('start', _isoformat,),
+        ('end', _isoformat,),
+        ('note', None,),
+    )
+
     def to_json_dict(self):
-        return {
-            'entry_type': self.type,
-            'start': self.start.isoformat() if self.start is not None else None,
-            'end': self.end.isoformat() if self.end is not None else None,
-            'note': self.note,
-        }
+        entry = {'entry_type': self.type}
+        for name, convert in self.json_fields:
+            value = getattr(self, name)
+            entry[name] = convert(value) if convert is not None else value
+        return entry
 
 @entry_type
 class BreastFeed(Entry):
@@ -280,13 +754,10 @@ class BreastFeed(Entry):
 
     # JSON representation
 
-    def to_json_dict(self):
-        entry = super(BreastFeed, self).to_json_dict()
-        entry.update({
-            'left_duration': self.left_duration.seconds / 60,
-            'right_duration': self.right_duration.seconds / 60,
-        })
-        return entry
+    json_fields = Entry.json_fields + (
+        ('left_duration', _minutes,),
+        ('right_duration', _minutes,),
+    )
 
 @entry_type
 class BottleFeed(Entry):
@@ -300,12 +771,9 @@ class BottleFeed(Entry):
 
     # JSON representation
 
-    def to_json_dict(self):
-        entry = super(BottleFeed, self).to_json_dict()
-        entry.update({
-            'amount': self.amount,
-        })
-        return entry
+    json_fields = Entry.json_fields + (
+        ('amount', None,),
+    )
 
 @entry_type
 class MixedFeed(BreastFeed):
@@ -324,12 +792,9 @@ class MixedFeed(BreastFeed):
 
     # JSON representation
 
-    def to_json_dict(self):
-        entry = super(MixedFeed, self).to_json_dict()
-        entry.update({
-            'topup': self.topup,
-        })
-        return entry
+    json_fields = BreastFeed.json_fields + (
+        ('topup', None,),
+    )
 
 @entry_type
 class Sleep(Entry):
@@ -343,12 +808,9 @@ class Sleep(Entry):
 
     # JSON representation
 
-    def to_json_dict(self):
-        entry = super(Sleep, self).to_json_dict()
-        entry.update({
-            'duration': self.duration.seconds / 60,
-        })
-        return entry
+    json_fields = Entry.json_fields + (
+        ('duration', _minutes,),
+    )
 
 @entry_type
 class NappyChange(Entry):
@@ -362,12 +824,288 @@ class NappyChange(Entry):
 
     # JSON representation
 
-    def to_json_dict(self):
-        entry = super(NappyChange, self).to_json_dict()
-        entry.update({
-            'contents': self.contents,
-        })
-        return entry
+    json_fields = Entry.json_fields + (
+        ('contents', None,),
+    )
+
+# Lightweight, read-only entries for listings. Records have an attribute for
+# each column of the ``entries`` table, so they can be serialised using the
+# ``json_fields`` of the entry type named by ``type``.
+EntryRecord = namedtuple('EntryRecord', [
+    column.name for column in Entry.__table__.columns if column.name != 'baby_id'
+])
+
+def _filter_entries(query, start, end, entry_type):
+    """Restrict a select from the ``entries`` table to entries starting
+    between ``start`` and ``end``, inclusive, of ``entry_type`` or its
+    subclasses. Any of these may be ``None``. Entries without a start are
+    always left out, since listings are ordered and paged by it.
+    """
+    entries = Entry.__table__.c
+
+    if entry_type is not None:
+        query = query.where(entries.type.in_([
+            mapper.polymorphic_identity for mapper in entry_type.__mapper__.polymorphic_iterator()
+        ]))
+
+    if start is not None:
+        query = query.where(entries.start>=start)
+    else:
+        query = query.where(entries.start!=None)
+    if end is not None:
+        query = query.where(entries.start<=end)
+
+    return query
+
+# Daily summaries. These are kept up to date as entries are flushed, by
+# recalculating the totals for each day that has changed.
+
+SUMMARY_FIELDS = (
+    'feeds', 'left_duration', 'right_duration', 'bottle_amount', 'topup_amount',
+    'sleeps', 'sleep_duration', 'nappy_changes', 'wet_nappies', 'dirty_nappies',
+)
+DURATION_FIELDS = ('left_duration', 'right_duration', 'sleep_duration',)
+
+daily_summaries = Table('daily_summaries', Base.metadata,
+    Column('baby_id', Integer, ForeignKey('babies.id'), primary_key=True),
+    Column('day', Date, primary_key=True),
+    *[Column(name, Integer, nullable=False, default=0) for name in SUMMARY_FIELDS]
+)
+
+def summary_columns():
+    """Aggregates over the entries table for each of ``SUMMARY_FIELDS``.
+    Durations are in seconds.
+    """
+    entries = Entry.__table__.c
+
+    feed_types = ('breast_feed', 'bottle_feed', 'mixed_feed',)
+    breast_types = ('breast_feed', 'mixed_feed',)
+
+    def total(condition, value):
+        return func.sum(case([(condition, value)]))
+
+    def count(condition):
+        return func.count(case([(condition, 1)]))
+
+    return [
+        count(entries.type.in_(feed_types)),
+        total(entries.type.in_(breast_types), interval_seconds(entries.left_duration)),
+        total(entries.type.in_(breast_types), interval_seconds(entries.right_duration)),
+        total(entries.type=='bottle_feed', entries.amount),
+        total(entries.type=='mixed_feed', entries.topup),
+        count(entries.type=='sleep'),
+        total(entries.type=='sleep', interval_seconds(entries.duration)),
+        count(entries.type=='nappy_change'),
+        count(and_(entries.type=='nappy_change', entries.contents=='wet')),
+        count(and_(entries.type=='nappy_change', entries.contents=='dirty')),
+    ]
+
+def summary_json(start, values):
+    """Turn values for ``SUMMARY_FIELDS`` into a dict, with durations in
+    minutes
+    """
+    data = {'start': start}
+    for name, value in zip(SUMMARY_FIELDS, values):
+        value = int(value or 0)
+        if name in DURATION_FIELDS:
+            value = value // 60
+        data[name] = value
+    return data
+
+def refresh_daily_summaries(connection, baby_id, start=None, end=None):
+    """Recalculate the daily summaries of a baby's entries from the
+    ``start`` date to the ``end`` date, inclusive. Either may be ``None``
+    to leave the range open.
+    """
+    entries = Entry.__table__.c
+    summaries = daily_summaries.c
+
+    bucket = time_period(entries.start, 'day')
+    query = select([bucket] + summary_columns()).where(and_(
+        entries.baby_id==baby_id,
+        entries.start!=None,
+    ))
+    delete = daily_summaries.delete().where(summaries.baby_id==baby_id)
+
+    if start is not None:
+        query = query.where(entries.start>=datetime.combine(start, time()))
+        delete = delete.where(summaries.day>=start)
+    if end is not None:
+        query = query.where(entries.start<datetime.combine(end + timedelta(days=1), time()))
+        delete = delete.where(summaries.day<=end)
+
+    rows = []
+    for row in connection.execute(query.group_by(bucket)):
+        values = dict(zip(SUMMARY_FIELDS, [int(value or 0) for value in row[1:]]))
+        values['baby_id'] = baby_id
+        values['day'] = datetime.strptime(row[0], '%Y-%m-%d').date()
+        rows.append(values)
+
+    connection.execute(delete)
+    if rows:
+        connection.execute(daily_summaries.insert(), rows)
+
+def _summary_days_before_flush(session, flush_context, instances):
+    days = session.__dict__.setdefault('_summary_days', set())
+    changed = session.__dict__.setdefault('_summary_entries', set())
+
+    for obj in session.deleted:
+        if isinstance(obj, Entry):
+            if obj.start is not None:
+                days.add((obj.baby_id, obj.start.date(),))
+        elif isinstance(obj, Baby):
+            session.execute(daily_summaries.delete().where(daily_summaries.c.baby_id==obj.id))
+
+    for obj in session.dirty:
+        if isinstance(obj, Entry) and session.is_modified(obj):
+            # The day the entry used to be in
+            old_start = get_history(obj, 'start')
+            for start in (old_start.deleted or old_start.unchanged or ()):
+                if start is not None:
+                    days.add((obj.baby_id, start.date(),))
+            changed.add(obj)
+
+    for obj in session.new:
+        if isinstance(obj, Entry):
+            changed.add(obj)
+
+def _summary_days_after_flush(session, flush_context):
+    days = session.__dict__.pop('_summary_days', set())
+    changed = session.__dict__.pop('_summary_entries', set())
+
+    for obj in changed:
+        if obj.start is not None and obj.baby_id is not None:
+            days.add((obj.baby_id, obj.start.date(),))
+
+    connection = session.connection()
+    for baby_id, day in sorted(days):
+        if baby_id is not None:
+            refresh_daily_summaries(connection, baby_id, day, day)
+
+event.listen(DBSession.session_factory, 'before_flush', _summary_days_before_flush)
+event.listen(DBSession.session_factory, 'after_flush', _summary_days_after_flush)
+
+# Changes. Each baby or entry added, changed or deleted is recorded with a
+# sequence number, so that clients can sync by asking for changes after the
+# last one they saw. Only the latest change to each object is kept, so the
+# table grows with the number of objects rather than the number of edits,
+# and deleted objects leave a tombstone. Deleting a baby replaces all its
+# changes with the baby's tombstone.
+#
+# Changes are recorded after the baby's version is bumped, which locks the
+# baby's row until the transaction commits, so the sequence numbers of a
+# baby's changes become visible in order. Changes to babies also lock the
+# user's row first, so that the user's feed of babies, which spans several
+# babies, becomes visible in order too.
+
+changes = Table('changes', Base.metadata,
+    Column('seq', Integer, primary_key=True),
+    Column('kind', String, nullable=False),      # 'baby' or 'entry'
+    Column('object_id', Integer, nullable=False),
+    Column('baby_id', Integer, nullable=False),
+    Column('user_id', Integer, nullable=True),   # set for babies
+    Column('deleted', Boolean, nullable=False, default=False),
+    Index('ix_changes_baby_id_seq', 'baby_id', 'seq'),
+    Index('ix_changes_user_id_kind_seq', 'user_id', 'kind', 'seq'),
+    Index('ix_changes_kind_object_id', 'kind', 'object_id'),
+    # Never reuse the sequence number of a replaced change
+    sqlite_autoincrement=True,
+)
+
+ChangeRecord = namedtuple('ChangeRecord', ['seq', 'kind', 'object_id', 'deleted'])
+
+def _list_changes(criteria, since, limit=None):
+    c = changes.c
+    query = select([c.seq, c.kind, c.object_id, c.deleted]).where(and_(criteria, c.seq>since)).order_by(c.seq)
+    if limit is not None:
+        query = query.limit(limit)
+    return [ChangeRecord._make(row) for row in DBSession().execute(query)]
+
+def _last_change(criteria):
+    return DBSession().execute(select([func.max(changes.c.seq)]).where(criteria)).scalar() or 0
+
+def _lock_users(user_ids):
+    """A query locking the rows of ``user_ids`` until the transaction
+    commits. SQLite has no row locks, but only ever has one writer.
+    """
+    users = User.__table__
+    return select([users.c.id], for_update=True).where(users.c.id.in_(user_ids)).order_by(users.c.id)
+
+def _changes_before_flush(session, flush_context, instances):
+    pending = session.__dict__.setdefault('_changes', [])
+
+    for obj in session.deleted:
+        if isinstance(obj, Baby):
+            pending.append(('baby', obj.id, obj.id, obj.user_id, True,))
+        elif isinstance(obj, Entry):
+            pending.append(('entry', obj.id, obj.baby_id, None, True,))
+
+    # Ids of new objects are only known after the flush
+    for obj in session.new:
+        if isinstance(obj, (Baby, Entry,)):
+            pending.append(obj)
+
+    for obj in session.dirty:
+        if isinstance(obj, (Baby, Entry,)) and session.is_modified(obj, include_collections=False):
+            pending.append(obj)
+
+def _changes_after_flush(session, flush_context):
+    pending = session.__dict__.pop('_changes', [])
+    if not pending:
+        return
+
+    latest = {}
+    for change in pending:
+        if isinstance(change, Baby):
+            change = ('baby', change.id, change.id, change.user_id, False,)
+        elif isinstance(change, Entry):
+            change = ('entry', change.id, change.baby_id, None, False,)
+        if change[2] is not None:
+            latest[change[:2]] = change
+
+    user_ids = set(user_id for (kind, object_id, baby_id, user_id, deleted) in latest.values()
+                    if user_id is not None)
+    if user_ids:
+        session.execute(_lock_users(sorted(user_ids)))
+
+    c = changes.c
+    for kind in ('baby', 'entry',):
+        object_ids = [object_id for (k, object_id) in latest if k == kind]
+        if object_ids:
+            session.execute(changes.delete().where(and_(c.kind==kind, c.object_id.in_(object_ids))))
+
+    deleted_babies = [baby_id for (kind, object_id, baby_id, user_id, deleted) in latest.values()
+                        if kind == 'baby' and deleted]
+    if deleted_babies:
+        session.execute(changes.delete().where(c.baby_id.in_(deleted_babies)))
+
+    session.execute(changes.insert(), [
+        dict(kind=kind, object_id=object_id, baby_id=baby_id, user_id=user_id, deleted=deleted)
+        for (kind, object_id, baby_id, user_id, deleted) in sorted(latest.values())
+    ])
+
+event.listen(DBSession.session_factory, 'before_flush', _changes_before_flush)
+event.listen(DBSession.session_factory, 'after_flush', _changes_after_flush)
+
+def _bump_baby_versions(session, flush_context, instances):
+    babies = set()
+
+    for obj in session.dirty:
+        if isinstance(obj, (Baby, Entry,)) and session.is_modified(obj, include_collections=False):
+            babies.add(obj if isinstance(obj, Baby) else obj.baby)
+
+    for obj in list(session.new) + list(session.deleted):
+        if isinstance(obj, Entry):
+            babies.add(obj.baby)
+
+    for baby in babies:
+        if baby is None or baby in session.new or baby in session.deleted:
+            continue
+        # Incremented in the database, so concurrent changes don't share a version
+        baby.version = func.coalesce(Baby.__table__.c.version, 0) + 1
+        baby.modified = datetime.utcnow()
+
+event.listen(DBSession.session_factory, 'before_flush', _bump_baby_versions)
 
 # TODO: Other types of entries:
 # - solid foods
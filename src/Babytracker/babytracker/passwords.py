@@ -0,0 +1,85 @@
+import os
+import hmac
+import base64
+import hashlib
+import threading
+import multiprocessing
+
+ALGORITHM = 'pbkdf2_sha256'
+DEFAULT_ITERATIONS = 100000
+SALT_BYTES = 16
+
+# Work factor for new hashes. Set by ``configure_password_hashing()``.
+iterations = DEFAULT_ITERATIONS
+
+# Limits how many threads may hash passwords at once, so that a burst of
+# logins can't take every CPU away from other requests. Set by
+# ``configure_password_hashing()``.
+hashing_slots = threading.BoundedSemaphore(multiprocessing.cpu_count())
+
+def configure_password_hashing(settings):
+    """Set the work factor from the ``password-iterations`` setting, and
+    the number of passwords that may be hashed concurrently from
+    ``password-hashing-threads``, which defaults to the number of CPUs.
+    """
+    global iterations, hashing_slots
+    iterations = int(settings.get('password-iterations', DEFAULT_ITERATIONS))
+    hashing_slots = threading.BoundedSemaphore(
+        int(settings.get('password-hashing-threads', multiprocessing.cpu_count()))
+    )
+
+def _pbkdf2(password, salt, rounds):
+    if isinstance(password, unicode):
+        password = password.encode('utf-8')
+    with hashing_slots:
+        return hashlib.pbkdf2_hmac('sha256', password, salt, rounds)
+
+def hash_password(password):
+    """Return a salted hash of the plain text ``password``, in the form
+    ``pbkdf2_sha256$<iterations>$<salt>$<hash>``.
+    """
+    salt = os.urandom(SALT_BYTES)
+    digest = _pbkdf2(password, salt, iterations)
+    return '%s$%d$%s$%s' % (ALGORITHM, iterations,
+        base64.b64encode(salt), base64.b64encode(digest),)
+
+def is_legacy_hash(hashed):
+    """Hashes from before salting are a plain hex SHA-1 digest
+    """
+    return hashed is not None and '$' not in hashed
+
+def verify_password(password, hashed):
+    """Check a plain text password against a hash made by
+    ``hash_password()``, or a legacy SHA-1 hash.
+    """
+    if not hashed:
+        return False
+
+    if is_legacy_hash(hashed):
+        if isinstance(password, unicode):
+            password = password.encode('utf-8')
+        return hmac.compare_digest(str(hashlib.sha1(password).hexdigest()), str(hashed))
+
+    try:
+        algorithm, rounds, salt, digest = str(hashed).split('$')
+        rounds = int(rounds)
+        salt = base64.b64decode(salt)
+        digest = base64.b64decode(digest)
+    except (TypeError, ValueError,):
+        return False
+
+    if algorithm != ALGORITHM:
+        return False
+
+    return hmac.compare_digest(_pbkdf2(password, salt, rounds), digest)
+
+def needs_rehash(hashed):
+    """Whether a hash is legacy or uses a different work factor to the one
+    configured, and so should be replaced next time the password is known.
+    """
+    if is_legacy_hash(hashed):
+        return True
+    try:
+        return int(hashed.split('$')[1]) != iterations
+    except (IndexError, ValueError,):
+        return True
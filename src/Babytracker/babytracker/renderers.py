@@ -0,0 +1,23 @@
+try:
+    # simplejson's C speedups are faster than the standard library's
+    import simplejson as json
+except ImportError:
+    import json
+
+def dumps(value):
+    """Encode ``value`` as compact JSON
+    """
+    return json.dumps(value, separators=(',', ':'))
+
+def json_renderer_factory(info):
+    """Replacement for Pyramid's ``json`` renderer, using ``dumps()``
+    """
+
+    def _render(value, system):
+        request = system.get('request')
+        if request is not None:
+            response = request.response
+            if response.content_type == response.default_content_type:
+                response.content_type = 'application/json'
+        return dumps(value)
+    return _render
@@ -0,0 +1,30 @@
+import os
+import sys
+
+from pkg_resources import resource_filename
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+    )
+
+from ..assets import build_assets
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: %s <config_uri>\n'
+          '(example: "%s production.ini")' % (cmd, cmd))
+    sys.exit(1)
+
+def main(argv=sys.argv):
+    if len(argv) != 2:
+        usage(argv)
+    config_uri = argv[1]
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri)
+    output_dir = settings.get('static-build-dir')
+    if not output_dir:
+        print('static-build-dir is not set in %s' % config_uri)
+        sys.exit(1)
+    manifest = build_assets(resource_filename('babytracker', 'static'), output_dir)
+    print('Built %d assets into %s' % (len(manifest), output_dir,))
@@ -0,0 +1,72 @@
+import os
+import sys
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+    )
+
+from .. import setup_database
+from ..models import DBSession, User, Baby, check_schema
+from ..importer import import_entries
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: %s <config_uri> <email> <baby> <file> [offset]\n'
+          '(example: "%s development.ini jill@example.org jack jack.csv")\n'
+          '<baby> is the name of the baby as it appears in URLs. <file> is CSV\n'
+          'as exported, or newline-delimited JSON if it ends in .ndjson or\n'
+          '.jsonl. offset is a number of rows to skip, to resume an import.' % (cmd, cmd))
+    sys.exit(1)
+
+def file_format(path):
+    if os.path.splitext(path)[1].lower() in ('.ndjson', '.jsonl',):
+        return 'ndjson'
+    return 'csv'
+
+def find_baby(email, slug):
+    """Return the id of the user's baby with the given slug, or ``None``
+    """
+    session = DBSession()
+    user = session.query(User).filter_by(email=email).first()
+    if user is None:
+        return None
+    baby = user.find_baby(Baby.normalize_name(slug))
+    return baby.id if baby is not None else None
+
+def report(result):
+    print("Row %d: %d entries imported, %d invalid rows" % (result.offset, result.imported, result.error_count))
+
+def main(argv=sys.argv):
+    if len(argv) not in (5, 6,):
+        usage(argv)
+    config_uri, email, slug, path = argv[1:5]
+    try:
+        offset = int(argv[5]) if len(argv) > 5 else 0
+    except ValueError:
+        usage(argv)
+
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri)
+    engine = setup_database(settings)
+    check_schema(engine)
+
+    baby_id = find_baby(email.decode('utf-8'), slug.decode('utf-8'))
+    if baby_id is None:
+        print("%s has no baby %s" % (email, slug,))
+        sys.exit(1)
+
+    with open(path, 'rb') as f:
+        result = import_entries(baby_id, f, file_format(path), offset, progress=report)
+
+    for row, message in result.errors:
+        print("Row %d: %s" % (row, message,))
+    if result.error_count > len(result.errors):
+        print("... and %d more invalid rows" % (result.error_count - len(result.errors)))
+
+    if result.failed is not None:
+        print(result.failed)
+        print("To carry on, run again with offset %d" % result.offset)
+        sys.exit(1)
+
+    print("Done: %d entries imported, %d invalid rows" % (result.imported, result.error_count))
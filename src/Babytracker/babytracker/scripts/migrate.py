@@ -0,0 +1,34 @@
+import os
+import sys
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+    )
+
+from .. import setup_database
+from ..models import (
+    SCHEMA_VERSION,
+    get_schema_version,
+    upgrade_schema,
+    )
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: %s <config_uri>\n'
+          '(example: "%s production.ini")' % (cmd, cmd))
+    sys.exit(1)
+
+def main(argv=sys.argv):
+    if len(argv) != 2:
+        usage(argv)
+    config_uri = argv[1]
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri)
+    engine = setup_database(settings)
+    version = get_schema_version(engine)
+    if version >= SCHEMA_VERSION:
+        print('Schema is up to date (version %d)' % version)
+        return
+    print('Upgrading schema from version %d to %d' % (version, SCHEMA_VERSION,))
+    upgrade_schema(engine)
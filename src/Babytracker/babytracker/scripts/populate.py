@@ -1,17 +1,13 @@
 import os
 import sys
 
-from sqlalchemy import engine_from_config
-
 from pyramid.paster import (
     get_appsettings,
     setup_logging,
     )
 
-from ..models import (
-    DBSession,
-    Base,
-    )
+from .. import setup_database
+from ..models import upgrade_schema
 
 def usage(argv):
     cmd = os.path.basename(argv[0])
@@ -25,9 +21,8 @@ def main(argv=sys.argv):
     config_uri = argv[1]
     setup_logging(config_uri)
     settings = get_appsettings(config_uri)
-    engine = engine_from_config(settings, 'sqlalchemy.')
-    DBSession.configure(bind=engine)
-    Base.metadata.create_all(engine)
+    engine = setup_database(settings)
+    upgrade_schema(engine)
 
 
     # with transaction.manager:
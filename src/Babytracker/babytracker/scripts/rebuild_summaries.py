@@ -0,0 +1,45 @@
+import os
+import sys
+
+import transaction
+
+from zope.sqlalchemy import mark_changed
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+    )
+
+from .. import setup_database
+from ..models import (
+    DBSession,
+    Baby,
+    check_schema,
+    refresh_daily_summaries,
+    )
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: %s <config_uri>\n'
+          '(example: "%s development.ini")' % (cmd, cmd))
+    sys.exit(1)
+
+def rebuild_summaries():
+    """Recalculate the daily summaries of every baby
+    """
+    with transaction.manager:
+        session = DBSession()
+        connection = session.connection()
+        for (baby_id,) in session.query(Baby.id):
+            refresh_daily_summaries(connection, baby_id)
+        mark_changed(session)
+
+def main(argv=sys.argv):
+    if len(argv) != 2:
+        usage(argv)
+    config_uri = argv[1]
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri)
+    engine = setup_database(settings)
+    check_schema(engine)
+    rebuild_summaries()
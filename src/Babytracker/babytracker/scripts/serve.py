@@ -0,0 +1,112 @@
+import os
+import sys
+import multiprocessing
+
+from ConfigParser import ConfigParser
+
+from pyramid.paster import (
+    get_app,
+    setup_logging,
+    )
+
+from ..models import DBSession
+from ..database import pool_metrics
+
+# Gunicorn settings used unless the [server:main] section sets them. The app
+# is loaded once in the master process and shared with the workers it forks.
+DEFAULTS = {
+    'worker_class': 'sync',
+    'preload_app': 'true',
+    'timeout': '30',
+}
+
+# Keys of the [server:main] section which are not gunicorn settings
+_PASTE_KEYS = ('use', 'here', '__file__', 'host', 'port',)
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: %s <config_uri>\n'
+          '(example: "%s production.ini")' % (cmd, cmd))
+    sys.exit(1)
+
+def default_workers():
+    """Two workers per CPU, plus one, so that a CPU is kept busy while a
+    worker waits for the database
+    """
+    return multiprocessing.cpu_count() * 2 + 1
+
+def server_options(config_uri, environ=os.environ):
+    """Gunicorn settings from the ``[server:main]`` section of
+    ``config_uri``, over ``DEFAULTS``. ``host`` and ``port`` are combined
+    into ``bind``, and the ``PORT`` environment variable (set on Heroku)
+    takes precedence over ``port``.
+    """
+    path, section = config_uri, 'main'
+    if '#' in config_uri:
+        path, section = config_uri.split('#', 1)
+    path = os.path.abspath(path)
+    section = 'server:' + section
+
+    parser = ConfigParser({'here': os.path.dirname(path), '__file__': path})
+    parser.read(path)
+
+    options = dict(DEFAULTS)
+    options['workers'] = str(default_workers())
+
+    host, port = '0.0.0.0', '6543'
+    if parser.has_section(section):
+        for key, value in parser.items(section):
+            if key not in _PASTE_KEYS:
+                options[key] = value
+        if parser.has_option(section, 'host'):
+            host = parser.get(section, 'host')
+        if parser.has_option(section, 'port'):
+            port = parser.get(section, 'port')
+
+    options['bind'] = '%s:%s' % (host, environ.get('PORT', port),)
+    return options
+
+def post_fork(server, worker):
+    """Give each worker a fresh connection pool and metrics, rather than
+    the master's.
+    """
+    engine = DBSession.bind
+    if engine is not None:
+        engine.dispose()
+    pool_metrics.reset()
+
+def gunicorn_config(options):
+    """A gunicorn ``Config`` with the given settings, which raises
+    ``AttributeError`` for any that gunicorn does not have.
+    """
+    from gunicorn.config import Config
+
+    cfg = Config()
+    for key, value in options.items():
+        cfg.set(key, value)
+    cfg.set('post_fork', post_fork)
+    return cfg
+
+def main(argv=sys.argv):
+    if len(argv) != 2:
+        usage(argv)
+    config_uri = argv[1]
+    setup_logging(config_uri)
+    options = server_options(config_uri)
+
+    from gunicorn.app.base import Application
+
+    class BabytrackerApplication(Application):
+
+        def load_config(self):
+            # Configured from the ini file rather than the command line
+            self.cfg = gunicorn_config(options)
+
+        def load(self):
+            app = get_app(config_uri)
+            # The schema check on startup leaves a connection in the pool.
+            # Close it, so that forked workers don't share its socket.
+            DBSession.bind.dispose()
+            return app
+
+    BabytrackerApplication().run()
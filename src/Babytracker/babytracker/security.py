@@ -1,11 +1,267 @@
+import os
+import time
+import json
+import hmac
+import heapq
+import base64
+import hashlib
+
+from zope.interface import implements
+
+from repoze.lru import LRUCache
+
+from sqlalchemy import event
+from sqlalchemy.orm import joinedload
+
+from pyramid.decorator import reify
+from pyramid.interfaces import IAuthenticationPolicy
+from pyramid.request import Request as BaseRequest
+from pyramid.security import unauthenticated_userid, Everyone, Authenticated
+
+from babytracker.interfaces import BEARER_TOKEN, baby_principal
 from babytracker.models import DBSession, User
 
+class PrincipalCache(object):
+    """Bounded, process-wide cache of the principals returned by
+    ``validate_user()``, keyed by user id. Entries expire after ``timeout``
+    seconds, so changes made in other processes are picked up eventually.
+    A ``timeout`` of 0 disables the cache.
+    """
+
+    def __init__(self, size=1000, timeout=0):
+        self.timeout = timeout
+        self._cache = LRUCache(size)
+
+    def get(self, userid):
+        if not self.timeout:
+            return None
+
+        cached = self._cache.get(userid)
+        if cached is None:
+            return None
+
+        expires, principals = cached
+        if expires < time.time():
+            return None
+
+        return principals
+
+    def put(self, userid, principals):
+        if self.timeout:
+            self._cache.put(userid, (time.time() + self.timeout, principals,))
+
+    def invalidate(self, userid):
+        self._cache.put(userid, None)
+
+    def clear(self):
+        self._cache.clear()
+
+principal_cache = PrincipalCache()
+
+def configure_principal_cache(settings):
+    """Set up the principal cache from the ``user-cache-size`` and
+    ``user-cache-timeout`` (in seconds) settings.
+    """
+    global principal_cache
+    principal_cache = PrincipalCache(
+        size=int(settings.get('user-cache-size', 1000)),
+        timeout=int(settings.get('user-cache-timeout', 0)),
+    )
+
+@event.listens_for(User.password, 'set')
+def _invalidate_on_password_change(target, value, oldvalue, initiator):
+    principal_cache.invalidate(target.email)
+
+@event.listens_for(User, 'after_delete')
+def _invalidate_on_delete(mapper, connection, target):
+    principal_cache.invalidate(target.email)
+
+class Request(BaseRequest):
+    """Request factory which makes the authenticated user available as
+    ``request.user``. The user is looked up at most once per request, and
+    shared by the authentication callback, traversal and views.
+    """
+
+    @reify
+    def user(self):
+        userid = unauthenticated_userid(self)
+        if userid is None:
+            return None
+
+        session = DBSession()
+        # Traversal and most views go on to use the user's babies
+        return session.query(User).options(joinedload('babies')).filter_by(email=userid).first()
+
 def validate_user(userid, request):
     """Ensure the given user exists
     """
 
-    session = DBSession()
-    user = session.query(User).filter_by(email=userid).first()
-    if user is not None:
-        return (user.__name__,)
+    principals = principal_cache.get(userid)
+    if principals is not None:
+        return principals
+
+    user = request.user
+    if user is not None and user.email == userid:
+        principals = (user.__name__,)
+        principal_cache.put(userid, principals)
+        return principals
     return None
+
+class TokenDenyList(object):
+    """Ids of revoked bearer tokens. Tokens are only kept until they would
+    have expired anyway, so the list stays small. The list is per process:
+    a token revoked in one worker is still accepted by the others until it
+    expires, so keep ``token-timeout`` short.
+    """
+
+    def __init__(self):
+        self._expires = {}
+        self._heap = []
+
+    def revoke(self, token_id, expires):
+        self._evict()
+        if expires > time.time() and token_id not in self._expires:
+            self._expires[token_id] = expires
+            heapq.heappush(self._heap, (expires, token_id,))
+
+    def is_revoked(self, token_id):
+        self._evict()
+        return token_id in self._expires
+
+    def clear(self):
+        self._expires.clear()
+        del self._heap[:]
+
+    def __len__(self):
+        return len(self._expires)
+
+    def _evict(self):
+        now = time.time()
+        while self._heap and self._heap[0][0] <= now:
+            expires, token_id = heapq.heappop(self._heap)
+            del self._expires[token_id]
+
+deny_list = TokenDenyList()
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip('=')
+
+def _b64decode(data):
+    return base64.urlsafe_b64decode(str(data) + '=' * (-len(data) % 4))
+
+class BearerTokenAuthenticationPolicy(object):
+    """Authenticates API requests carrying an ``Authorization: Bearer``
+    header with a token issued by ``issue()``, and delegates everything
+    else to the ``wrapped`` policy.
+
+    Tokens are signed claims of the user's email, the ids of the babies
+    they can be used for and an expiry time, so checking one needs no
+    database queries. Revoked tokens are held in ``deny_list``.
+    """
+    implements(IAuthenticationPolicy)
+
+    def __init__(self, wrapped, secret, timeout=86400, route_name='api'):
+        self.wrapped = wrapped
+        self.secret = secret
+        self.timeout = timeout
+        self.route_name = route_name
+
+    # Tokens
+
+    def _sign(self, payload):
+        return _b64encode(hmac.new(self.secret, payload, hashlib.sha256).digest())
+
+    def issue(self, userid, baby_ids):
+        """Return a new token for ``userid`` which is valid for ``timeout``
+        seconds for the babies with ids ``baby_ids``.
+        """
+        payload = _b64encode(json.dumps({
+            'sub': userid,
+            'babies': list(baby_ids),
+            'exp': int(time.time() + self.timeout),
+            'jti': _b64encode(os.urandom(12)),
+        }, separators=(',', ':')))
+        return '%s.%s' % (payload, self._sign(payload),)
+
+    def verify(self, token):
+        """Return the claims of a token, or ``None`` if it is not valid,
+        has expired or has been revoked.
+        """
+        try:
+            payload, signature = str(token).split('.')
+        except (UnicodeEncodeError, ValueError,):
+            return None
+
+        if not hmac.compare_digest(self._sign(payload), signature):
+            return None
+
+        try:
+            claims = json.loads(_b64decode(payload))
+        except (TypeError, ValueError,):
+            return None
+
+        if claims['exp'] < time.time() or deny_list.is_revoked(claims['jti']):
+            return None
+
+        return claims
+
+    def claims(self, request):
+        """The claims of the request's bearer token, if it has a valid one
+        """
+        if 'babytracker.token_claims' not in request.environ:
+            claims = None
+
+            route = getattr(request, 'matched_route', None)
+            authorization = request.headers.get('Authorization', '')
+            if route is not None and route.name == self.route_name and authorization.startswith('Bearer '):
+                claims = self.verify(authorization[len('Bearer '):].strip())
+
+            request.environ['babytracker.token_claims'] = claims
+
+        return request.environ['babytracker.token_claims']
+
+    # IAuthenticationPolicy
+
+    def authenticated_userid(self, request):
+        claims = self.claims(request)
+        if claims is not None:
+            return claims['sub']
+        return self.wrapped.authenticated_userid(request)
+
+    def unauthenticated_userid(self, request):
+        claims = self.claims(request)
+        if claims is not None:
+            return claims['sub']
+        return self.wrapped.unauthenticated_userid(request)
+
+    def effective_principals(self, request):
+        claims = self.claims(request)
+        if claims is not None:
+            return [Everyone, Authenticated, claims['sub'], BEARER_TOKEN] + \
+                [baby_principal(claims['sub'], baby_id) for baby_id in claims['babies']]
+        return self.wrapped.effective_principals(request)
+
+    def remember(self, request, principal, **kw):
+        return self.wrapped.remember(request, principal, **kw)
+
+    def forget(self, request):
+        return self.wrapped.forget(request)
+
+def issue_token(request, user):
+    """Issue a bearer token for ``user`` and their current babies, or
+    return ``None`` if bearer tokens are not enabled.
+    """
+    policy = request.registry.queryUtility(IAuthenticationPolicy)
+    if not isinstance(policy, BearerTokenAuthenticationPolicy):
+        return None
+    return policy.issue(user.__name__, [baby.id for baby in user.babies])
+
+def revoke_token(request):
+    """Revoke the bearer token the request was authenticated with, if any
+    """
+    policy = request.registry.queryUtility(IAuthenticationPolicy)
+    if not isinstance(policy, BearerTokenAuthenticationPolicy):
+        return
+    claims = policy.claims(request)
+    if claims is not None:
+        deny_list.revoke(claims['jti'], claims['exp'])
@@ -252,6 +252,119 @@ BabyTracker.User.prototype = {
                 BabyTracker.handleError(jqXHR, textStatus, errorThrown, errorCallback);
             }
         });
+    },
+
+    /**
+     * Get the entries of several babies in the date/time range start to
+     * end in one request, optionally filtering by entry type. start, end
+     * and entry_type may be null. babies is a list of Baby objects, or
+     * null for all of the user's babies.
+     * Callback is called with the User object and a list of objects with a
+     * 'baby' (a Baby object) and 'entries' (a list of Entry objects), one
+     * per baby.
+     * Error callback is called in case of a failure with the HTTP
+     * response code and the error information returned by the server.
+     */
+    getEntries: function(start, end, entry_type, babies, callback, errorCallback, async) {
+        var self = this;
+        if(async == undefined) async = true;
+
+        var data = {};
+        if(start) data['start'] = start.toISOString();
+        if(end) data['end'] = end.toISOString();
+        if(entry_type) data['entry_type'] = entry_type;
+        if(babies) {
+            data['baby'] = [];
+            for(var i = 0; i < babies.length; ++i) {
+                data['baby'].push(babies[i].url.substring(babies[i].url.lastIndexOf('/') + 1));
+            }
+        }
+
+        jQuery.ajax({
+            type: 'GET',
+            url: self.url + '/@@entries',
+            dataType: 'json',
+            data: data,
+            traditional: true,
+            xhrFields: {
+                withCredentials: true
+            },
+            crossDomain: true,
+            async: async,
+            success: function(data, textStatus, jqXHR) {
+                var arr = [];
+                for(var i = 0; i < data.length; ++i) {
+                    var baby = null;
+                    for(var j = 0; j < self.babies.length; ++j) {
+                        if(self.babies[j].url == data[i]['url']) {
+                            baby = self.babies[j];
+                            break;
+                        }
+                    }
+                    if(baby == null) {
+                        baby = new BabyTracker.Baby(data[i]);
+                    }
+
+                    var entries = [];
+                    for(var j = 0; j < data[i]['entries'].length; ++j) {
+                        entries.push(BabyTracker._createEntry(data[i]['entries'][j]));
+                    }
+                    arr.push({baby: baby, entries: entries});
+                }
+
+                if(callback != undefined) {
+                    callback(self, arr);
+                }
+            },
+            error: function(jqXHR, textStatus, errorThrown) {
+                BabyTracker.handleError(jqXHR, textStatus, errorThrown, errorCallback);
+            }
+        });
+    },
+
+    /**
+     * Get the babies added, changed or deleted since the sequence number
+     * since, at most limit of them. since and limit may be null; without
+     * since, only the current sequence number is returned.
+     * Callback is called with the User object and an object with the
+     * latest sequence number 'seq', whether there are 'more' changes, and
+     * a list of 'changes', each with a 'baby' (a Baby object) unless
+     * 'deleted' is true.
+     * Error callback is called in case of a failure with the HTTP
+     * response code and the error information returned by the server.
+     */
+    getChanges: function(since, limit, callback, errorCallback, async) {
+        var self = this;
+        if(async == undefined) async = true;
+
+        var data = {};
+        if(since != null) data['since'] = since;
+        if(limit) data['limit'] = limit;
+
+        jQuery.ajax({
+            type: 'GET',
+            url: self.url + '/@@changes',
+            dataType: 'json',
+            data: data,
+            xhrFields: {
+                withCredentials: true
+            },
+            crossDomain: true,
+            async: async,
+            success: function(data, textStatus, jqXHR) {
+                for(var i = 0; i < data['changes'].length; ++i) {
+                    var change = data['changes'][i];
+                    if(change['baby']) change['baby'] = new BabyTracker.Baby(change['baby']);
+                }
+
+                if(callback != undefined) {
+                    callback(self, data);
+                }
+            },
+            error: function(jqXHR, textStatus, errorThrown) {
+                BabyTracker.handleError(jqXHR, textStatus, errorThrown, errorCallback);
+            }
+        });
     }
 
 };
@@ -409,6 +522,207 @@ BabyTracker.Baby.prototype = {
         });
     },
 
+    /**
+     * Add several new entry objects in one request.
+     * Callback is called with the Baby object and a list of results, one
+     * per entry and in the same order. Each result has a 'status' (201 if
+     * the entry was created) and either an 'entry' (an Entry object) or
+     * an 'error' message.
+     * Error callback is called in case of a failure with the HTTP
+     * response code and the error information returned by the server.
+     */
+    addEntries: function(entries, callback, errorCallback, async) {
+        var self = this;
+        if(async == undefined) async = true;
+        jQuery.ajax({
+            type: 'POST',
+            url: self.url + '/@@entries',
+            dataType: 'json',
+            contentType: 'application/json',
+            data: JSON.stringify(entries),
+            processData: false,
+            xhrFields: {
+                withCredentials: true
+            },
+            crossDomain: true,
+            async: async,
+            success: function(data, textStatus, jqXHR) {
+                for(var i = 0; i < data.length; ++i) {
+                    if(data[i].entry) {
+                        data[i].entry = BabyTracker._createEntry(data[i].entry);
+                    }
+                }
+
+                if(callback != undefined) {
+                    callback(self, data);
+                }
+            },
+            error: function(jqXHR, textStatus, errorThrown) {
+                BabyTracker.handleError(jqXHR, textStatus, errorThrown, errorCallback);
+            }
+        });
+    },
+
+    /**
+     * Get totals of the baby's entries per 'day' or 'hour' (period) in the
+     * date/time range start to end. start, end and period may be null.
+     * Callback is called with the Baby object and a list of totals, most
+     * recent first.
+     * Error callback is called in case of a failure with the HTTP
+     * response code and the error information returned by the server.
+     */
+    getSummary: function(start, end, period, callback, errorCallback, async) {
+        var self = this;
+        if(async == undefined) async = true;
+
+        var data = {};
+        if(start) data['start'] = start.toISOString();
+        if(end) data['end'] = end.toISOString();
+        if(period) data['period'] = period;
+
+        jQuery.ajax({
+            type: 'GET',
+            url: self.url + '/@@summary',
+            dataType: 'json',
+            data: data,
+            xhrFields: {
+                withCredentials: true
+            },
+            crossDomain: true,
+            async: async,
+            success: function(data, textStatus, jqXHR) {
+                if(callback != undefined) {
+                    callback(self, data);
+                }
+            },
+            error: function(jqXHR, textStatus, errorThrown) {
+                BabyTracker.handleError(jqXHR, textStatus, errorThrown, errorCallback);
+            }
+        });
+    },
+
+    /**
+     * Get the changes to the baby and its entries since the sequence
+     * number since, at most limit of them. since and limit may be null;
+     * without since, only the current sequence number is returned.
+     * Callback is called with the Baby object and an object with the
+     * latest sequence number 'seq', whether there are 'more' changes, and
+     * a list of 'changes', each with an 'entry' (an Entry object) or a
+     * 'baby' (a Baby object) unless 'deleted' is true.
+     * Error callback is called in case of a failure with the HTTP
+     * response code and the error information returned by the server.
+     */
+    getChanges: function(since, limit, callback, errorCallback, async) {
+        var self = this;
+        if(async == undefined) async = true;
+
+        var data = {};
+        if(since != null) data['since'] = since;
+        if(limit) data['limit'] = limit;
+
+        jQuery.ajax({
+            type: 'GET',
+            url: self.url + '/@@changes',
+            dataType: 'json',
+            data: data,
+            xhrFields: {
+                withCredentials: true
+            },
+            crossDomain: true,
+            async: async,
+            success: function(data, textStatus, jqXHR) {
+                for(var i = 0; i < data['changes'].length; ++i) {
+                    var change = data['changes'][i];
+                    if(change['entry']) change['entry'] = BabyTracker._createEntry(change['entry']);
+                    if(change['baby']) change['baby'] = new BabyTracker.Baby(change['baby']);
+                }
+
+                if(callback != undefined) {
+                    callback(self, data);
+                }
+            },
+            error: function(jqXHR, textStatus, errorThrown) {
+                BabyTracker.handleError(jqXHR, textStatus, errorThrown, errorCallback);
+            }
+        });
+    },
+
+    /**
+     * Listen for changes to the baby and its entries as they happen, e.g.
+     * entries added by another caregiver, starting after the sequence
+     * number since (which may be null for only new changes).
+     * Callback is called with the Baby object and each change, as for
+     * getChanges(). Changes are pushed through server-sent events where
+     * the browser and server support them; otherwise @@changes is polled
+     * every pollInterval milliseconds (by default 30 seconds). Returns an
+     * object with a close() method to stop listening.
+     */
+    listen: function(since, callback, pollInterval) {
+        var self = this;
+        if(pollInterval == undefined) pollInterval = 30000;
+
+        var listener = {
+            since: since,
+            source: null,
+            timer: null,
+            closed: false,
+            close: function() {
+                if(this.source) this.source.close();
+                if(this.timer) clearTimeout(this.timer);
+                this.source = this.timer = null;
+                this.closed = true;
+            }
+        };
+
+        // Without since, the first poll only catches up to the latest change
+        function poll(catchUp) {
+            listener.timer = null;
+            self.getChanges(listener.since, null, function(baby, data) {
+                if(listener.closed) return;
+                if(!catchUp) {
+                    for(var i = 0; i < data['changes'].length; ++i) {
+                        callback(self, data['changes'][i]);
+                    }
+                }
+                listener.since = data['seq'];
+                if(data['more']) {
+                    poll(catchUp);
+                } else {
+                    listener.timer = setTimeout(function() { poll(false); }, pollInterval);
+                }
+            }, function(status, error) {
+                if(listener.closed) return;
+                listener.timer = setTimeout(function() { poll(catchUp); }, pollInterval);
+            });
+        }
+
+        if(typeof(EventSource) == 'undefined') {
+            poll(listener.since == null);
+            return listener;
+        }
+
+        var url = self.url + '/@@events';
+        if(since != null) url += '?since=' + since;
+
+        var source = listener.source = new EventSource(url, {withCredentials: true});
+        source.onmessage = function(event) {
+            var change = JSON.parse(event.data);
+            if(change['entry']) change['entry'] = BabyTracker._createEntry(change['entry']);
+            if(change['baby']) change['baby'] = new BabyTracker.Baby(change['baby']);
+            listener.since = change['seq'];
+            callback(self, change);
+        };
+        source.onerror = function() {
+            // EventSource gives up, rather than reconnecting, when the server
+            // answers 204 because it does not stream events
+            if(source.readyState == EventSource.CLOSED && !listener.closed) {
+                listener.source = null;
+                poll(listener.since == null);
+            }
+        };
+        return listener;
+    },
+
     /**
      * Add a new entry object.
      * Callback is called with the Baby object and the new Entry object.
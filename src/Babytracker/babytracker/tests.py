@@ -1,11 +1,49 @@
 import unittest
 from pyramid import testing
 
+# Password hashing is deliberately slow, so use a low work factor in tests
+TEST_SETTINGS = {'password-iterations': '10', 'database-auto-migrate': 'true'}
+
+def setUpModule():
+    from babytracker.passwords import configure_password_hashing
+    configure_password_hashing(TEST_SETTINGS)
+
+class StatementCounter(object):
+    """Records the SQL statements executed against an engine while used as a
+    context manager, to catch N+1 query regressions.
+
+    Create it before the engine is first used: connections opened before
+    the listener is registered do not report their statements.
+    """
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self.statements = []
+        self.active = False
+        event.listen(engine, 'before_cursor_execute', self._record)
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        if self.active:
+            self.statements.append(statement)
+
+    def __enter__(self):
+        self.statements = []
+        self.active = True
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.active = False
+
+    @property
+    def count(self):
+        return len(self.statements)
+
 class TestModel(unittest.TestCase):
     def setUp(self):
         self.config = testing.setUp()
         from sqlalchemy import create_engine
         engine = create_engine('sqlite://')
+        self.counter = StatementCounter(engine)
         from babytracker.models import DBSession, Base
         DBSession.configure(bind=engine)
         Base.metadata.create_all(engine)
@@ -15,10 +53,117 @@ class TestModel(unittest.TestCase):
         DBSession.remove()
         testing.tearDown()
 
+    def test_upgrade_schema(self):
+        from sqlalchemy.engine.reflection import Inspector
+        from babytracker.models import DBSession, upgrade_schema
+
+        # A database from before the schema was versioned
+        engine = DBSession.bind
+        engine.execute('DROP TABLE schema_version')
+        engine.execute('DROP INDEX ix_entries_baby_id_start')
+
+        upgrade_schema(engine)
+        upgrade_schema(engine)
+
+        indexes = Inspector.from_engine(engine).get_indexes('entries')
+        self.assertEqual(
+            set([u'ix_entries_baby_id_start', u'ix_entries_baby_id_type_start']),
+            set([index['name'] for index in indexes])
+        )
+
+    def test_schema_version(self):
+        from sqlalchemy import create_engine
+        from babytracker.models import SCHEMA_VERSION, SchemaVersionError
+        from babytracker.models import get_schema_version, check_schema, upgrade_schema
+
+        engine = create_engine('sqlite://')
+        self.assertEqual(get_schema_version(engine), 0)
+        self.assertRaises(SchemaVersionError, check_schema, engine)
+
+        self.assertEqual(upgrade_schema(engine), SCHEMA_VERSION)
+        self.assertEqual(check_schema(engine), SCHEMA_VERSION)
+
+        # Nothing to do once up to date
+        counter = StatementCounter(engine)
+        with counter:
+            upgrade_schema(engine)
+        self.assertEqual(counter.count, 1)
+
+    def test_upgrade_unversioned_schema_is_frozen(self):
+        from sqlalchemy import create_engine
+        from sqlalchemy.engine.reflection import Inspector
+        from babytracker.models import MIGRATIONS
+
+        # Migration 1 creates the version 1 schema, not the current models
+        engine = create_engine('sqlite://')
+        MIGRATIONS[0](engine)
+
+        self.assertEqual(
+            set([u'users', u'schema_version', u'babies', u'entries', u'daily_summaries']),
+            set(Inspector.from_engine(engine).get_table_names())
+        )
+
+    def test_upgrade_schema_fills_changes(self):
+        import transaction
+        import datetime
+        from babytracker.models import DBSession, User, Baby, BreastFeed
+        from babytracker.models import upgrade_schema
+
+        with transaction.manager:
+            session = DBSession()
+            baby = Baby(User(u'test@example.org', u'John Smith', 'secret'), datetime.date(2011,11,25), u"Jill Smith", 'f')
+            session.add(baby)
+            session.add(BreastFeed(baby, datetime.datetime(2012, 1, 1, 12, 0, 0)))
+            session.add(BreastFeed(baby, datetime.datetime(2012, 1, 1, 15, 0, 0)))
+
+        # A database at schema version 1
+        engine = DBSession.bind
+        engine.execute('DROP TABLE changes')
+        engine.execute('DELETE FROM schema_version')
+        engine.execute('INSERT INTO schema_version (version) VALUES (1)')
+
+        upgrade_schema(engine)
+        upgrade_schema(engine)
+
+        session = DBSession()
+        baby = session.query(Baby).one()
+        self.assertEqual(['baby', 'entry', 'entry'], [c.kind for c in baby.list_changes(0)])
+        self.assertEqual(1, len(baby.user.list_baby_changes(0)))
+
+    def test_main_checks_schema_version(self):
+        from babytracker import main
+        from babytracker.models import SchemaVersionError
+
+        self.assertRaises(SchemaVersionError, main, {}, **{'sqlalchemy.url': 'sqlite://'})
+
+    def test_upgrade_schema_fills_daily_summaries(self):
+        import transaction
+        import datetime
+        from babytracker.models import DBSession, User, Baby, BottleFeed, upgrade_schema
+
+        with transaction.manager:
+            session = DBSession()
+            baby = Baby(User(u'test@example.org', u'John Smith', 'secret'), datetime.date(2011,11,25), u"Jill Smith", 'f')
+            session.add(baby)
+            session.add(BottleFeed(baby, start=datetime.datetime(2012, 1, 1, 12, 0, 0), amount=100))
+            session.add(BottleFeed(baby, start=datetime.datetime(2012, 1, 2, 12, 0, 0), amount=120))
+
+        engine = DBSession.bind
+        engine.execute('DROP TABLE schema_version')
+        engine.execute('DROP TABLE daily_summaries')
+
+        upgrade_schema(engine)
+
+        self.assertEqual(
+            [(u'2012-01-01', 100), (u'2012-01-02', 120)],
+            [(unicode(row[0]), row[1]) for row in engine.execute(
+                'SELECT day, bottle_amount FROM daily_summaries ORDER BY day')]
+        )
+
     def test_user(self):
         import transaction
-        import hashlib
         from babytracker.models import Root, DBSession, User
+        from babytracker.passwords import verify_password
         from pyramid.security import Allow, DENY_ALL
 
         with transaction.manager:
@@ -30,9 +175,10 @@ class TestModel(unittest.TestCase):
 
             self.assertEqual(user.email, u'test@example.org')
             self.assertEqual(user.name, u'John Smith')
-            self.assertEqual(user.password, hashlib.sha1('secret').hexdigest())
+            self.assertTrue(user.password.startswith('pbkdf2_sha256$10$'))
+            self.assertTrue(verify_password('secret', user.password))
             self.assertEqual(user.__name__, u'test@example.org')
-            self.assertEqual(user.__parent__, Root())
+            self.assertTrue(isinstance(user.__parent__, Root))
 
             self.assertEqual(user.__acl__, [
                 (Allow, u'test@example.org', ('view', 'edit',)),
@@ -78,15 +224,59 @@ class TestModel(unittest.TestCase):
             user = User.authenticate(u'test3@example.org', 'sikrit')
             self.assertEqual(user, None)
 
-    def test_user_change_password(self):
+            user = User.authenticate(u'test1@example.org', 'sikrit')
+            self.assertEqual(user, None)
+
+    def test_user_authenticate_rehashes_legacy_password(self):
+        import transaction
         import hashlib
+        from babytracker.models import DBSession, User
+        from babytracker import passwords
+
+        with transaction.manager:
+            session = DBSession()
+            user = User(u'test1@example.org', u'John Smith', 'secret')
+            user.password = hashlib.sha1('secret').hexdigest()
+            session.add(user)
+
+        with transaction.manager:
+            self.assertEqual(User.authenticate(u'test1@example.org', 'sikrit'), None)
+            user = User.authenticate(u'test1@example.org', 'secret')
+            self.assertEqual(user.__name__, u'test1@example.org')
+
+        user = DBSession().query(User).filter_by(email=u'test1@example.org').one()
+        self.assertTrue(user.password.startswith('pbkdf2_sha256$10$'))
+        self.assertFalse(passwords.needs_rehash(user.password))
+
+        # Changing the work factor rehashes again on the next login
+        try:
+            passwords.configure_password_hashing({'password-iterations': '20'})
+            with transaction.manager:
+                User.authenticate(u'test1@example.org', 'secret')
+
+            user = DBSession().query(User).filter_by(email=u'test1@example.org').one()
+            self.assertTrue(user.password.startswith('pbkdf2_sha256$20$'))
+        finally:
+            passwords.configure_password_hashing(TEST_SETTINGS)
+
+        with transaction.manager:
+            self.assertEqual(User.authenticate(u'test1@example.org', 'secret').__name__, u'test1@example.org')
+
+    def test_user_change_password(self):
         from babytracker.models import User
+        from babytracker.passwords import verify_password
 
         user = User(u'test1@example.org', u'John Smith', 'secret')
-        self.assertEqual(user.password, hashlib.sha1('secret').hexdigest())
+        self.assertTrue(verify_password('secret', user.password))
 
+        old_password = user.password
         user.change_password('sikrit')
-        self.assertEqual(user.password, hashlib.sha1('sikrit').hexdigest())
+        self.assertNotEqual(old_password, user.password)
+        self.assertTrue(verify_password('sikrit', user.password))
+        self.assertFalse(verify_password('secret', user.password))
+
+        # Salted, so the same password doesn't give the same hash
+        self.assertNotEqual(user.password, User(u'test2@example.org', u'Jill Smith', 'sikrit').password)
 
     def test_baby(self):
         import transaction
@@ -115,10 +305,52 @@ class TestModel(unittest.TestCase):
             self.assertEqual(baby1.__name__, u"jill-smith")
             self.assertEqual(baby1.__parent__, user)
 
-    def test_root_singleton(self):
+    def test_baby_slug(self):
+        import transaction
+        import datetime
+        from sqlalchemy.exc import IntegrityError
+        from babytracker.models import DBSession, User, Baby
+
+        with transaction.manager:
+            session = DBSession()
+
+            user = User(u'test@example.org', u'John Smith', 'secret')
+            baby = Baby(user, datetime.date(2011,11,25), u" Jill Smith", 'f')
+            session.add(baby)
+            self.assertEqual(baby.slug, u"jill-smith")
+
+            baby.name = u"Jillie Smith"
+            self.assertEqual(baby.slug, u"jillie-smith")
+            self.assertEqual(baby.__name__, u"jillie-smith")
+
+            session.add(Baby(user, datetime.date(2011,11,25), u"jillie smith", 'f'))
+            self.assertRaises(IntegrityError, session.flush)
+            transaction.abort()
+
+    def test_upgrade_schema_fills_baby_slugs(self):
+        from babytracker.models import DBSession, upgrade_schema
+
+        engine = DBSession.bind
+        engine.execute('DROP TABLE schema_version')
+        engine.execute('DROP INDEX ix_babies_user_id_slug')
+        engine.execute("INSERT INTO users (id, email) VALUES (1, 'test@example.org')")
+        engine.execute("INSERT INTO babies (id, user_id, name) VALUES (1, 1, 'Jill Smith')")
+        engine.execute("INSERT INTO babies (id, user_id, name) VALUES (2, 1, 'jill smith')")
+        engine.execute("INSERT INTO babies (id, user_id, name) VALUES (3, 1, 'Bill')")
+
+        upgrade_schema(engine)
+
+        self.assertEqual(
+            [(1, u'jill-smith'), (2, u'jill-smith-2'), (3, u'bill')],
+            list(engine.execute('SELECT id, slug FROM babies ORDER BY id'))
+        )
+
+    def test_root_per_request(self):
         from babytracker.models import Root
 
-        self.assertTrue(Root() is Root())
+        request = testing.DummyRequest()
+        self.assertTrue(Root(request).request is request)
+        self.assertTrue(Root().request is None)
 
     def test_root_traversal(self):
         import transaction
@@ -134,6 +366,7 @@ class TestModel(unittest.TestCase):
             root = Root()
 
             self.assertEqual(root['test@example.org'], user)
+            self.assertTrue(root['test@example.org'].__parent__ is root)
             self.assertRaises(KeyError, root.__getitem__, 'foo@bar.com')
             self.assertRaises(KeyError, root.__getitem__, 'frobble')
 
@@ -312,6 +545,177 @@ class TestModel(unittest.TestCase):
         self.assertRaises(KeyError, baby.__getitem__, 'notastring')
         self.assertRaises(KeyError, baby.__getitem__, '9999')
 
+    def test_baby_traversal_scoped_to_baby(self):
+        import transaction
+        import datetime
+        from babytracker.models import DBSession, User, Baby, BottleFeed
+
+        with transaction.manager:
+            session = DBSession()
+
+            user = User(u'test@example.org', u'John Smith', 'secret')
+            jill = Baby(user, datetime.date(2011,11,25), u"Jill Smith", 'f')
+            bill = Baby(user, datetime.date(2011,11,25), u"Bill Smith", 'm')
+            session.add(jill)
+            session.add(bill)
+            session.add(BottleFeed(jill, start=datetime.datetime(2012, 1, 1, 12, 0, 0), amount=130))
+            session.flush()
+
+            jill_id, bill_id = jill.id, bill.id
+            entry_id = jill.entries[0].id
+
+        session = DBSession()
+        jill = session.query(Baby).get(jill_id)
+        bill = session.query(Baby).get(bill_id)
+
+        self.assertRaises(KeyError, bill.__getitem__, str(entry_id))
+
+        entry = jill[str(entry_id)]
+
+        # The entry, its subclass columns and its parent are all loaded now
+        with self.counter as counter:
+            self.assertTrue(jill[str(entry_id)] is entry)
+            self.assertEqual(entry.amount, 130)
+            self.assertTrue(entry.__parent__ is jill)
+        self.assertEqual(counter.count, 0)
+
+    def test_baby_get_summary(self):
+        import transaction
+        import datetime
+        from babytracker.models import DBSession, User, Baby
+        from babytracker.models import BreastFeed, BottleFeed, MixedFeed, Sleep, NappyChange
+
+        baby_id = None
+
+        with transaction.manager:
+            session = DBSession()
+
+            user = User(u'test@example.org', u'John Smith', 'secret')
+            baby = Baby(user, datetime.date(2011,11,25), u"Jill Smith", 'f')
+            session.add(baby)
+
+            session.add(BreastFeed(baby,
+                start=datetime.datetime(2012, 1, 1, 12, 0, 0),
+                left_duration=datetime.timedelta(minutes=10),
+                right_duration=datetime.timedelta(minutes=25),
+            ))
+            session.add(MixedFeed(baby,
+                start=datetime.datetime(2012, 1, 1, 12, 30, 0),
+                left_duration=datetime.timedelta(minutes=7),
+                right_duration=datetime.timedelta(minutes=12),
+                topup=110,
+            ))
+            session.add(BottleFeed(baby, start=datetime.datetime(2012, 1, 1, 14, 0, 0), amount=130))
+            session.add(Sleep(baby, start=datetime.datetime(2012, 1, 1, 15, 0, 0), duration=datetime.timedelta(minutes=45)))
+            session.add(NappyChange(baby, start=datetime.datetime(2012, 1, 2, 9, 0, 0), contents='wet'))
+            session.add(NappyChange(baby, start=datetime.datetime(2012, 1, 2, 10, 0, 0), contents='dirty'))
+            session.add(NappyChange(baby, start=datetime.datetime(2012, 1, 2, 10, 30, 0), contents='wet'))
+
+            session.flush()
+            baby_id = baby.id
+
+        session = DBSession()
+        baby = session.query(Baby).get(baby_id)
+
+        summary = baby.get_summary(start=None, end=None)
+        self.assertEqual([u'2012-01-02', u'2012-01-01'], [s['start'] for s in summary])
+
+        self.assertEqual(summary[1], {
+            'start': u'2012-01-01',
+            'feeds': 3,
+            'left_duration': 17,
+            'right_duration': 37,
+            'bottle_amount': 130,
+            'topup_amount': 110,
+            'sleeps': 1,
+            'sleep_duration': 45,
+            'nappy_changes': 0,
+            'wet_nappies': 0,
+            'dirty_nappies': 0,
+        })
+        self.assertEqual((3, 2, 1), (summary[0]['nappy_changes'], summary[0]['wet_nappies'], summary[0]['dirty_nappies']))
+
+        summary = baby.get_summary(start=datetime.datetime(2012, 1, 2), end=None, period='hour')
+        self.assertEqual(
+            [(u'2012-01-02T10:00:00', 2), (u'2012-01-02T09:00:00', 1)],
+            [(s['start'], s['nappy_changes']) for s in summary]
+        )
+
+    def test_baby_daily_summary(self):
+        import transaction
+        import datetime
+        from babytracker.models import DBSession, User, Baby, Entry
+        from babytracker.models import BottleFeed, Sleep, NappyChange
+        from babytracker.scripts.rebuild_summaries import rebuild_summaries
+        from zope.sqlalchemy import mark_changed
+
+        with transaction.manager:
+            session = DBSession()
+
+            user = User(u'test@example.org', u'John Smith', 'secret')
+            baby = Baby(user, datetime.date(2011,11,25), u"Jill Smith", 'f')
+            session.add(baby)
+
+            session.add(BottleFeed(baby, start=datetime.datetime(2012, 1, 1, 14, 0, 0), amount=130))
+            session.add(Sleep(baby, start=datetime.datetime(2012, 1, 1, 15, 0, 0), duration=datetime.timedelta(minutes=45)))
+            session.add(NappyChange(baby, start=datetime.datetime(2012, 1, 2, 9, 0, 0), contents='wet'))
+            session.add(NappyChange(baby, start=datetime.datetime(2012, 1, 2, 10, 0, 0), contents='dirty'))
+
+            session.flush()
+            baby_id = baby.id
+
+        def check(days):
+            baby = DBSession().query(Baby).get(baby_id)
+            summary = baby.get_daily_summary(None, None)
+            self.assertEqual(baby.get_summary(None, None), summary)
+            self.assertEqual(days, [s['start'] for s in summary])
+            return summary
+
+        summary = check([u'2012-01-02', u'2012-01-01'])
+        self.assertEqual((130, 1, 45, 0), (summary[1]['bottle_amount'], summary[1]['sleeps'],
+            summary[1]['sleep_duration'], summary[1]['nappy_changes']))
+
+        # Moving an entry to another day updates both days
+        with transaction.manager:
+            session = DBSession()
+            nappy = session.query(NappyChange).filter_by(baby_id=baby_id, contents='dirty').one()
+            nappy.start = datetime.datetime(2012, 1, 1, 18, 0, 0)
+
+        summary = check([u'2012-01-02', u'2012-01-01'])
+        self.assertEqual((1, 1, 0), (summary[0]['nappy_changes'], summary[0]['wet_nappies'], summary[0]['dirty_nappies']))
+        self.assertEqual((1, 0, 1), (summary[1]['nappy_changes'], summary[1]['wet_nappies'], summary[1]['dirty_nappies']))
+
+        # Deleting the only entry on a day removes the day
+        with transaction.manager:
+            session = DBSession()
+            session.delete(session.query(NappyChange).filter_by(baby_id=baby_id, contents='wet').one())
+
+        check([u'2012-01-01'])
+
+        baby = DBSession().query(Baby).get(baby_id)
+        summary = baby.get_daily_summary(datetime.date(2012, 1, 2), None)
+        self.assertEqual([], summary)
+
+        # Rebuilding restores summaries lost or changed outside the ORM
+        with transaction.manager:
+            session = DBSession()
+            session.execute(Entry.__table__.update().values(amount=200))
+            mark_changed(session)
+
+        rebuild_summaries()
+        summary = check([u'2012-01-01'])
+        self.assertEqual(200, summary[0]['bottle_amount'])
+
+        # Deleting the baby takes its summaries with it
+        with transaction.manager:
+            session = DBSession()
+            baby = session.query(Baby).get(baby_id)
+            for entry in baby.entries:
+                session.delete(entry)
+            session.delete(baby)
+
+        self.assertEqual(0, DBSession().execute("SELECT count(*) FROM daily_summaries").scalar())
+
     def test_baby_get_entries_between(self):
         import transaction
         import datetime
@@ -413,3 +817,1726 @@ class TestModel(unittest.TestCase):
             [u'sleep1', u'bottle1'],
             [e.note for e in entries]
         )
+
+    def test_baby_list_entries_between(self):
+        import transaction
+        import datetime
+        from babytracker.models import DBSession, User, Baby, EntryRecord
+        from babytracker.models import BreastFeed, MixedFeed, Sleep
+
+        with transaction.manager:
+            session = DBSession()
+
+            user = User(u'test@example.org', u'John Smith', 'secret')
+            baby = Baby(user, datetime.date(2011,11,25), u"Jill Smith", 'f')
+            session.add(baby)
+
+            session.add(BreastFeed(baby, datetime.datetime(2012, 1, 1, 12, 0, 0), datetime.timedelta(minutes=5), note=u"breast1"))
+            session.add(MixedFeed(baby, datetime.datetime(2012, 1, 1, 13, 0, 0), topup=60, note=u"mixed1"))
+            session.add(Sleep(baby, datetime.datetime(2012, 1, 1, 14, 0, 0), datetime.timedelta(minutes=45), note=u"sleep1"))
+
+            session.flush()
+            baby_id = baby.id
+
+        session = DBSession()
+        baby = session.query(Baby).get(baby_id)
+
+        # Nothing is loaded into the session
+        loaded = len(session.identity_map)
+        records = baby.list_entries_between(start=None, end=None)
+        self.assertEqual(loaded, len(session.identity_map))
+
+        self.assertEqual([u'sleep1', u'mixed1', u'breast1'], [r.note for r in records])
+        self.assertTrue(isinstance(records[0], EntryRecord))
+        self.assertEqual(datetime.timedelta(minutes=45), records[0].duration)
+        self.assertEqual((u'mixed_feed', 60), (records[1].type, records[1].topup))
+
+        # Entry types include their subtypes, as with the ORM
+        records = baby.list_entries_between(start=None, end=None, entry_type=BreastFeed)
+        self.assertEqual([u'mixed1', u'breast1'], [r.note for r in records])
+
+        records = baby.list_entries_between(start=None, end=None, limit=1)
+        self.assertEqual([u'sleep1'], [r.note for r in records])
+
+        records = baby.list_entries_between(start=None, end=None, after=(records[0].start, records[0].id,))
+        self.assertEqual([u'mixed1', u'breast1'], [r.note for r in records])
+
+    def test_baby_changes(self):
+        import transaction
+        import datetime
+        from babytracker.models import DBSession, User, Baby, ChangeRecord
+        from babytracker.models import BreastFeed, Sleep
+
+        with transaction.manager:
+            session = DBSession()
+
+            user = User(u'test@example.org', u'John Smith', 'secret')
+            baby = Baby(user, datetime.date(2011,11,25), u"Jill Smith", 'f')
+            other = Baby(user, datetime.date(2011,11,25), u"Jack Smith", 'm')
+            session.add(baby)
+            session.add(other)
+
+            feed = BreastFeed(baby, datetime.datetime(2012, 1, 1, 12, 0, 0))
+            sleep = Sleep(baby, datetime.datetime(2012, 1, 1, 13, 0, 0), datetime.timedelta(minutes=30))
+            session.add(feed)
+            session.add(sleep)
+            session.add(Sleep(other, datetime.datetime(2012, 1, 1, 13, 0, 0), datetime.timedelta(minutes=30)))
+
+            session.flush()
+            baby_id, other_id, feed_id, sleep_id = baby.id, other.id, feed.id, sleep.id
+
+        session = DBSession()
+        baby = session.query(Baby).get(baby_id)
+        user = baby.user
+
+        created = baby.list_changes(0)
+        self.assertEqual(3, len(created))
+        self.assertEqual(set([('baby', baby_id,), ('entry', feed_id,), ('entry', sleep_id,)]),
+            set([(c.kind, c.object_id,) for c in created]))
+        self.assertTrue(isinstance(created[0], ChangeRecord))
+        self.assertEqual(created[-1].seq, baby.last_change())
+        self.assertEqual(2, len(baby.list_changes(0, limit=2)))
+
+        since = baby.last_change()
+        self.assertEqual([], baby.list_changes(since))
+
+        with transaction.manager:
+            session = DBSession()
+            baby = session.query(Baby).get(baby_id)
+            session.query(BreastFeed).get(feed_id).note = u"First"
+            session.query(BreastFeed).get(feed_id).note = u"Second"
+            session.flush()
+            session.query(BreastFeed).get(feed_id).note = u"Third"
+            session.delete(session.query(Sleep).get(sleep_id))
+
+        session = DBSession()
+        baby = session.query(Baby).get(baby_id)
+
+        # Only the latest change to each entry is kept, and deletions are
+        # recorded
+        self.assertEqual([('entry', feed_id, False,), ('entry', sleep_id, True,)],
+            sorted([(c.kind, c.object_id, c.deleted,) for c in baby.list_changes(since)]))
+        self.assertEqual(3, len(baby.list_changes(0)))
+        self.assertTrue(baby.list_changes(since)[0].seq > since)
+
+        # Other babies' changes are not affected
+        self.assertEqual(2, len(session.query(Baby).get(other_id).list_changes(0)))
+
+        since = user.last_baby_change()
+        self.assertEqual(set([baby_id, other_id]), set([c.object_id for c in user.list_baby_changes(0)]))
+
+        with transaction.manager:
+            session = DBSession()
+            session.delete(session.query(Baby).get(other_id))
+
+        session = DBSession()
+        user = session.query(User).filter_by(email=u'test@example.org').one()
+
+        # A deleted baby leaves only its tombstone
+        changes = user.list_baby_changes(since)
+        self.assertEqual([('baby', other_id, True,)], [(c.kind, c.object_id, c.deleted,) for c in changes])
+        self.assertTrue(changes[0].seq > since)
+        self.assertEqual(changes[0].seq, user.last_baby_change())
+
+    def test_baby_changes_lock_user(self):
+        import transaction
+        import datetime
+        from sqlalchemy.dialects import postgresql
+        from babytracker.models import DBSession, User, Baby, BreastFeed, _lock_users
+
+        def locks_user(statements):
+            inserted = [i for i, s in enumerate(statements) if s.startswith('INSERT INTO changes')]
+            locked = [i for i, s in enumerate(statements) if 'WHERE users.id IN' in s]
+            return bool(locked) and locked[0] < inserted[0]
+
+        # The user's row is locked before a baby change is given a sequence
+        # number, so changes to different babies of a user commit in order
+        with self.counter:
+            with transaction.manager:
+                session = DBSession()
+                baby = Baby(User(u'test@example.org', u'John Smith', 'secret'), datetime.date(2011,11,25), u"Jill Smith", 'f')
+                session.add(baby)
+                session.flush()
+                baby_id = baby.id
+        self.assertTrue(locks_user(self.counter.statements))
+
+        with self.counter:
+            with transaction.manager:
+                DBSession().query(Baby).get(baby_id).name = u"Jill Jones"
+        self.assertTrue(locks_user(self.counter.statements))
+
+        # Entries are only in their baby's feed
+        with self.counter:
+            with transaction.manager:
+                session = DBSession()
+                session.add(BreastFeed(session.query(Baby).get(baby_id), datetime.datetime(2012, 1, 1, 12, 0, 0)))
+        self.assertFalse(locks_user(self.counter.statements))
+
+        self.assertTrue(str(_lock_users([1]).compile(dialect=postgresql.dialect())).endswith('FOR UPDATE'))
+
+class TestAPI(unittest.TestCase):
+    def setUp(self):
+        self.config = testing.setUp()
+        self.config.add_route('api', '/api/*traverse')
+        from sqlalchemy import create_engine
+        engine = create_engine('sqlite://')
+        self.counter = StatementCounter(engine)
+        from babytracker.models import DBSession, Base
+        DBSession.configure(bind=engine)
+        Base.metadata.create_all(engine)
+
+    def tearDown(self):
+        from babytracker.models import DBSession
+        DBSession.remove()
+        testing.tearDown()
+
+    def _make_request(self, context, params=None):
+        from pyramid.interfaces import IRoutesMapper
+        request = testing.DummyRequest(params=params or {})
+        request.context = context
+        request.matchdict = {}
+        request.matched_route = self.config.registry.getUtility(IRoutesMapper).get_route('api')
+        return request
+
+    def _make_baby(self, num_entries=5):
+        import transaction
+        import datetime
+        from babytracker.models import DBSession, User, Baby, BottleFeed
+
+        with transaction.manager:
+            session = DBSession()
+
+            user = User(u'test@example.org', u'John Smith', 'secret')
+            baby = Baby(user, datetime.date(2011,11,25), u"Jill Smith", 'f')
+            session.add(baby)
+
+            for i in range(num_entries):
+                session.add(BottleFeed(baby,
+                    start=datetime.datetime(2012, 1, 1, 12, 0, 0) + datetime.timedelta(hours=i),
+                    amount=100 + i,
+                ))
+
+            session.flush()
+            return baby.id
+
+    def test_entries(self):
+        from babytracker.models import DBSession, Baby
+        from babytracker.views.api import BabyAPI
+
+        baby_id = self._make_baby()
+        baby = DBSession().query(Baby).get(baby_id)
+
+        request = self._make_request(baby)
+        data = BabyAPI(request).entries()
+
+        self.assertEqual([104, 103, 102, 101, 100], [e['amount'] for e in data])
+        self.assertEqual('http://example.com/api/test%40example.org/jill-smith/5', data[0]['url'])
+        self.assertFalse('Link' in request.response.headers)
+
+    def test_entries_paged(self):
+        import urlparse
+        from babytracker.models import DBSession, Baby
+        from babytracker.views.api import BabyAPI
+
+        baby_id = self._make_baby()
+        baby = DBSession().query(Baby).get(baby_id)
+
+        request = self._make_request(baby, {'limit': '2'})
+        data = BabyAPI(request).entries()
+        self.assertEqual([104, 103], [e['amount'] for e in data])
+
+        amounts = [e['amount'] for e in data]
+        while 'Link' in request.response.headers:
+            link = request.response.headers['Link']
+            self.assertTrue(link.endswith('>; rel="next"'))
+            url = urlparse.urlparse(link[1:link.index('>')])
+            self.assertEqual('/api/test%40example.org/jill-smith/@@entries', url.path)
+
+            params = dict(urlparse.parse_qsl(url.query))
+            self.assertEqual('2', params['limit'])
+
+            request = self._make_request(baby, params)
+            amounts.extend([e['amount'] for e in BabyAPI(request).entries()])
+
+        self.assertEqual([104, 103, 102, 101, 100], amounts)
+
+    def test_entries_without_start(self):
+        from babytracker.models import DBSession, Baby, Entry
+        from babytracker.views.api import BabyAPI
+
+        baby_id = self._make_baby()
+        session = DBSession()
+        session.execute(Entry.__table__.insert().values(baby_id=baby_id, type='bottle_feed', amount=99, start=None))
+        baby = session.query(Baby).get(baby_id)
+
+        # Left out of listings, which are ordered and paged by start
+        request = self._make_request(baby)
+        self.assertEqual([104, 103, 102, 101, 100], [e['amount'] for e in BabyAPI(request).entries()])
+        self.assertEqual([104, 103, 102, 101, 100], [e.amount for e in baby.get_entries_between(None, None)])
+
+        request = self._make_request(baby, {'limit': '5'})
+        self.assertEqual([104, 103, 102, 101, 100], [e['amount'] for e in BabyAPI(request).entries()])
+        self.assertFalse('Link' in request.response.headers)
+
+    def test_entries_invalid_parameters(self):
+        from babytracker.models import DBSession, Baby
+        from babytracker.views.api import BabyAPI
+
+        baby_id = self._make_baby()
+        baby = DBSession().query(Baby).get(baby_id)
+
+        for params in (
+            {'limit': 'foo'},
+            {'limit': '0'},
+            {'cursor': 'notacursor'},
+            {'entry_type': 'foo'},
+        ):
+            request = self._make_request(baby, params)
+            data = BabyAPI(request).entries()
+            self.assertEqual(400, request.response.status_int)
+            self.assertTrue('error' in data)
+
+    def test_create_entry(self):
+        import datetime
+        from babytracker.models import DBSession, Baby
+        from babytracker.views.api import BabyAPI
+
+        baby_id = self._make_baby(num_entries=0)
+        baby = DBSession().query(Baby).get(baby_id)
+
+        request = self._make_request(baby)
+        request.json_body = {
+            'entry_type': 'sleep',
+            'start': '2012-01-01T12:00:00',
+            'duration': 30,
+            'url': None,
+        }
+        data = BabyAPI(request).create()
+
+        self.assertEqual(data['duration'], 30)
+        self.assertEqual(baby.entries[0].duration, datetime.timedelta(minutes=30))
+
+    def test_create_many(self):
+        from babytracker.models import DBSession, Baby
+        from babytracker.views.api import BabyAPI
+
+        baby_id = self._make_baby(num_entries=0)
+        baby = DBSession().query(Baby).get(baby_id)
+
+        request = self._make_request(baby)
+        request.json_body = [
+            {'entry_type': 'bottle_feed', 'start': '2012-01-01T12:00:00', 'amount': 100},
+            {'entry_type': 'bottle_feed', 'start': 'foo', 'amount': 100},
+            {'entry_type': 'frobble', 'start': '2012-01-01T13:00:00'},
+            'foo',
+            {'entry_type': 'nappy_change', 'start': '2012-01-01T14:00:00', 'contents': 'wet'},
+        ]
+
+        with self.counter as counter:
+            data = BabyAPI(request).create_many()
+
+        self.assertEqual([201, 400, 400, 400, 201], [r['status'] for r in data])
+        self.assertEqual(100, data[0]['entry']['amount'])
+        self.assertEqual('wet', data[4]['entry']['contents'])
+        self.assertEqual('Invalid start date', data[1]['error'])
+
+        # Two INSERTs, and no loading of existing entries
+        self.assertEqual(2, len([st for st in counter.statements if st.startswith('INSERT INTO entries')]))
+        self.assertEqual(0, len([st for st in counter.statements if st.startswith('SELECT entries.')]))
+
+        DBSession().expire_all()
+        self.assertEqual(['nappy_change', 'bottle_feed'], [e.type for e in baby.entries])
+
+    def test_create_many_invalid(self):
+        from babytracker.models import DBSession, Baby
+        from babytracker.views import api
+
+        baby_id = self._make_baby(num_entries=0)
+        baby = DBSession().query(Baby).get(baby_id)
+
+        request = self._make_request(baby)
+        request.json_body = {'entry_type': 'sleep'}
+        api.BabyAPI(request).create_many()
+        self.assertEqual(400, request.response.status_int)
+
+        request = self._make_request(baby)
+        request.json_body = [{}] * (api.MAX_BATCH_SIZE + 1)
+        api.BabyAPI(request).create_many()
+        self.assertEqual(400, request.response.status_int)
+
+    def test_create_many_invalid_properties(self):
+        from babytracker.models import DBSession, Baby
+        from babytracker.views.api import BabyAPI
+
+        baby_id = self._make_baby(num_entries=0)
+        baby = DBSession().query(Baby).get(baby_id)
+
+        request = self._make_request(baby)
+        request.json_body = [
+            {'entry_type': 'bottle_feed', 'start': '2012-01-01T12:00:00'},
+            {'entry_type': 'bottle_feed', 'start': '2012-01-01T12:00:00', 'amount': 100, 'id': 1},
+            {'entry_type': 'sleep', 'start': '2012-01-01T12:00:00', 'duration': 30, 'type': 'sleep'},
+            {'entry_type': 'sleep', 'start': '2012-01-01T12:00:00', 'duration': 30, 'baby_id': 2},
+            {'entry_type': 'sleep', 'start': '2012-01-01T13:00:00', 'duration': 30},
+        ]
+        data = BabyAPI(request).create_many()
+
+        self.assertEqual([400, 400, 400, 400, 201], [r['status'] for r in data])
+        self.assertEqual('Missing property amount of type bottle_feed', data[0]['error'])
+        self.assertEqual('Unknown property id of type bottle_feed', data[1]['error'])
+        self.assertEqual('Unknown property type of type sleep', data[2]['error'])
+        self.assertEqual('Unknown property baby_id of type sleep', data[3]['error'])
+
+        request = self._make_request(baby)
+        request.json_body = {'entry_type': 'sleep', 'start': '2012-01-01T12:00:00'}
+        data = BabyAPI(request).create()
+        self.assertEqual(400, request.response.status_int)
+        self.assertEqual('Missing property duration of type sleep', data['error'])
+
+        DBSession().expire_all()
+        self.assertEqual(1, len(baby.entries))
+
+    def test_entries_stream(self):
+        import json
+        from babytracker.models import DBSession, Baby
+        from babytracker.views import api
+
+        baby_id = self._make_baby(num_entries=7)
+        baby = DBSession().query(Baby).get(baby_id)
+
+        old_batch_size = api.STREAM_BATCH_SIZE
+        api.STREAM_BATCH_SIZE = 3
+        try:
+            request = self._make_request(baby, {'stream': '1'})
+            response = api.BabyAPI(request).entries()
+            data = json.loads(''.join(response.app_iter))
+            self.assertEqual(range(106, 99, -1), [e['amount'] for e in data])
+
+            request = self._make_request(baby, {'stream': '1', 'limit': '4'})
+            response = api.BabyAPI(request).entries()
+            data = json.loads(''.join(response.app_iter))
+            self.assertEqual(range(106, 102, -1), [e['amount'] for e in data])
+        finally:
+            api.STREAM_BATCH_SIZE = old_batch_size
+
+    def test_export(self):
+        import csv
+        import json
+        import transaction
+        from babytracker.models import DBSession, Baby, BottleFeed
+        from babytracker.views import api
+
+        baby_id = self._make_baby(num_entries=7)
+
+        with transaction.manager:
+            entry = DBSession().query(BottleFeed).filter_by(amount=106).one()
+            entry.note = u"Caf\xe9, then \"sleep\""
+
+        baby = DBSession().query(Baby).get(baby_id)
+
+        old_batch_size = api.STREAM_BATCH_SIZE
+        api.STREAM_BATCH_SIZE = 3
+        try:
+            request = self._make_request(baby)
+            response = api.BabyAPI(request).export()
+            self.assertEqual('text/csv', response.content_type)
+            self.assertEqual('attachment; filename="jill-smith.csv"', response.headers['Content-Disposition'])
+
+            # One chunk per batch of entries, with the header in the first
+            chunks = list(response.app_iter)
+            self.assertEqual(3, len(chunks))
+
+            rows = list(csv.DictReader(''.join(chunks).splitlines()))
+            self.assertEqual(range(106, 99, -1), [int(row['amount']) for row in rows])
+            self.assertEqual(api.export_columns(), ''.join(chunks).splitlines()[0].split(','))
+            self.assertEqual(('bottle_feed', '2012-01-01T18:00:00', '', '',),
+                (rows[0]['entry_type'], rows[0]['start'], rows[0]['end'], rows[0]['duration'],))
+            self.assertEqual(u"Caf\xe9, then \"sleep\"", rows[0]['note'].decode('utf-8'))
+
+            request = self._make_request(baby, {'format': 'ndjson', 'entry_type': 'bottle_feed'})
+            response = api.BabyAPI(request).export()
+            self.assertEqual('application/x-ndjson', response.content_type)
+            lines = ''.join(response.app_iter).splitlines()
+            self.assertEqual(range(106, 99, -1), [json.loads(line)['amount'] for line in lines])
+            entry = DBSession().query(BottleFeed).filter_by(amount=106).one()
+            self.assertEqual(api.entry_json(entry, request), json.loads(lines[0]))
+
+            # Just the header if there are no entries
+            request = self._make_request(baby, {'entry_type': 'sleep'})
+            response = api.BabyAPI(request).export()
+            self.assertEqual([','.join(api.export_columns()) + '\r\n'], list(response.app_iter))
+        finally:
+            api.STREAM_BATCH_SIZE = old_batch_size
+
+        for params in ({'format': 'xml'}, {'start': 'notadate'},):
+            request = self._make_request(baby, params)
+            data = api.BabyAPI(request).export()
+            self.assertEqual(400, request.response.status_int)
+            self.assertTrue('error' in data)
+
+    def test_entry_serializer(self):
+        import json
+        import datetime
+        import transaction
+        from babytracker.models import DBSession, User, Baby
+        from babytracker.models import BreastFeed, BottleFeed, MixedFeed, Sleep, NappyChange
+        from babytracker.views.api import EntrySerializer, entry_json
+        from babytracker.renderers import dumps
+
+        with transaction.manager:
+            session = DBSession()
+            baby = Baby(User(u'test@example.org', u'John Smith', 'secret'), datetime.date(2011,11,25), u"Jill Smith", 'f')
+            start = datetime.datetime(2012, 1, 1, 12, 0, 0)
+            session.add_all([
+                BreastFeed(baby, start, datetime.timedelta(minutes=5), datetime.timedelta(minutes=10)),
+                BottleFeed(baby, start, 120, end=start + datetime.timedelta(minutes=15), note=u"Note"),
+                MixedFeed(baby, start, topup=50),
+                Sleep(baby, start, datetime.timedelta(minutes=90)),
+                NappyChange(baby, start, 'dirty'),
+            ])
+            session.flush()
+            baby_id = baby.id
+
+        baby = DBSession().query(Baby).get(baby_id)
+        request = self._make_request(baby)
+        serializer = EntrySerializer(baby, request)
+
+        self.assertEqual(5, len(baby.entries))
+        for entry in baby.entries:
+            self.assertEqual(entry_json(entry, request), serializer(entry))
+            self.assertEqual(entry_json(entry, request), json.loads(dumps(serializer(entry))))
+
+        records = dict((record.id, record) for record in baby.list_entries_between(None, None))
+        for entry in baby.entries:
+            self.assertEqual(entry_json(entry, request), serializer(records[entry.id]))
+
+    def test_summary(self):
+        from babytracker.models import DBSession, Baby
+        from babytracker.views.api import BabyAPI
+
+        baby_id = self._make_baby(num_entries=15)
+        baby = DBSession().query(Baby).get(baby_id)
+
+        # Daily totals cover whole days
+        request = self._make_request(baby, {'start': '2012-01-02T09:00:00', 'end': '2012-01-02T10:00:00'})
+        data = BabyAPI(request).summary()
+        self.assertEqual([(u'2012-01-02', 3)], [(s['start'], s['feeds']) for s in data])
+
+        request = self._make_request(baby, {'start': '2012-01-02T00:00:00', 'period': 'hour'})
+        data = BabyAPI(request).summary()
+        self.assertEqual([u'2012-01-02T02:00:00', u'2012-01-02T01:00:00', u'2012-01-02T00:00:00'],
+            [s['start'] for s in data])
+
+        request = self._make_request(baby, {'period': 'week'})
+        BabyAPI(request).summary()
+        self.assertEqual(400, request.response.status_int)
+
+class TestSecurity(unittest.TestCase):
+    def setUp(self):
+        self.config = testing.setUp()
+        from sqlalchemy import create_engine
+        engine = create_engine('sqlite://')
+        self.counter = StatementCounter(engine)
+        from babytracker.models import DBSession, Base
+        DBSession.configure(bind=engine)
+        Base.metadata.create_all(engine)
+
+    def tearDown(self):
+        from babytracker import security
+        from babytracker.models import DBSession
+        security.principal_cache = security.PrincipalCache()
+        DBSession.remove()
+        testing.tearDown()
+
+    def _make_request(self):
+        from babytracker.security import Request
+        request = Request.blank('/')
+        request.registry = self.config.registry
+        return request
+
+    def test_bearer_token_policy(self):
+        from pyramid.security import Authenticated
+        from pyramid.authentication import AuthTktAuthenticationPolicy
+        from babytracker.security import BearerTokenAuthenticationPolicy, deny_list
+        from babytracker.interfaces import BEARER_TOKEN
+
+        policy = BearerTokenAuthenticationPolicy(AuthTktAuthenticationPolicy('secret'), 'sikrit', timeout=60)
+        token = policy.issue(u'test@example.org', [1, 3])
+
+        claims = policy.verify(token)
+        self.assertEqual(u'test@example.org', claims['sub'])
+        self.assertEqual([1, 3], claims['babies'])
+
+        request = self._make_request()
+        request.matched_route = testing.DummyResource(name='api')
+        request.headers['Authorization'] = 'Bearer %s' % token
+        self.assertEqual(u'test@example.org', policy.authenticated_userid(request))
+
+        principals = policy.effective_principals(request)
+        for principal in (Authenticated, u'test@example.org', BEARER_TOKEN, u'baby:test@example.org:1', u'baby:test@example.org:3'):
+            self.assertTrue(principal in principals, principal)
+
+        # Only for the API
+        request = self._make_request()
+        request.headers['Authorization'] = 'Bearer %s' % token
+        self.assertEqual(None, policy.authenticated_userid(request))
+
+        # Signed with a different secret
+        other = BearerTokenAuthenticationPolicy(AuthTktAuthenticationPolicy('secret'), 'other')
+        self.assertEqual(None, other.verify(token))
+        self.assertEqual(None, policy.verify('garbage'))
+
+        # Expired
+        policy.timeout = -1
+        self.assertEqual(None, policy.verify(policy.issue(u'test@example.org', [])))
+
+        try:
+            deny_list.revoke(claims['jti'], claims['exp'])
+            self.assertEqual(None, policy.verify(token))
+        finally:
+            deny_list.clear()
+
+    def test_token_deny_list(self):
+        import time
+        from babytracker.security import TokenDenyList
+
+        deny_list = TokenDenyList()
+        deny_list.revoke('a', time.time() + 60)
+        deny_list.revoke('b', time.time() - 1) # already expired
+        deny_list.revoke('c', time.time() + 0.01)
+
+        self.assertTrue(deny_list.is_revoked('a'))
+        self.assertFalse(deny_list.is_revoked('b'))
+        self.assertEqual(2, len(deny_list))
+
+        time.sleep(0.02)
+        self.assertFalse(deny_list.is_revoked('c'))
+        self.assertEqual(1, len(deny_list))
+
+    def test_request_user(self):
+        import transaction
+        from babytracker.models import DBSession, User
+
+        with transaction.manager:
+            DBSession().add(User(u'test@example.org', u'John Smith', 'secret'))
+
+        request = self._make_request()
+        self.assertEqual(request.user, None)
+
+        self.config.testing_securitypolicy(userid=u'test@example.org')
+        request = self._make_request()
+        self.assertEqual(request.user.email, u'test@example.org')
+        self.assertTrue(request.user is request.user)
+
+    def test_validate_user(self):
+        import transaction
+        from babytracker.models import DBSession, User
+        from babytracker.security import validate_user
+
+        with transaction.manager:
+            DBSession().add(User(u'test@example.org', u'John Smith', 'secret'))
+
+        self.config.testing_securitypolicy(userid=u'test@example.org')
+        self.assertEqual(validate_user(u'test@example.org', self._make_request()), (u'test@example.org',))
+
+        self.config.testing_securitypolicy(userid=u'foo@example.org')
+        self.assertEqual(validate_user(u'foo@example.org', self._make_request()), None)
+
+    def test_root_traversal_uses_request_user(self):
+        import transaction
+        from babytracker.models import DBSession, User, Root
+
+        with transaction.manager:
+            DBSession().add(User(u'test@example.org', u'John Smith', 'secret'))
+
+        self.config.testing_securitypolicy(userid=u'test@example.org')
+        request = self._make_request()
+
+        root = Root(request)
+        with self.counter:
+            self.assertTrue(root[u'test@example.org'] is request.user)
+            self.assertTrue(root[u'test@example.org'] is request.user)
+        self.assertEqual(self.counter.count, 1)
+        self.assertTrue(request.user.__parent__ is root)
+
+    def test_principal_cache(self):
+        import transaction
+        from babytracker import security
+        from babytracker.models import DBSession, User
+
+        security.configure_principal_cache({'user-cache-timeout': '60'})
+
+        with transaction.manager:
+            DBSession().add(User(u'test@example.org', u'John Smith', 'secret'))
+
+        self.config.testing_securitypolicy(userid=u'test@example.org')
+        self.assertEqual(security.validate_user(u'test@example.org', self._make_request()), (u'test@example.org',))
+        self.assertEqual(security.principal_cache.get(u'test@example.org'), (u'test@example.org',))
+
+        with transaction.manager:
+            user = DBSession().query(User).filter_by(email=u'test@example.org').one()
+            user.change_password('sikrit')
+
+        self.assertEqual(security.principal_cache.get(u'test@example.org'), None)
+        self.assertEqual(security.validate_user(u'test@example.org', self._make_request()), (u'test@example.org',))
+
+        with transaction.manager:
+            user = DBSession().query(User).filter_by(email=u'test@example.org').one()
+            DBSession().delete(user)
+
+        self.assertEqual(security.principal_cache.get(u'test@example.org'), None)
+        self.assertEqual(security.validate_user(u'test@example.org', self._make_request()), None)
+
+    def test_principal_cache_expiry(self):
+        from babytracker.security import PrincipalCache
+
+        cache = PrincipalCache(timeout=0)
+        cache.put('foo', ('foo',))
+        self.assertEqual(cache.get('foo'), None)
+
+        cache = PrincipalCache(timeout=-1)
+        cache.put('foo', ('foo',))
+        self.assertEqual(cache.get('foo'), None)
+
+        cache = PrincipalCache(timeout=60)
+        cache.put('foo', ('foo',))
+        self.assertEqual(cache.get('foo'), ('foo',))
+
+class TestHooks(unittest.TestCase):
+    def setUp(self):
+        self.config = testing.setUp()
+        self.config.add_route('api', '/api/*traverse')
+
+    def tearDown(self):
+        from babytracker import hooks
+        hooks._layout = None
+        testing.tearDown()
+
+    def _make_event(self, renderer_name, route_name=None):
+        from pyramid.events import BeforeRender
+        from pyramid.interfaces import IRoutesMapper
+
+        request = testing.DummyRequest()
+        request.matched_route = None
+        if route_name is not None:
+            request.matched_route = self.config.registry.getUtility(IRoutesMapper).get_route(route_name)
+        return BeforeRender({'renderer_name': renderer_name, 'request': request})
+
+    def test_add_base_template(self):
+        from babytracker.hooks import add_base_template, add_login_status
+
+        event = self._make_event('babytracker:templates/user.pt')
+        add_base_template(event)
+        add_login_status(event)
+        self.assertTrue(event['layout'] is not None)
+        self.assertTrue('authenticated_userid' in event)
+
+        # The layout is only looked up once
+        other = self._make_event('babytracker:templates/entries.pt')
+        add_base_template(other)
+        self.assertTrue(other['layout'] is event['layout'])
+
+    def test_add_base_template_skipped_for_api(self):
+        from babytracker.hooks import add_base_template, add_login_status
+
+        for event in (self._make_event('json'), self._make_event('string', 'api')):
+            add_base_template(event)
+            add_login_status(event)
+            self.assertFalse('layout' in event)
+            self.assertFalse('authenticated_userid' in event)
+
+class TestUtils(unittest.TestCase):
+
+    def _make_request(self, user_agent=None, preferred_view=None):
+        request = testing.DummyRequest()
+        if user_agent is not None:
+            request.headers['User-Agent'] = user_agent
+        if preferred_view is not None:
+            request.cookies['preferred-view'] = preferred_view
+        return request
+
+    def test_detect_mobile(self):
+        from babytracker.utils import detect_mobile
+
+        iphone = 'Mozilla/5.0 (iPhone; CPU iPhone OS 5_0 like Mac OS X) AppleWebKit/534.46 (KHTML, like Gecko) Version/5.1 Mobile/9A334 Safari/7534.48.3'
+        chrome = 'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/535.7 (KHTML, like Gecko) Chrome/16.0.912.75 Safari/535.7'
+
+        self.assertTrue(detect_mobile(self._make_request(iphone)))
+        self.assertTrue(detect_mobile(self._make_request(iphone)))
+        self.assertFalse(detect_mobile(self._make_request(chrome)))
+        self.assertFalse(detect_mobile(self._make_request()))
+
+        self.assertFalse(detect_mobile(self._make_request(iphone, 'desktop')))
+        self.assertTrue(detect_mobile(self._make_request(chrome, 'mobile')))
+
+    def test_is_mobile_user_agent(self):
+        from babytracker.utils import is_mobile_user_agent
+
+        # Patterns with a slash, which only matched a literal backslash
+        self.assertTrue(is_mobile_user_agent('Mozilla/5.0 (SAMSUNG; SAMSUNG-GT-S8500/S8500XXJL2; U; Bada/1.2; en-gb)'))
+        self.assertTrue(is_mobile_user_agent('UP.Browser/6.2.3.3.c.1.101 (GUI) MMP/2.0'))
+
+        # Matched on the first four characters only
+        self.assertTrue(is_mobile_user_agent('SIE-S65/25'))
+        self.assertFalse(is_mobile_user_agent('Mozilla/5.0 (compatible; acs-crawler)'))
+
+class TestAssets(unittest.TestCase):
+
+    def setUp(self):
+        import os
+        import tempfile
+
+        self.config = testing.setUp()
+        self.config.add_route('static', '/static/*subpath')
+
+        self.static_dir = tempfile.mkdtemp()
+        self.output_dir = tempfile.mkdtemp()
+
+        os.makedirs(os.path.join(self.static_dir, 'mobile'))
+        os.makedirs(os.path.join(self.static_dir, 'images'))
+        files = {
+            'client.js': 'var client = {};\n' * 100,
+            'images/icon.png': '\x89PNG fake image',
+            'style.css': '.icon { background: url("images/icon.png"); }\n' * 10,
+            'mobile/index.html': '<link href="../style.css" /><script src="../client.js?v=1"></script>'
+                                 '<a href="http://example.org/client.js">x</a>',
+        }
+        for path, data in files.items():
+            with open(os.path.join(self.static_dir, *path.split('/')), 'wb') as f:
+                f.write(data)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.static_dir)
+        shutil.rmtree(self.output_dir)
+        testing.tearDown()
+
+    def _read(self, path):
+        import os
+        with open(os.path.join(self.output_dir, *path.split('/')), 'rb') as f:
+            return f.read()
+
+    def _get(self, path, **headers):
+        from pyramid.request import Request
+        from babytracker.assets import StaticAssets, load_manifest
+
+        view = StaticAssets(self.output_dir, load_manifest(self.output_dir))
+        request = Request.blank('/static/' + path, headers=headers)
+        request.matchdict = {'subpath': tuple(path.split('/'))}
+        return view(None, request)
+
+    def test_build_assets(self):
+        import os
+        import gzip
+        from babytracker.assets import build_assets, load_manifest
+
+        self.assertEqual(load_manifest(self.output_dir), None)
+
+        manifest = build_assets(self.static_dir, self.output_dir)
+        self.assertEqual(load_manifest(self.output_dir), manifest)
+        self.assertEqual(sorted(manifest.keys()), ['client.js', 'images/icon.png', 'style.css'])
+        self.assertTrue(manifest['client.js'].startswith('client.'))
+        self.assertTrue(manifest['client.js'].endswith('.js'))
+
+        # Originals are kept so relative references still work
+        self.assertEqual(self._read('client.js'), self._read(manifest['client.js']))
+
+        # References point at fingerprinted names
+        self.assertTrue(os.path.basename(manifest['images/icon.png']) in self._read(manifest['style.css']))
+        page = self._read('mobile/index.html')
+        self.assertTrue('href="../%s"' % manifest['style.css'] in page)
+        self.assertTrue('src="../%s?v=1"' % manifest['client.js'] in page)
+        self.assertTrue('href="http://example.org/client.js"' in page)
+
+        # Compressed variants of text only
+        f = gzip.open(os.path.join(self.output_dir, manifest['client.js'] + '.gz'))
+        self.assertEqual(f.read(), self._read('client.js'))
+        f.close()
+        self.assertFalse(os.path.exists(os.path.join(self.output_dir, manifest['images/icon.png'] + '.gz')))
+
+        # A changed asset gets a new name
+        with open(os.path.join(self.static_dir, 'client.js'), 'wb') as f:
+            f.write('var client = {version: 2};')
+        self.assertNotEqual(build_assets(self.static_dir, self.output_dir)['client.js'], manifest['client.js'])
+
+    def test_serve_assets(self):
+        from pyramid.httpexceptions import HTTPNotFound
+        from babytracker.assets import build_assets
+
+        manifest = build_assets(self.static_dir, self.output_dir)
+
+        response = self._get(manifest['client.js'], **{'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(response.content_encoding, 'gzip')
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        self.assertTrue(response.content_type.endswith('/javascript'))
+        self.assertEqual(response.headers['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertEqual(''.join(response.app_iter), self._read(manifest['client.js'] + '.gz'))
+
+        response = self._get(manifest['client.js'], **{'Accept-Encoding': 'gzip;q=0'})
+        self.assertEqual(response.content_encoding, None)
+        self.assertEqual(''.join(response.app_iter), self._read('client.js'))
+
+        response = self._get('mobile/index.html')
+        self.assertEqual(response.content_encoding, None)
+        self.assertEqual(response.headers['Cache-Control'], 'max-age=3600')
+
+        response = self._get(manifest['images/icon.png'], **{'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.content_encoding, None)
+        self.assertFalse('Vary' in response.headers)
+
+        for path in ('../client.js', 'missing.js', 'manifest.json', 'mobile'):
+            self.assertRaises(HTTPNotFound, self._get, path)
+
+    def test_asset_url(self):
+        from babytracker.assets import asset_url
+
+        request = testing.DummyRequest()
+        request.registry.asset_manifest = {'images/icon.png': 'images/icon.0123456789ab.png'}
+        self.assertEqual(asset_url(request, 'images/icon.png'), 'http://example.com/static/images/icon.0123456789ab.png')
+        self.assertEqual(asset_url(request, 'other.js'), 'http://example.com/static/other.js')
+
+        del request.registry.asset_manifest
+        self.config.add_static_view('static', 'babytracker:static')
+        self.assertEqual(asset_url(request, 'client.js'), 'http://example.com/static/client.js')
+
+class TestDatabase(unittest.TestCase):
+
+    def setUp(self):
+        from babytracker.database import pool_metrics
+        pool_metrics.reset()
+
+    def _make_pool(self, connect, **kw):
+        from sqlalchemy import event
+        from babytracker.database import InstrumentedQueuePool
+        from babytracker.database import _ping, _count_checkout, _count_checkin
+
+        pool = InstrumentedQueuePool(connect, **kw)
+        event.listen(pool, 'checkout', _ping)
+        event.listen(pool, 'checkout', _count_checkout)
+        event.listen(pool, 'checkin', _count_checkin)
+        return pool
+
+    def test_pool_metrics(self):
+        import sqlite3
+        from sqlalchemy import exc
+        from babytracker.database import pool_metrics
+
+        pool = self._make_pool(lambda: sqlite3.connect(':memory:'), pool_size=1, max_overflow=1, timeout=0)
+
+        first = pool.connect()
+        second = pool.connect()
+        metrics = pool_metrics.snapshot(type('Engine', (object,), {'pool': pool}))
+        self.assertEqual(metrics['checkouts'], 2)
+        self.assertEqual(metrics['checked_out'], 2)
+        self.assertEqual(metrics['overflow'], 1)
+
+        self.assertRaises(exc.TimeoutError, pool.connect)
+        second.close()
+        first.close()
+
+        metrics = pool_metrics.snapshot()
+        self.assertEqual(metrics['timeouts'], 1)
+        self.assertEqual(metrics['checkins'], 2)
+        self.assertTrue(metrics['max_wait_time'] >= 0)
+        self.assertFalse('overflow' in metrics)
+
+    def test_ping_replaces_dead_connections(self):
+        import sqlite3
+        from babytracker.database import pool_metrics
+
+        connections = []
+        def connect():
+            connections.append(sqlite3.connect(':memory:'))
+            return connections[-1]
+
+        pool = self._make_pool(connect, pool_size=1, max_overflow=0)
+        pool.connect().close()
+
+        # The database went away
+        connections[0].close()
+
+        connection = pool.connect()
+        connection.cursor().execute("SELECT 1")
+        connection.close()
+
+        self.assertEqual(len(connections), 2)
+        self.assertEqual(pool_metrics.snapshot()['invalidations'], 1)
+
+class TestServer(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tempdir)
+
+    def _write_config(self, server):
+        import os
+        path = os.path.join(self.tempdir, 'test.ini')
+        with open(path, 'w') as f:
+            f.write('[app:main]\nuse = egg:Babytracker\n\n[server:main]\n' + server)
+        return path
+
+    def test_server_options(self):
+        from babytracker.scripts.serve import server_options, default_workers
+
+        options = server_options(self._write_config('use = egg:gunicorn#main\nhost = 127.0.0.1\nport = 8080\n'), {})
+        self.assertEqual(options['bind'], '127.0.0.1:8080')
+        self.assertEqual(options['workers'], str(default_workers()))
+        self.assertEqual(options['preload_app'], 'true')
+        self.assertFalse('use' in options)
+        self.assertFalse('here' in options)
+
+        options = server_options(self._write_config('port = 8080\nworkers = 3\nworker_class = gevent\n'), {'PORT': '5000'})
+        self.assertEqual(options['bind'], '0.0.0.0:5000')
+        self.assertEqual(options['workers'], '3')
+        self.assertEqual(options['worker_class'], 'gevent')
+
+    def test_gunicorn_config(self):
+        import os
+        try:
+            from gunicorn.config import Config
+        except ImportError:
+            self.skipTest("gunicorn is not installed")
+
+        from babytracker.scripts.serve import server_options, gunicorn_config, post_fork
+
+        here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        cfg = gunicorn_config(server_options(os.path.join(here, 'production.ini'), {'PORT': '5000'}))
+        self.assertTrue(isinstance(cfg, Config))
+        self.assertEqual(cfg.address, ('0.0.0.0', 5000))
+        self.assertEqual(cfg.settings['worker_class'].get(), 'sync')
+        self.assertEqual(cfg.preload_app, True)
+        self.assertEqual(cfg.timeout, 30)
+        self.assertTrue(cfg.post_fork is post_fork)
+
+        self.assertRaises(AttributeError, gunicorn_config, {'no_such_setting': '1'})
+
+    def test_post_fork(self):
+        from sqlalchemy import create_engine
+        from babytracker.models import DBSession
+        from babytracker.database import pool_metrics
+        from babytracker.scripts.serve import post_fork
+
+        engine = create_engine('sqlite://')
+        DBSession.configure(bind=engine)
+        try:
+            pool = engine.pool
+            pool_metrics.increment('checkouts')
+
+            post_fork(None, None)
+
+            self.assertFalse(engine.pool is pool)
+            self.assertEqual(pool_metrics.snapshot()['checkouts'], 0)
+        finally:
+            DBSession.remove()
+
+class TestEvents(unittest.TestCase):
+
+    def setUp(self):
+        from sqlalchemy import create_engine
+        from babytracker.models import DBSession, Base
+        engine = create_engine('sqlite://')
+        DBSession.configure(bind=engine)
+        Base.metadata.create_all(engine)
+
+    def tearDown(self):
+        from babytracker.models import DBSession
+        from babytracker.events import configure_events
+        DBSession.remove()
+        configure_events({})
+
+    def test_local_broker(self):
+        from babytracker.events import LocalBroker
+
+        broker = LocalBroker()
+        first = broker.subscribe('baby-1')
+        second = broker.subscribe('baby-1')
+        other = broker.subscribe('baby-2')
+        self.assertEqual(3, broker.subscriber_count())
+
+        broker.publish('baby-1', {'baby_id': 1})
+        self.assertEqual({'baby_id': 1}, first.get(0))
+        self.assertEqual({'baby_id': 1}, second.get(0))
+        self.assertEqual(None, first.get(0))
+        self.assertEqual(None, other.get(0))
+
+        first.close()
+        broker.publish('baby-1', {'baby_id': 1})
+        self.assertEqual(None, first.get(0))
+        self.assertEqual({'baby_id': 1}, second.get(0))
+        self.assertEqual(2, broker.subscriber_count())
+
+    def test_publish_changes_after_commit(self):
+        import transaction
+        from babytracker import events
+
+        events.configure_events({})
+        subscription = events.subscribe(1)
+
+        with transaction.manager:
+            events.publish_changes(1)
+            self.assertEqual(None, subscription.get(0))
+        self.assertEqual({'baby_id': 1}, subscription.get(0))
+
+        transaction.begin()
+        events.publish_changes(1)
+        transaction.abort()
+        self.assertEqual(None, subscription.get(0))
+
+    def test_polling_broker(self):
+        import datetime
+        import transaction
+        from babytracker import events
+        from babytracker.models import DBSession, User, Baby, Sleep
+
+        events.configure_events({
+            'events-broker': 'babytracker.events:PollingBroker',
+            'events-poll-interval': '60',
+        })
+        broker = events.broker
+        self.assertTrue(isinstance(broker, events.PollingBroker))
+
+        with transaction.manager:
+            session = DBSession()
+            baby = Baby(User(u'test@example.org', u'John Smith', 'secret'), datetime.date(2011,11,25), u"Jill Smith", 'f')
+            session.add(baby)
+            session.flush()
+            baby_id = baby.id
+
+        # Polls from the latest change when first subscribed to
+        subscription = events.subscribe(baby_id)
+        self.assertEqual(0, broker.poll())
+        self.assertEqual(None, subscription.get(0))
+
+        # Changes made by another worker, which publishes to its own broker
+        with transaction.manager:
+            session = DBSession()
+            session.add(Sleep(session.query(Baby).get(baby_id), datetime.datetime(2012, 1, 1, 13, 0, 0), datetime.timedelta(minutes=30)))
+
+        self.assertEqual(1, broker.poll())
+        message = subscription.get(0)
+        self.assertEqual(baby_id, message['baby_id'])
+        self.assertEqual(0, broker.poll())
+
+        subscription.close()
+
+class TestImporter(unittest.TestCase):
+
+    def setUp(self):
+        import datetime
+        import transaction
+        from sqlalchemy import create_engine
+        from babytracker.models import DBSession, Base, User, Baby
+        engine = create_engine('sqlite://')
+        DBSession.configure(bind=engine)
+        Base.metadata.create_all(engine)
+
+        with transaction.manager:
+            session = DBSession()
+            baby = Baby(User(u'test@example.org', u'John Smith', 'secret'), datetime.date(2011,11,25), u"Jill Smith", 'f')
+            session.add(baby)
+            session.flush()
+            self.baby_id = baby.id
+
+    def tearDown(self):
+        from babytracker.models import DBSession
+        DBSession.remove()
+
+    def test_parse_datetime(self):
+        import datetime
+        from babytracker.importer import parse_datetime
+
+        self.assertEqual(datetime.datetime(2012, 1, 1, 12, 21), parse_datetime('2012-01-01T12:21:00'))
+        self.assertEqual(datetime.datetime(2012, 1, 1, 12, 21), parse_datetime('2012-01-01 12:21'))
+        self.assertEqual(datetime.datetime(2012, 1, 1, 12, 21, 5, 500000), parse_datetime('2012-01-01T12:21:05.5'))
+
+        # Anything else goes through dateutil
+        self.assertEqual(datetime.datetime(2012, 1, 1, 12, 21), parse_datetime('2012-01-01T12:21:00+01:00'))
+        self.assertEqual(datetime.datetime(2012, 1, 1, 12, 21), parse_datetime('1 Jan 2012 12:21'))
+
+        self.assertRaises(ValueError, parse_datetime, 'notadate')
+        self.assertRaises(ValueError, parse_datetime, '2012-13-01T12:21:00')
+
+    def test_entry_parser(self):
+        import datetime
+        from babytracker.importer import EntryParser
+        from babytracker.models import Sleep, MixedFeed
+
+        parse = EntryParser()
+
+        factory, kwargs = parse({'entry_type': u'sleep', 'start': u'2012-01-01T12:00:00', 'end': u'',
+            'note': u'Nap', 'amount': u'', 'duration': u'45', 'url': u'/api/test@example.org/jack/1'})
+        self.assertTrue(factory is Sleep)
+        self.assertEqual({
+            'start': datetime.datetime(2012, 1, 1, 12, 0),
+            'end': None,
+            'note': u'Nap',
+            'duration': datetime.timedelta(minutes=45),
+        }, kwargs)
+
+        factory, kwargs = parse({'entry_type': 'mixed_feed', 'start': '2012-01-01T12:00:00', 'topup': 60, 'left_duration': 5})
+        self.assertTrue(factory is MixedFeed)
+        self.assertEqual((60, datetime.timedelta(minutes=5),), (kwargs['topup'], kwargs['left_duration'],))
+
+        for row, message in (
+            ({'start': '2012-01-01T12:00:00'}, "Row with 'entry_type' and 'start' expected"),
+            ({'entry_type': 'nap', 'start': '2012-01-01T12:00:00'}, "Unknown entry_type: nap"),
+            ({'entry_type': 'sleep', 'start': 'soon'}, "Invalid start date"),
+            ({'entry_type': 'sleep', 'start': '2012-01-01T12:00:00', 'end': 'later'}, "Invalid end date"),
+            ({'entry_type': 'sleep', 'start': '2012-01-01T12:00:00', 'duration': '5', 'amount': '100'}, "Unknown property amount of type sleep"),
+            ({'entry_type': 'sleep', 'start': '2012-01-01T12:00:00'}, "Missing property duration of type sleep"),
+            ({'entry_type': 'sleep', 'start': '2012-01-01T12:00:00', 'duration': 'long'},
+                "Incompatible property duration of type sleep: invalid literal for int() with base 10: 'long'"),
+        ):
+            try:
+                parse(row)
+            except ValueError, e:
+                self.assertEqual(message, e.args[0])
+            else:
+                self.fail(row)
+
+    def test_import_entries(self):
+        from cStringIO import StringIO
+        from babytracker.importer import import_entries
+        from babytracker.models import DBSession, Baby
+
+        data = '\xef\xbb\xbfentry_type,start,end,note,amount,duration\r\n'
+        for i in range(10):
+            data += 'bottle_feed,2012-01-%02dT12:00:00,,Caf\xc3\xa9 %d,%d,\r\n' % (i + 1, i, 100 + i,)
+        data += 'sleep,notadate,,,,30\r\n'
+        data += 'sleep,2012-01-20T12:00:00,,,,30\r\n'
+
+        progress = []
+        result = import_entries(self.baby_id, StringIO(data), 'csv', batch_size=4,
+            progress=lambda result: progress.append((result.offset, result.imported,)))
+
+        # Batches are committed as they fill up
+        self.assertEqual([(4, 4,), (8, 8,), (12, 11,)], progress)
+        self.assertEqual((12, 11, 1, [(11, 'Invalid start date',)],),
+            (result.offset, result.imported, result.error_count, result.errors,))
+        self.assertEqual(None, result.failed)
+
+        baby = DBSession().query(Baby).get(self.baby_id)
+        records = baby.list_entries_between(None, None)
+        self.assertEqual(11, len(records))
+        self.assertEqual(u'Caf\xe9 0', records[-1].note)
+        self.assertEqual(100, records[-1].amount)
+
+        # Daily summaries and changes are kept up to date
+        self.assertEqual(1, baby.get_daily_summary(records[0].start.date(), records[0].start.date())[0]['sleeps'])
+        self.assertEqual(12, len(baby.list_changes(0)))
+
+        # Resuming skips the rows already imported
+        result = import_entries(self.baby_id, StringIO(data), 'csv', offset=10)
+        self.assertEqual((12, 1,), (result.offset, result.imported,))
+
+    def test_import_entries_ndjson(self):
+        import json
+        from cStringIO import StringIO
+        from babytracker.importer import import_entries
+        from babytracker.models import DBSession, Baby
+
+        data = '\n'.join([
+            json.dumps({'entry_type': 'nappy_change', 'start': '2012-01-01T12:00:00', 'contents': 'wet'}),
+            '',
+            '[1, 2]',
+            '{"entry_type":',
+            json.dumps({'entry_type': 'breast_feed', 'start': '2012-01-01T13:00:00', 'left_duration': 10}),
+        ])
+
+        result = import_entries(self.baby_id, StringIO(data), 'ndjson')
+        self.assertEqual((4, 2,), (result.offset, result.imported,))
+        self.assertEqual([(2, 'JSON object expected',), (3, 'Invalid JSON',)], result.errors)
+
+        baby = DBSession().query(Baby).get(self.baby_id)
+        self.assertEqual([u'breast_feed', u'nappy_change'], [r.type for r in baby.list_entries_between(None, None)])
+
+    def test_import_entries_failure(self):
+        import transaction
+        from cStringIO import StringIO
+        from babytracker.importer import import_entries
+        from babytracker.models import DBSession, Baby
+
+        data = 'entry_type,start\r\n' + 'breast_feed,2012-01-01T12:00:00\r\n' * 5
+
+        def delete_baby(result):
+            with transaction.manager:
+                session = DBSession()
+                session.delete(session.query(Baby).get(self.baby_id))
+
+        result = import_entries(self.baby_id, StringIO(data), 'csv', batch_size=2, progress=delete_baby)
+        self.assertEqual((2, 2,), (result.offset, result.imported,))
+        self.assertEqual(u"Import failed at row 3: Baby not found", result.failed)
+        self.assertEqual(u"Import failed at row 3: Baby not found", result.to_json_dict()['error'])
+
+    def test_import_entries_own_transaction(self):
+        import transaction
+        from cStringIO import StringIO
+        from babytracker.importer import import_entries
+        from babytracker.models import DBSession, Baby, User
+
+        data = 'entry_type,start\r\n' + 'breast_feed,2012-01-01T12:00:00\r\n' * 3
+
+        # The caller's transaction, e.g. the request's, is neither committed
+        # nor aborted by the import
+        current = transaction.begin()
+        DBSession().add(User(u'other@example.org', u'Other', 'secret'))
+
+        result = import_entries(self.baby_id, StringIO(data), 'csv', batch_size=2)
+        self.assertEqual((3, 3,), (result.offset, result.imported,))
+        self.assertTrue(transaction.get() is current)
+        self.assertEqual(1, len(DBSession().new))
+
+        transaction.abort()
+        session = DBSession()
+        self.assertEqual(None, session.query(User).filter_by(email=u'other@example.org').first())
+        self.assertEqual(3, len(session.query(Baby).get(self.baby_id).entries))
+
+class TestAPIQueries(unittest.TestCase):
+    """Count the SQL statements issued for each API endpoint, going through
+    the full application including authentication and traversal.
+    """
+
+    def setUp(self):
+        import json
+        import datetime
+        import transaction
+        from webob import Request
+        from babytracker import main
+        from babytracker.models import DBSession, User, Baby
+        from babytracker.models import BreastFeed, BottleFeed, Sleep
+
+        settings = {
+            'sqlalchemy.url': 'sqlite://',
+            'pyramid.includes': 'pyramid_tm',
+        }
+        settings.update(TEST_SETTINGS)
+        self.app = main({}, **settings)
+        self.counter = StatementCounter(DBSession.bind)
+
+        with transaction.manager:
+            session = DBSession()
+            user = User(u'test@example.org', u'John Smith', 'secret')
+
+            for name in (u"Jill Smith", u"Bill Smith", u"Jack Smith"):
+                baby = Baby(user, datetime.date(2011,11,25), name, 'f')
+                session.add(baby)
+
+                for i in range(3):
+                    start = datetime.datetime(2012, 1, 1, 12, 0, 0) + datetime.timedelta(hours=i)
+                    session.add(BreastFeed(baby, start=start))
+                    session.add(BottleFeed(baby, start=start, amount=100))
+                    session.add(Sleep(baby, start=start, duration=datetime.timedelta(minutes=30)))
+
+            session.flush()
+            self.entry_id = baby.entries[0].id
+
+        request = Request.blank('/api/@@login', method='POST',
+            content_type='application/json',
+            body=json.dumps({'username': 'test@example.org', 'password': 'secret'}),
+        )
+        response = request.get_response(self.app)
+        self.cookie = '; '.join([
+            value.split(';')[0] for name, value in response.headerlist if name == 'Set-Cookie'
+        ])
+
+    def tearDown(self):
+        from babytracker.models import DBSession
+        DBSession.remove()
+
+    def _request(self, path, method='GET', body=None, headers=None, status=None):
+        import json
+        from webob import Request
+
+        request = Request.blank(path, method=method, headers={'Cookie': self.cookie})
+        request.headers.update(headers or {})
+        if body is not None:
+            request.content_type = 'application/json'
+            request.body = json.dumps(body)
+
+        with self.counter as counter:
+            response = request.get_response(self.app)
+
+        if status is None:
+            self.assertTrue(response.status_int < 400, response.status)
+        else:
+            self.assertEqual(status, response.status_int)
+        return response, counter.count
+
+    def _count(self, path, method='GET', body=None):
+        return self._request(path, method, body)[1]
+
+    def test_root(self):
+        self.assertEqual(1, self._count('/api/'))
+
+    def test_metrics_disabled(self):
+        self._request('/metrics', status=404)
+
+    def test_user(self):
+        self.assertEqual(1, self._count('/api/test@example.org'))
+
+    def test_baby(self):
+        self.assertEqual(1, self._count('/api/test@example.org/jack-smith'))
+
+    def test_baby_entries(self):
+        self.assertEqual(2, self._count('/api/test@example.org/jack-smith/@@entries'))
+
+    def test_user_entries(self):
+        import json
+
+        # The user with their babies, then one query for all the entries
+        response, count = self._request('/api/test@example.org/@@entries')
+        self.assertEqual(2, count)
+        etag = response.etag
+
+        data = json.loads(response.body)
+        self.assertEqual([u'Jill Smith', u'Bill Smith', u'Jack Smith'], [baby['name'] for baby in data])
+        self.assertEqual([9, 9, 9], [len(baby['entries']) for baby in data])
+        self.assertTrue(data[2]['entries'][0]['url'].startswith(data[2]['url'] + '/'))
+
+        response, count = self._request('/api/test@example.org/@@entries?baby=jack-smith&baby=jill-smith'
+            '&entry_type=sleep&start=2012-01-01T13:00:00')
+        data = json.loads(response.body)
+        self.assertEqual([u'Jill Smith', u'Jack Smith'], [baby['name'] for baby in data])
+        self.assertEqual([[u'sleep', u'sleep']] * 2, [[e['entry_type'] for e in baby['entries']] for baby in data])
+
+        self._request('/api/test@example.org/@@entries?baby=nobody', status=400)
+        self._request('/api/test@example.org/@@entries?start=notadate', status=400)
+
+        response, count = self._request('/api/test@example.org/@@entries', headers={'If-None-Match': '"%s"' % etag})
+        self.assertEqual(304, response.status_int)
+        self.assertEqual(1, count)
+
+    def test_changes(self):
+        import json
+
+        url = '/api/test@example.org/jack-smith/@@changes'
+        entry_url = '/api/test@example.org/jack-smith/%d' % self.entry_id
+
+        # Without since, only the current sequence number
+        response, count = self._request(url)
+        data = json.loads(response.body)
+        self.assertEqual([], data['changes'])
+        self.assertTrue(data['seq'] > 0)
+        since = data['seq']
+
+        response, count = self._request(url + '?since=0&limit=4')
+        data = json.loads(response.body)
+        self.assertEqual(4, len(data['changes']))
+        self.assertTrue(data['more'])
+        self.assertEqual('baby', data['changes'][0]['kind'])
+        self.assertEqual(u'Jack Smith', data['changes'][0]['baby']['name'])
+        self.assertEqual(data['changes'][-1]['seq'], data['seq'])
+
+        self.assertEqual([], json.loads(self._request(url + '?since=%d' % since)[0].body)['changes'])
+
+        self._request(entry_url, method='PUT', body={'note': u'Changed'})
+        self._request(entry_url, method='DELETE')
+
+        # The user with their babies, and the changes; there are no entries
+        # to load
+        response, count = self._request(url + '?since=%d' % since)
+        self.assertEqual(2, count)
+        data = json.loads(response.body)
+        self.assertFalse(data['more'])
+        self.assertEqual([{
+            'seq': data['seq'],
+            'kind': 'entry',
+            'id': self.entry_id,
+            'deleted': True,
+        }], data['changes'])
+
+        response, count = self._request(url + '?since=0')
+        data = json.loads(response.body)
+        self.assertEqual(10, len(data['changes']))
+        self.assertEqual(9, len([c for c in data['changes'] if 'url' in c]))
+        entry = [c for c in data['changes'] if c['kind'] == 'entry' and not c['deleted']][0]
+        self.assertEqual(entry['url'], entry['entry']['url'])
+
+        self._request(url + '?since=-1', status=400)
+        self._request(url + '?since=notanumber', status=400)
+        self._request(url + '?since=0&limit=0', status=400)
+        self._request(url + '?since=0&limit=1001', status=400)
+
+    def test_user_changes(self):
+        import json
+
+        url = '/api/test@example.org/@@changes'
+
+        data = json.loads(self._request(url + '?since=0')[0].body)
+        self.assertEqual([u'Jill Smith', u'Bill Smith', u'Jack Smith'],
+            [change['baby']['name'] for change in data['changes']])
+        self.assertEqual(['baby'] * 3, [change['kind'] for change in data['changes']])
+        since = json.loads(self._request(url)[0].body)['seq']
+        self.assertEqual(data['seq'], since)
+
+        jill_id = data['changes'][0]['id']
+        self._request('/api/test@example.org/jill-smith', method='DELETE')
+
+        data = json.loads(self._request(url + '?since=%d' % since)[0].body)
+        self.assertEqual([(jill_id, True,)], [(change['id'], change['deleted'],) for change in data['changes']])
+        self.assertFalse('url' in data['changes'][0])
+
+    def test_events(self):
+        import json
+        from babytracker import events
+
+        events.stream_timeout = 0.2
+        events.keepalive_interval = 0.1
+
+        url = '/api/test@example.org/jack-smith/@@events'
+        entry_url = '/api/test@example.org/jack-smith/%d' % self.entry_id
+
+        def parse(event):
+            lines = dict(line.split(': ', 1) for line in event.strip().split('\n'))
+            return int(lines['id']), json.loads(lines['data'])
+
+        response, count = self._request(url + '?since=0')
+        self.assertEqual('text/event-stream', response.content_type)
+        self.assertEqual('no-cache', response.headers['Cache-Control'])
+
+        stream = iter(response.app_iter)
+        self.assertEqual('retry: 3000\n\n', stream.next())
+
+        # Changes since the given sequence number first
+        backlog = [parse(stream.next()) for i in range(10)]
+        self.assertEqual(['baby'] + ['entry'] * 9, [data['kind'] for seq, data in backlog])
+        self.assertEqual([seq for seq, data in backlog], [data['seq'] for seq, data in backlog])
+        last_seq = backlog[-1][0]
+
+        # Then changes as they are committed
+        self._request(entry_url, method='PUT', body={'note': u'Changed'})
+        seq, data = parse(stream.next())
+        self.assertTrue(seq > last_seq)
+        self.assertEqual((self.entry_id, u'Changed',), (data['id'], data['entry']['note'],))
+
+        # Kept alive until the stream times out
+        self.assertEqual([': keepalive\n\n'], list(stream)[:1])
+        response.app_iter.close()
+        self.assertEqual(0, events.broker.subscriber_count())
+
+        # A reconnecting client resumes after the last event it saw
+        response, count = self._request(url, headers={'Last-Event-ID': str(last_seq)})
+        changes = [parse(event) for event in response.app_iter if event.startswith('id:')]
+        self.assertEqual([seq], [s for s, change in changes])
+
+        # Without either, only new changes
+        response, count = self._request(url)
+        self.assertEqual([], [event for event in response.app_iter if event.startswith('id:')])
+
+        self._request(url + '?since=notanumber', status=400)
+        self._request(url, headers={'Last-Event-ID': '-1'}, status=400)
+
+        # Turned off, e.g. under sync workers: clients poll @@changes instead
+        events.configure_events({'events-streams': 'false'})
+        try:
+            response, count = self._request(url, status=204)
+            self.assertEqual('', response.body)
+            self.assertEqual(0, events.broker.subscriber_count())
+        finally:
+            events.configure_events({})
+
+    def test_import(self):
+        import json
+        from webob import Request
+
+        def upload(url, body, content_type, status=None):
+            request = Request.blank(url, method='POST', headers={'Cookie': self.cookie})
+            request.content_type = content_type
+            request.body = body
+            response = request.get_response(self.app)
+            if status is not None:
+                self.assertEqual(status, response.status_int)
+            return response
+
+        # Round trip an export into another baby
+        exported = self._request('/api/test@example.org/jack-smith/@@export')[0].body
+        response = upload('/api/test@example.org/jill-smith/@@import', exported, 'text/csv', 200)
+        self.assertEqual({'offset': 9, 'imported': 9, 'error_count': 0, 'errors': []}, json.loads(response.body))
+
+        entries = json.loads(self._request('/api/test@example.org/jill-smith/@@entries')[0].body)
+        self.assertEqual(18, len(entries))
+        self.assertEqual(len(json.loads(self._request('/api/test@example.org/jill-smith/@@changes?since=0')[0].body)['changes']), 19)
+
+        exported = self._request('/api/test@example.org/jack-smith/@@export?format=ndjson')[0].body
+        response = upload('/api/test@example.org/bill-smith/@@import?offset=6', exported, 'application/x-ndjson', 200)
+        self.assertEqual((9, 3,), (json.loads(response.body)['offset'], json.loads(response.body)['imported'],))
+
+        response = upload('/api/test@example.org/bill-smith/@@import?format=csv', 'entry_type,start\r\nsleep,never\r\n',
+            'application/octet-stream', 200)
+        self.assertEqual([{'row': 1, 'error': 'Invalid start date'}], json.loads(response.body)['errors'])
+
+        upload('/api/test@example.org/bill-smith/@@import', exported, 'text/plain', 400)
+        upload('/api/test@example.org/bill-smith/@@import?offset=-1', exported, 'text/csv', 400)
+
+    def test_entry(self):
+        self.assertEqual(2, self._count('/api/test@example.org/jack-smith/%d' % self.entry_id))
+
+    def test_entry_edit(self):
+        # lookups, then UPDATEs of the entry and baby version, refreshing
+        # the daily summary and replacing the entry's change record
+        self.assertEqual(9, self._count('/api/test@example.org/jack-smith/%d' % self.entry_id,
+            method='PUT', body={'note': u'Changed'}))
+
+    def test_entry_edit_invalid_start(self):
+        import json
+
+        url = '/api/test@example.org/jack-smith/%d' % self.entry_id
+        for start in (None, 'notadate', 12):
+            self._request(url, method='PUT', body={'start': start}, status=400)
+
+        self.assertTrue(json.loads(self._request(url)[0].body)['start'])
+
+    def test_entry_edit_invalid_properties(self):
+        import json
+
+        url = '/api/test@example.org/jack-smith/%d' % self.entry_id
+        before = json.loads(self._request(url)[0].body)
+
+        for body in (
+            {'note': u'Changed', 'json_fields': 1},
+            {'note': u'Changed', 'to_json_dict': 1},
+            {'note': u'Changed', 'baby_id': 1},
+            {'note': u'Changed', 'amount': 1},
+            {'note': u'Changed', 'duration': 30},
+            {'note': u'Changed', 'left_duration': 'long'},
+            {'note': u'Changed', 'end': 12},
+        ):
+            response, count = self._request(url, method='PUT', body=body, status=400)
+            self.assertTrue('error' in json.loads(response.body))
+
+        # Nothing is changed by an invalid request
+        self.assertEqual(before, json.loads(self._request(url)[0].body))
+
+        # The entry's own JSON can be sent back with changes
+        data = json.loads(self._request(url, method='PUT', body=dict(before, left_duration=45, note=u'Changed'))[0].body)
+        self.assertEqual((45, u'Changed',), (data['left_duration'], data['note'],))
+
+    def test_conditional_get(self):
+        entries_url = '/api/test@example.org/jack-smith/@@entries'
+        entry_url = '/api/test@example.org/jack-smith/%d' % self.entry_id
+
+        for url in ('/api/', '/api/test@example.org', '/api/test@example.org/jack-smith', entries_url, entry_url):
+            response, count = self._request(url)
+            self.assertEqual(200, response.status_int)
+            self.assertTrue(response.etag)
+
+            response, count = self._request(url, headers={'If-None-Match': '"%s"' % response.etag})
+            self.assertEqual(304, response.status_int, url)
+            self.assertEqual('', response.body)
+
+        # Entries aren't loaded to answer a conditional request
+        response, count = self._request(entries_url)
+        etag = response.etag
+        response, count = self._request(entries_url, headers={'If-None-Match': '"%s"' % etag})
+        self.assertEqual(1, count)
+
+        # A different query is a different result
+        for url, other_url in (
+            (entries_url, entries_url + '?start=2030-01-01'),
+            (entries_url, entries_url + '?entry_type=sleep'),
+            (entries_url, entries_url + '?limit=2'),
+            ('/api/test@example.org/@@entries', '/api/test@example.org/@@entries?end=2000-01-01'),
+            ('/api/test@example.org/jack-smith/@@export', '/api/test@example.org/jack-smith/@@export?format=ndjson'),
+        ):
+            response, count = self._request(url)
+            response, count = self._request(other_url, headers={'If-None-Match': '"%s"' % response.etag})
+            self.assertEqual(200, response.status_int, other_url)
+
+            response, count = self._request(other_url, headers={'If-None-Match': '"%s"' % response.etag})
+            self.assertEqual(304, response.status_int, other_url)
+
+        other_etag = self._request('/api/test@example.org/jill-smith')[0].etag
+
+        # Changing an entry changes the baby's version
+        self._request(entry_url, method='PUT', body={'note': u'Changed'})
+
+        response, count = self._request(entries_url, headers={'If-None-Match': '"%s"' % etag})
+        self.assertEqual(200, response.status_int)
+        self.assertNotEqual(etag, response.etag)
+
+        # Other babies are not affected
+        self.assertEqual(other_etag, self._request('/api/test@example.org/jill-smith')[0].etag)
+
+    def test_if_modified_since(self):
+        import datetime
+
+        url = '/api/test@example.org/jack-smith'
+        response, count = self._request(url)
+        last_modified = response.last_modified
+        self.assertTrue(last_modified is not None)
+
+        response, count = self._request(url, headers={'If-Modified-Since': response.headers['Last-Modified']})
+        self.assertEqual(304, response.status_int)
+
+        earlier = last_modified - datetime.timedelta(seconds=1)
+        response, count = self._request(url, headers={'If-Modified-Since': earlier.strftime('%a, %d %b %Y %H:%M:%S GMT')})
+        self.assertEqual(200, response.status_int)
+
+    def test_bearer_token(self):
+        import json
+        import transaction
+        import datetime
+        from babytracker.models import DBSession, User, Baby
+
+        response, count = self._request('/api/@@login', method='POST',
+            body={'username': 'test@example.org', 'password': 'secret'})
+        token = json.loads(response.body)['token']
+
+        no_cookie = {'Cookie': ''}
+        with_token = {'Cookie': '', 'Authorization': 'Bearer %s' % token}
+
+        self._request('/api/test@example.org/jack-smith/@@entries', headers=no_cookie, status=403)
+
+        # The user is only loaded for traversal, not to check the token
+        response, count = self._request('/api/test@example.org/jack-smith/@@entries', headers=with_token)
+        self.assertEqual(2, count)
+
+        response, count = self._request('/api/', headers=with_token)
+        self.assertEqual(u'test@example.org', json.loads(response.body)['user']['email'])
+
+        self._request('/api/test@example.org/jack-smith/%d' % self.entry_id,
+            method='PUT', body={'note': u'Changed'}, headers=with_token)
+
+        # Tokens can't be used for babies added after they were issued
+        with transaction.manager:
+            session = DBSession()
+            user = session.query(User).filter_by(email=u'test@example.org').one()
+            session.add(Baby(user, datetime.date(2012,1,1), u"Jane Smith", 'f'))
+
+        self._request('/api/test@example.org/jane-smith', headers=with_token, status=403)
+        self._request('/api/test@example.org/jane-smith')
+
+        response, count = self._request('/api/test@example.org/@@entries', headers=with_token)
+        self.assertEqual(3, len(json.loads(response.body)))
+        response, count = self._request('/api/test@example.org/@@entries')
+        self.assertEqual(4, len(json.loads(response.body)))
+
+        # Nor for another user's baby which reuses the id of a deleted one
+        with transaction.manager:
+            session = DBSession()
+            baby = session.query(Baby).filter_by(slug=u'jill-smith').one()
+            baby_id = baby.id
+            session.delete(baby)
+            session.flush()
+
+            other = Baby(User(u'other@example.org', u'Other', 'secret'), datetime.date(2012,1,1), u"Jill Smith", 'f')
+            other.id = baby_id
+            session.add(other)
+
+        self._request('/api/other@example.org/jill-smith', headers=with_token, status=403)
+        self._request('/api/other@example.org/jill-smith/@@entries', headers=with_token, status=403)
+        self._request('/api/other@example.org/jill-smith', method='PUT', body={'name': u'Mine'},
+            headers=with_token, status=403)
+
+        # Tampered tokens are rejected
+        payload, signature = token.split('.')
+        self._request('/api/test@example.org', status=403, headers={
+            'Cookie': '', 'Authorization': 'Bearer %s.%s' % (payload, signature[::-1],)})
+
+        # Logging out revokes the token
+        self._request('/api/@@logout', method='POST', headers=with_token)
+        self._request('/api/test@example.org', headers=with_token, status=403)
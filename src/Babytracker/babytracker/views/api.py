@@ -1,13 +1,31 @@
+import csv
+import time
+import inspect
+import logging
+import base64
+import hashlib
 import urllib
 import dateutil.parser
 import datetime
+import transaction
+
+from cStringIO import StringIO
+
+from webob.etag import ETagMatcher
+from webob.datetime_utils import parse_date
 
 from pyramid.view import view_config, view_defaults
 from pyramid.traversal import resource_path
-from pyramid.security import remember, forget, authenticated_userid
+from pyramid.security import remember, forget, authenticated_userid, has_permission
 
 from babytracker.interfaces import VIEW_PERMISSION, EDIT_PERMISSION
+from babytracker.renderers import dumps
+from babytracker.security import issue_token, revoke_token
 from babytracker import models
+from babytracker import events
+from babytracker import importer
+
+log = logging.getLogger(__name__)
 
 def api_resource_url(context, request):
     return request.current_route_url(traverse=urllib.unquote(resource_path(context)[1:]))
@@ -28,6 +46,445 @@ def entry_json(entry, request):
     data['url'] = api_resource_url(entry, request)
     return data
 
+class EntrySerializer(object):
+    """Turns many entries of one baby into the same JSON data as
+    ``entry_json()``, for listings. The URL of the baby is only worked out
+    once, and the ``json_fields`` of each entry type are looked up once.
+    Works with ``Entry`` objects and ``EntryRecord`` tuples.
+    """
+
+    def __init__(self, baby, request):
+        self.prefix = api_resource_url(baby, request) + '/'
+        self.fields = {}
+
+    def __call__(self, entry):
+        fields = self.fields.get(entry.type)
+        if fields is None:
+            fields = self.fields[entry.type] = models.lookup_entry_type(entry.type, models.Entry).json_fields
+
+        data = {'entry_type': entry.type, 'url': self.prefix + str(entry.id)}
+        for name, convert in fields:
+            value = getattr(entry, name)
+            data[name] = convert(value) if convert is not None else value
+        return data
+
+# Conditional requests. ETags are derived from the version numbers of the
+# babies a resource depends on, and from the parsed query parameters of
+# listings, so they can be checked before anything is serialised.
+
+def resource_etag(*key):
+    return hashlib.md5(repr(key)).hexdigest()
+
+def filters_key(start_date, end_date, entry_class):
+    """The filters parsed by ``entry_filters()``, for an ETag key"""
+    return (start_date, end_date, entry_class.__name__ if entry_class is not None else None,)
+
+def user_etag(user):
+    return resource_etag('user', user.email, user.name,
+        [(baby.id, baby.version,) for baby in user.babies])
+
+def baby_etag(baby, name='baby', *params):
+    return resource_etag(name, baby.id, baby.version, *params)
+
+def not_modified(request, etag, last_modified=None):
+    """Set the ``ETag`` and ``Last-Modified`` headers of the response.
+    Returns the response with a 304 status if the client's copy is current,
+    or ``None`` if the view should render a full response.
+    """
+    response = request.response
+    response.etag = etag
+    if last_modified is not None:
+        last_modified = last_modified.replace(microsecond=0)
+        response.last_modified = last_modified
+
+    if_none_match = request.headers.get('If-None-Match')
+    if_modified_since = request.headers.get('If-Modified-Since')
+
+    current = False
+    if if_none_match:
+        current = etag in ETagMatcher.parse(if_none_match, strong=False)
+    elif last_modified is not None and if_modified_since:
+        since = parse_date(if_modified_since)
+        current = since is not None and last_modified <= since.replace(tzinfo=None)
+
+    if current:
+        response.status_int = 304
+        return response
+    return None
+
+def entry_filters(params):
+    """Parse the ``start``, ``end`` and ``entry_type`` parameters of an
+    entry listing into a ``(start, end, entry_class)`` tuple, any of which
+    may be ``None``. Raises ``ValueError`` with a message suitable for
+    returning to the client if a parameter is invalid.
+    """
+    start_date = None
+    end_date = None
+    entry_class = None
+
+    start = params.get('start', None)
+    end = params.get('end', None)
+    entry_type = params.get('entry_type', None)
+
+    if start is not None:
+        try:
+            # XXX: This is not very nice - we strip timezone to make naive dates
+            start_date = dateutil.parser.parse(start).replace(tzinfo=None)
+        except ValueError:
+            raise ValueError("Invalid start date")
+
+    if end is not None:
+        try:
+            # XXX: This is not very nice - we strip timezone to make naive dates
+            end_date = dateutil.parser.parse(end).replace(tzinfo=None)
+        except ValueError:
+            raise ValueError("Invalid end date")
+
+    if entry_type is not None:
+        entry_class = models.lookup_entry_type(entry_type)
+        if entry_class is None:
+            raise ValueError(u"Unknown entry_type: %s" % entry_type)
+
+    return (start_date, end_date, entry_class,)
+
+# Pagination of entry listings is done on the ``(start, id)`` key rather than
+# with offsets, so each page costs the same regardless of how deep into a
+# baby's history it is. Cursors are opaque to clients.
+
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 500
+
+def encode_cursor(entry):
+    """The cursor of an entry in a listing. Listings leave out entries
+    without a start, so there always is one.
+    """
+    key = "%s|%d" % (entry.start.isoformat(), entry.id,)
+    return base64.urlsafe_b64encode(key)
+
+def decode_cursor(cursor):
+    """Turn a cursor into a ``(start, id)`` tuple. Raises ``ValueError``
+    if the cursor is not valid.
+    """
+    try:
+        start, entry_id = base64.urlsafe_b64decode(str(cursor)).split('|', 1)
+        return (dateutil.parser.parse(start), int(entry_id),)
+    except (TypeError, ValueError, UnicodeEncodeError,):
+        raise ValueError("Invalid cursor")
+
+def iter_entry_batches(baby_id, start, end, entry_type, after=None, limit=None):
+    """Generator of the baby's entries as lists of ``EntryRecord`` tuples,
+    most recent first, for producing a response ``app_iter``.
+
+    The body is produced after ``pyramid_tm`` has committed the request's
+    transaction, so each batch is read in its own short transaction using
+    keyset pagination. Only one batch of entries is held in memory at a time.
+    """
+
+    count = 0
+    while limit is None or count < limit:
+        batch_size = STREAM_BATCH_SIZE
+        if limit is not None:
+            batch_size = min(batch_size, limit - count)
+
+        with transaction.manager:
+            session = models.DBSession()
+            baby = session.query(models.Baby).get(baby_id)
+            if baby is None:
+                return
+            entries = baby.list_entries_between(
+                start=start,
+                end=end,
+                entry_type=entry_type,
+                after=after,
+                limit=batch_size,
+            )
+
+        if entries:
+            after = (entries[-1].start, entries[-1].id,)
+            yield entries
+
+        count += len(entries)
+        if len(entries) < batch_size:
+            break
+
+def stream_entries_json(baby_id, serializer, start, end, entry_type, after=None, limit=None):
+    """Generator for a JSON list of entries, suitable for use as a
+    response ``app_iter``. ``serializer`` is an ``EntrySerializer``.
+    """
+
+    yield '['
+
+    separator = ''
+    for entries in iter_entry_batches(baby_id, start, end, entry_type, after, limit):
+        yield separator + ','.join([dumps(serializer(entry)) for entry in entries])
+        separator = ','
+
+    yield ']'
+
+def export_columns():
+    """CSV columns for entries of every type: ``entry_type``, then the
+    ``json_fields`` of each type, in order of first appearance.
+    """
+    columns = ['entry_type']
+    for name, convert in models.Entry.json_fields:
+        columns.append(name)
+    for entry_type in models.entry_type_names():
+        for name, convert in models.lookup_entry_type(entry_type).json_fields:
+            if name not in columns:
+                columns.append(name)
+    return columns
+
+def stream_entries_csv(baby_id, serializer, start, end, entry_type):
+    """Generator for the baby's entries as CSV, with a header row, suitable
+    for use as a response ``app_iter``. Fields an entry type does not have
+    are left empty.
+    """
+
+    columns = export_columns()
+    buf = StringIO()
+    writer = csv.writer(buf)
+
+    writer.writerow(columns)
+    for entries in iter_entry_batches(baby_id, start, end, entry_type):
+        for entry in entries:
+            data = serializer(entry)
+            row = []
+            for name in columns:
+                value = data.get(name)
+                if value is None:
+                    value = ''
+                elif isinstance(value, unicode):
+                    value = value.encode('utf-8')
+                row.append(value)
+            writer.writerow(row)
+
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+
+    if buf.tell():
+        yield buf.getvalue()
+
+def stream_entries_ndjson(baby_id, serializer, start, end, entry_type):
+    """Generator for the baby's entries as newline-delimited JSON, one entry
+    per line as for ``entry_json()``, suitable for use as a response
+    ``app_iter``.
+    """
+
+    for entries in iter_entry_batches(baby_id, start, end, entry_type):
+        yield ''.join([dumps(serializer(entry)) + '\n' for entry in entries])
+
+EXPORT_FORMATS = {
+    'csv': ('text/csv', stream_entries_csv,),
+    'ndjson': ('application/x-ndjson', stream_entries_ndjson,),
+}
+
+def changes_params(params):
+    """Parse the ``since`` and ``limit`` parameters of a changes feed into
+    a ``(since, limit)`` tuple. ``since`` is ``None`` if not given. Raises
+    ``ValueError`` with a message suitable for returning to the client if
+    a parameter is invalid.
+    """
+    since = params.get('since', None)
+    limit = params.get('limit', None)
+
+    if since is not None:
+        try:
+            since = int(since)
+        except ValueError:
+            raise ValueError("Invalid since")
+        if since < 0:
+            raise ValueError("since must not be negative")
+
+    if limit is None:
+        limit = MAX_PAGE_SIZE
+    else:
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise ValueError("Invalid limit")
+        if limit < 1 or limit > MAX_PAGE_SIZE:
+            raise ValueError("limit must be between 1 and %d" % MAX_PAGE_SIZE)
+
+    return (since, limit,)
+
+def changes_json(changes, limit, since, json_for):
+    """The body of a changes feed. ``changes`` is a list of up to
+    ``limit + 1`` ``ChangeRecord`` tuples, and ``json_for(change)`` returns
+    a dict of the URL and current data of a change which is not a deletion,
+    or ``None`` if the object no longer exists.
+    """
+    more = len(changes) > limit
+    changes = changes[:limit]
+
+    result = []
+    for change in changes:
+        data = {
+            'seq': change.seq,
+            'kind': change.kind,
+            'id': change.object_id,
+            'deleted': bool(change.deleted),
+        }
+        if not change.deleted:
+            current = json_for(change)
+            if current is None:
+                data['deleted'] = True
+            else:
+                data.update(current)
+        result.append(data)
+
+    return {
+        'seq': changes[-1].seq if changes else since,
+        'more': more,
+        'changes': result,
+    }
+
+def baby_changes_json(baby, request, since, limit):
+    """The changes feed of ``baby`` after ``since``, with the current data
+    of the baby and of its entries which still exist, loaded in one query.
+    """
+    changes = baby.list_changes(since, limit + 1)
+
+    serializer = EntrySerializer(baby, request)
+    records = baby.get_entry_records([
+        change.object_id for change in changes[:limit] if change.kind == 'entry' and not change.deleted
+    ])
+
+    def json_for(change):
+        if change.kind == 'baby':
+            data = baby_json(baby, request)
+            return {'url': data['url'], 'baby': data}
+
+        record = records.get(change.object_id)
+        if record is None:
+            return None
+        data = serializer(record)
+        return {'url': data['url'], 'entry': data}
+
+    return changes_json(changes, limit, since, json_for)
+
+def stream_change_events(baby_id, request, since, subscription, timeout, keepalive):
+    """Generator for a ``text/event-stream`` of changes to a baby after
+    ``since``, suitable for use as a response ``app_iter``. Each event is
+    one item of the baby's changes feed, with its sequence number as the
+    event id, so that a reconnecting client resumes after the last one it
+    saw. ``subscription`` is the baby's channel, subscribed to before
+    ``since`` was read so that no change is missed.
+
+    Like ``stream_entries_json()``, each read is in its own short
+    transaction. The stream ends after ``timeout`` seconds, or when the
+    baby is deleted, and sends a comment every ``keepalive`` seconds while
+    idle.
+    """
+
+    try:
+        yield 'retry: 3000\n\n'
+
+        deadline = time.time() + timeout
+        pending = True
+        while True:
+            while pending:
+                with transaction.manager:
+                    baby = models.DBSession().query(models.Baby).get(baby_id)
+                    if baby is None:
+                        return
+                    data = baby_changes_json(baby, request, since, MAX_PAGE_SIZE)
+
+                for change in data['changes']:
+                    yield 'id: %d\ndata: %s\n\n' % (change['seq'], dumps(change),)
+                since = data['seq']
+                pending = data['more']
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+
+            if subscription.get(min(keepalive, remaining)) is None:
+                yield ': keepalive\n\n'
+            else:
+                pending = True
+    finally:
+        subscription.close()
+        models.DBSession.remove()
+
+MAX_BATCH_SIZE = 1000
+
+IMPORT_CONTENT_TYPES = {
+    'text/csv': 'csv',
+    'application/x-ndjson': 'ndjson',
+    'application/ndjson': 'ndjson',
+}
+
+def entry_property_from_json(factory, entry_type, key, value):
+    """Convert the JSON value of a property of the entry type other than
+    start, end and note to the type of its column. Raises ``ValueError``
+    with a message suitable for returning to the client if the entry type
+    has no such property or the value is invalid.
+    """
+
+    if key not in [name for name, convert in factory.json_fields]:
+        raise ValueError(u"Unknown property %s of type %s" % (key, entry_type,))
+
+    try:
+        type_ = getattr(factory, key).property.columns[0].type.python_type
+        if type_ is datetime.timedelta:
+            return datetime.timedelta(minutes=int(value or 0))
+        return type_(value)
+    except (TypeError, AttributeError, ValueError,), e:
+        raise ValueError(u"Incompatible property %s of type %s: %s" % (key, entry_type, str(e)))
+
+def entry_from_json(data, baby):
+    """Create a new entry for ``baby`` from a dict of JSON data, as posted
+    to the API. Raises ``ValueError`` with a message suitable for returning
+    to the client if the data is invalid.
+    """
+
+    entry_type = data.get('entry_type')
+    start = data.get('start')
+    end = data.get('end')
+    note = data.get('note')
+
+    start_date = end_date = None
+
+    if not entry_type or not start:
+        raise ValueError("JSON object with 'entry_type' and 'start' expected")
+
+    try:
+        # XXX: This is not very nice - we strip timezone to make naive dates
+        start_date = dateutil.parser.parse(start).replace(tzinfo=None)
+    except (AttributeError, ValueError,):
+        raise ValueError("Invalid start date")
+
+    if end:
+        try:
+            # XXX: This is not very nice - we strip timezone to make naive dates
+            end_date = dateutil.parser.parse(end).replace(tzinfo=None)
+        except (AttributeError, ValueError,):
+            raise ValueError("Invalid end date")
+
+    factory = models.lookup_entry_type(entry_type)
+    if factory is None:
+        raise ValueError(u"Unknown entry_type: %s" % entry_type)
+
+    kwargs = {
+        'baby': baby,
+        'start': start_date,
+        'end': end_date,
+        'note': note
+    }
+
+    for key, value in data.items():
+        if key not in kwargs and key not in ('entry_type', 'url',):
+            kwargs[key] = entry_property_from_json(factory, entry_type, key, value)
+
+    # Constructor arguments without defaults
+    args, varargs, varkw, defaults = inspect.getargspec(factory.__init__)
+    for name in args[1:len(args) - len(defaults or ())]:
+        if name not in kwargs:
+            raise ValueError(u"Missing property %s of type %s" % (name, entry_type,))
+
+    return factory(**kwargs)
+
 # We use this instead of raising exceptions because it allows us to easily
 # return JSON responses
 def error_json(code, message, request):
@@ -78,10 +535,18 @@ class RootAPI(object):
 
         if userid is not None:
             try:
-                user = user_json(self.request.context[userid], self.request)
+                user = self.request.context[userid]
             except KeyError:
                 pass
 
+        response = not_modified(self.request,
+            user_etag(user) if user is not None else resource_etag('root'))
+        if response is not None:
+            return response
+
+        if user is not None:
+            user = user_json(user, self.request)
+
         return {
             'login_url': prefix + '@@login',
             'logout_url': prefix + '@@logout',
@@ -115,9 +580,15 @@ class RootAPI(object):
                     'gender': 'f'                          // Baby gender
                 },
                 ...
-            ]
+            ],
+            'token': 'eyJ...'                // Bearer token
         }
 
+        As well as setting an authentication cookie, this returns a token
+        which can be sent instead in an 'Authorization: Bearer <token>'
+        header. It expires after a time and can only be used for the babies
+        listed, so log in again to use it with a baby added later.
+
         400 -> No username and/or no password
         401 -> Invalid credentials
         """
@@ -143,7 +614,13 @@ class RootAPI(object):
         headers = remember(self.request, user.__name__)
         self.request.response.headerlist.extend(headers)
 
-        return user_json(user, self.request)
+        data = user_json(user, self.request)
+
+        token = issue_token(self.request, user)
+        if token is not None:
+            data['token'] = token
+
+        return data
 
     @view_config(name='logout', request_method='OPTIONS')
     def logout_options(self):
@@ -159,8 +636,12 @@ class RootAPI(object):
         200 -> {
             'url' : '/api' // URL to home
         }
+
+        A bearer token used to make the request is revoked.
         """
 
+        revoke_token(self.request)
+
         headers = forget(self.request)
         self.request.response.headerlist.extend(headers)
 
@@ -200,12 +681,145 @@ class UserAPI(object):
             ]
         }
 
+        304 -> Not modified since the ETag given in If-None-Match
         400 -> Neither name, nor password supplied
         403 -> Not logged in or attempting to access another user's details
         """
 
+        response = not_modified(self.request, user_etag(self.request.context))
+        if response is not None:
+            return response
+
         return user_json(self.request.context, self.request)
 
+    @view_config(name='entries', request_method='OPTIONS')
+    def entries_options(self):
+        self.request.response.headers['Access-Control-Allow-Methods'] = 'GET'
+        return None
+
+    @view_config(name='entries', request_method='GET', permission=VIEW_PERMISSION)
+    def entries(self):
+        """Entries recorded for several of the user's babies, grouped by baby
+
+        GET /api/test@example.org/entries?start=2011-01-01T12:00:00&end=2011-01-07T12:00:00&baby=jill&baby=bill
+
+        start, end and entry_type work as for a baby's entries. baby selects
+        babies by the name in their URL, and may be given more than once;
+        by default all the user's babies are included. There is no paging,
+        so use a date range.
+
+        200 -> [
+            {
+                'url'   : '/api/test@example.org/jill' // Baby URL
+                'name'  : 'Jill',                      // Baby name
+                'dob'   : '2011-01-01',                // Baby date of birth
+                'gender': 'f',                         // Baby gender
+                'entries': [
+                    ...                                // As for /api/test@example.org/jill/entries
+                ]
+            },
+            ...
+        ]
+
+        304 -> No entries changed since the ETag given in If-None-Match, or
+               the date given in If-Modified-Since
+        400 -> Invalid date format or entry type, or unknown baby
+        403 -> Not logged in or attempting to access another user's details
+        """
+
+        try:
+            start_date, end_date, entry_class = entry_filters(self.request.GET)
+        except ValueError, e:
+            return error_json(400, e.args[0], self.request)
+
+        user = self.request.context
+
+        # Bearer tokens may only be used for some of the user's babies
+        babies = [baby for baby in user.babies if has_permission(VIEW_PERMISSION, baby, self.request)]
+
+        names = self.request.GET.getall('baby')
+        if names:
+            by_name = dict((baby.__name__, baby,) for baby in babies)
+            for name in names:
+                if name not in by_name:
+                    return error_json(400, u"Unknown baby: %s" % name, self.request)
+            babies = [baby for baby in babies if baby.__name__ in names]
+
+        modified = [baby.modified for baby in babies if baby.modified is not None]
+        response = not_modified(self.request,
+            resource_etag('entries', [(baby.id, baby.version,) for baby in babies],
+                filters_key(start_date, end_date, entry_class)),
+            max(modified) if modified else None,
+        )
+        if response is not None:
+            return response
+
+        entries = user.list_entries_between(babies, start_date, end_date, entry_class)
+
+        result = []
+        for baby in babies:
+            serializer = EntrySerializer(baby, self.request)
+            data = baby_json(baby, self.request)
+            data['entries'] = [serializer(entry) for entry in entries[baby.id]]
+            result.append(data)
+
+        return result
+
+    @view_config(name='changes', request_method='OPTIONS')
+    def changes_options(self):
+        self.request.response.headers['Access-Control-Allow-Methods'] = 'GET'
+        return None
+
+    @view_config(name='changes', request_method='GET', permission=VIEW_PERMISSION)
+    def changes(self):
+        """Babies added, changed or deleted since a sequence number
+
+        GET /api/test@example.org/changes?since=120&limit=100
+
+        Works like a baby's changes, for the user's babies. Use it to find
+        babies to add or remove, then get each baby's changes.
+
+        200 -> {
+            'seq': 135,
+            'more': false,
+            'changes': [
+                {
+                    'seq': 135,
+                    'kind': 'baby',
+                    'id': 2,
+                    'deleted': false,
+                    'url': '/api/test@example.org/jill', // If not deleted
+                    'baby': {...}                        // If not deleted, as for /api/test@example.org/jill
+                },
+                ...
+            ]
+        }
+
+        400 -> Invalid since or limit
+        403 -> Not logged in or attempting to access another user's details
+        """
+
+        try:
+            since, limit = changes_params(self.request.GET)
+        except ValueError, e:
+            return error_json(400, e.args[0], self.request)
+
+        user = self.request.context
+
+        if since is None:
+            return {'seq': user.last_baby_change(), 'more': False, 'changes': []}
+
+        babies = dict((baby.id, baby,) for baby in user.babies)
+
+        def json_for(change):
+            baby = babies.get(change.object_id)
+            if baby is None:
+                return None
+            data = baby_json(baby, self.request)
+            return {'url': data['url'], 'baby': data}
+
+        return changes_json(user.list_baby_changes(since, limit + 1), limit, since, json_for)
+
     @view_config(name='', request_method='PUT', permission=EDIT_PERMISSION)
     def edit(self):
         """Update the user
@@ -304,9 +918,8 @@ class UserAPI(object):
 
 
         normalized_name = models.Baby.normalize_name(name)
-        for baby in self.request.context.babies:
-            if baby.__name__ == normalized_name:
-                return error_json(409, u"Baby with name %s already exists" % name, self.request)
+        if self.request.context.find_baby(normalized_name) is not None:
+            return error_json(409, u"Baby with name %s already exists" % name, self.request)
 
         session = models.DBSession()
         baby = models.Baby(self.request.context, dob_date, name, gender)
@@ -340,26 +953,39 @@ class BabyAPI(object):
             'gender': 'f'                          // Baby gender
         }
 
+        304 -> Not modified since the ETag given in If-None-Match, or the
+               date given in If-Modified-Since
         403 -> Not authorised to view this baby
         """
 
-        return baby_json(self.request.context, self.request)
+        baby = self.request.context
+        response = not_modified(self.request, baby_etag(baby), baby.modified)
+        if response is not None:
+            return response
+
+        return baby_json(baby, self.request)
 
     @view_config(name='entries', request_method='OPTIONS')
     def entries_options(self):
-        self.request.response.headers['Access-Control-Allow-Methods'] = 'GET'
+        self.request.response.headers['Access-Control-Allow-Methods'] = 'GET POST'
         return None
 
     @view_config(name='entries', request_method='GET', permission=VIEW_PERMISSION)
     def entries(self):
         """Entries recorded for the baby
 
-        GET /api/test@example.org/jill/entries?start=2011-01-01T12:00:00&end=2011-01-01T12:00:00&entry_type=breast_feed
+        GET /api/test@example.org/jill/entries?start=2011-01-01T12:00:00&end=2011-01-01T12:00:00&entry_type=breast_feed&limit=100
 
         start and end contain ISO formatted dates or date-times to bound the
         returned list. entry_type limits to one type of entry only. All
         parameters are optional.
 
+        limit sets the maximum number of entries returned. If there are more,
+        a 'Link' header with rel="next" gives the URL of the next page, which
+        carries a 'cursor' parameter. Pass stream=1 to have the response
+        encoded incrementally rather than built in memory; this is
+        recommended for large ranges.
+
         200 -> [
             {
                 'url'   : '/api/test@example.org/jill/1', // Entry URL
@@ -379,7 +1005,285 @@ class BabyAPI(object):
             ...
         ]
 
-        400 -> Invalid date format
+        304 -> No entries changed since the ETag given in If-None-Match, or
+               the date given in If-Modified-Since
+        400 -> Invalid date format, entry type, limit or cursor
+        403 -> Not authorised to view information about this baby
+        """
+
+        after = None
+
+        limit = self.request.GET.get('limit', None)
+        cursor = self.request.GET.get('cursor', None)
+        stream = self.request.GET.get('stream', None)
+
+        try:
+            start_date, end_date, entry_class = entry_filters(self.request.GET)
+        except ValueError, e:
+            return error_json(400, e.args[0], self.request)
+
+        if limit is not None:
+            try:
+                limit = int(limit)
+            except ValueError:
+                return error_json(400, "Invalid limit", self.request)
+            if limit < 1 or limit > MAX_PAGE_SIZE:
+                return error_json(400, "limit must be between 1 and %d" % MAX_PAGE_SIZE, self.request)
+
+        if cursor is not None:
+            try:
+                after = decode_cursor(cursor)
+            except ValueError, e:
+                return error_json(400, str(e), self.request)
+
+        baby = self.request.context
+
+        response = not_modified(self.request,
+            baby_etag(baby, 'entries', filters_key(start_date, end_date, entry_class), after, limit, bool(stream)),
+            baby.modified,
+        )
+        if response is not None:
+            return response
+
+        if stream:
+            response = self.request.response
+            response.content_type = 'application/json'
+            response.app_iter = stream_entries_json(baby.id, EntrySerializer(baby, self.request),
+                start_date, end_date, entry_class,
+                after=after,
+                limit=limit,
+            )
+            return response
+
+        serializer = EntrySerializer(baby, self.request)
+
+        entries = baby.list_entries_between(
+            start=start_date,
+            end=end_date,
+            entry_type=entry_class,
+            after=after,
+            limit=limit + 1 if limit is not None else None,
+        )
+
+        if limit is not None and len(entries) > limit:
+            entries = entries[:limit]
+
+            params = [(k.encode('utf-8'), v.encode('utf-8'),)
+                        for k, v in self.request.GET.items() if k != 'cursor']
+            params.append(('cursor', encode_cursor(entries[-1]),))
+            next_url = "%s/@@entries?%s" % (api_resource_url(baby, self.request), urllib.urlencode(params),)
+
+            self.request.response.headers['Link'] = '<%s>; rel="next"' % next_url
+
+        return [serializer(entry) for entry in entries]
+
+    @view_config(name='export', request_method='OPTIONS')
+    def export_options(self):
+        self.request.response.headers['Access-Control-Allow-Methods'] = 'GET'
+        return None
+
+    @view_config(name='export', request_method='GET', permission=VIEW_PERMISSION)
+    def export(self):
+        """Download the baby's entries, most recent first
+
+        GET /api/test@example.org/jill/@@export?format=csv
+
+        format is 'csv' (the default) or 'ndjson'. start, end and
+        entry_type may be given to filter entries as for @@entries.
+
+        CSV has a header row, then one row per entry, with a column for
+        each field of any entry type:
+
+            entry_type,start,end,note,amount,left_duration,right_duration,topup,contents,duration
+            sleep,2012-01-01T12:21:00,2012-01-01T12:30:00,Note text,,,,,,9
+            ...
+
+        NDJSON has one JSON object per line, as for
+        /api/test@example.org/jill/1.
+
+        The body is streamed, however many entries there are.
+
+        200 -> text/csv or application/x-ndjson
+        304 -> Not modified since the ETag in If-None-Match
+        400 -> Invalid format or filters
+        403 -> Not authorised to view information about this baby
+        """
+
+        format = self.request.GET.get('format', 'csv')
+        if format not in EXPORT_FORMATS:
+            return error_json(400, "format must be 'csv' or 'ndjson'", self.request)
+
+        try:
+            start_date, end_date, entry_class = entry_filters(self.request.GET)
+        except ValueError, e:
+            return error_json(400, e.args[0], self.request)
+
+        baby = self.request.context
+
+        response = not_modified(self.request,
+            baby_etag(baby, 'export', format, filters_key(start_date, end_date, entry_class)),
+            baby.modified,
+        )
+        if response is not None:
+            return response
+
+        content_type, stream = EXPORT_FORMATS[format]
+
+        response = self.request.response
+        response.content_type = content_type
+        response.charset = 'utf-8'
+        response.headers['Content-Disposition'] = 'attachment; filename="%s.%s"' % (baby.slug, format,)
+        response.app_iter = stream(baby.id, EntrySerializer(baby, self.request),
+            start_date, end_date, entry_class)
+        return response
+
+    @view_config(name='changes', request_method='OPTIONS')
+    def changes_options(self):
+        self.request.response.headers['Access-Control-Allow-Methods'] = 'GET'
+        return None
+
+    @view_config(name='changes', request_method='GET', permission=VIEW_PERMISSION)
+    def changes(self):
+        """Changes to the baby and its entries since a sequence number
+
+        GET /api/test@example.org/jill/changes?since=120&limit=100
+
+        Each entry added, changed or deleted gets a new sequence number, and
+        only the latest change to each entry is listed. Without since, no
+        changes are returned, only the current sequence number: get it
+        before fetching the baby's entries, then pass the latest seq
+        returned as since to get what has changed since.
+
+        limit is the maximum number of changes returned, at most 1000. If
+        there are more, 'more' is true; ask again with the new seq.
+
+        200 -> {
+            'seq': 135,            // Latest sequence number returned
+            'more': false,         // Whether there are more changes
+            'changes': [
+                {
+                    'seq': 121,
+                    'kind': 'entry',   // Or 'baby'
+                    'id': 1,           // Id of the entry or baby
+                    'deleted': false,
+                    'url': '/api/test@example.org/jill/1', // If not deleted
+                    'entry': {...}                         // If not deleted, as for /api/test@example.org/jill/1
+                },
+                ...
+            ]
+        }
+
+        400 -> Invalid since or limit
+        403 -> Not authorised to view information about this baby
+        """
+
+        try:
+            since, limit = changes_params(self.request.GET)
+        except ValueError, e:
+            return error_json(400, e.args[0], self.request)
+
+        baby = self.request.context
+
+        if since is None:
+            return {'seq': baby.last_change(), 'more': False, 'changes': []}
+
+        return baby_changes_json(baby, self.request, since, limit)
+
+    @view_config(name='events', request_method='OPTIONS')
+    def events_options(self):
+        self.request.response.headers['Access-Control-Allow-Methods'] = 'GET'
+        return None
+
+    @view_config(name='events', request_method='GET', permission=VIEW_PERMISSION)
+    def events(self):
+        """Server-sent events for changes to the baby and its entries, as
+        they happen
+
+        GET /api/test@example.org/jill/@@events?since=120
+
+        Use with an EventSource. Each event is one change, as listed by
+        @@changes, with its sequence number as the event id:
+
+            id: 121
+            data: {"seq": 121, "kind": "entry", "id": 1, "deleted": false, "url": ..., "entry": {...}}
+
+        Changes after since are sent first, if given; otherwise, or when
+        reconnecting, those after the Last-Event-ID header. Without either,
+        only new changes are sent. The stream ends after a while, or when
+        the baby is deleted, and EventSource reconnects to carry on.
+
+        200 -> text/event-stream
+        204 -> Event streams are turned off: poll @@changes instead
+        400 -> Invalid since or Last-Event-ID
+        403 -> Not authorised to view information about this baby
+        """
+
+        if not events.streams_enabled:
+            # EventSource does not reconnect after a 204
+            self.request.response.status_int = 204
+            return self.request.response
+
+        since = self.request.headers.get('Last-Event-ID', None)
+        if since is None:
+            since = self.request.GET.get('since', None)
+
+        try:
+            since, limit = changes_params({'since': since})
+        except ValueError, e:
+            return error_json(400, e.args[0], self.request)
+
+        baby = self.request.context
+        subscription = events.subscribe(baby.id)
+
+        if since is None:
+            since = baby.last_change()
+
+        response = self.request.response
+        response.content_type = 'text/event-stream'
+        response.cache_control = 'no-cache'
+        # Stop nginx from buffering the stream
+        response.headers['X-Accel-Buffering'] = 'no'
+        response.app_iter = stream_change_events(baby.id, self.request, since, subscription,
+            timeout=events.stream_timeout,
+            keepalive=events.keepalive_interval,
+        )
+        return response
+
+    @view_config(name='summary', request_method='OPTIONS')
+    def summary_options(self):
+        self.request.response.headers['Access-Control-Allow-Methods'] = 'GET'
+        return None
+
+    @view_config(name='summary', request_method='GET', permission=VIEW_PERMISSION)
+    def summary(self):
+        """Totals of the entries recorded for the baby, per day or per hour
+
+        GET /api/test@example.org/jill/@@summary?start=2011-01-01T00:00:00&end=2011-01-07T23:59:59&period=day
+
+        start and end contain ISO formatted dates or date-times to bound the
+        summarised entries, and are optional. period is 'day' (the default)
+        or 'hour'. Periods without entries are omitted. Daily totals are
+        read from precalculated summaries and always cover whole days, so
+        only the date part of start and end is used.
+
+        200 -> [
+            {
+                'start': '2011-01-07',      // Day, or '2011-01-07T13:00:00' for hours
+                'feeds': 8,                 // Breast, bottle and mixed feeds
+                'left_duration': 60,        // Minutes, breast and mixed feeds
+                'right_duration': 55,       // Minutes, breast and mixed feeds
+                'bottle_amount': 240,       // ml, bottle feeds
+                'topup_amount': 120,        // ml, mixed feeds
+                'sleeps': 5,
+                'sleep_duration': 600,      // Minutes
+                'nappy_changes': 7,
+                'wet_nappies': 4,
+                'dirty_nappies': 3,
+            },
+            ...
+        ]
+
+        400 -> Invalid date format or period
         403 -> Not authorised to view information about this baby
         """
 
@@ -388,7 +1292,7 @@ class BabyAPI(object):
 
         start = self.request.GET.get('start', None)
         end = self.request.GET.get('end', None)
-        entry_type = self.request.GET.get('entry_type', None)
+        period = self.request.GET.get('period', 'day')
 
         if start is not None:
             try:
@@ -404,14 +1308,16 @@ class BabyAPI(object):
             except ValueError:
                 return error_json(400, "Invalid end date", self.request)
 
-        return [
-            entry_json(entry, self.request)
-            for entry in self.request.context.get_entries_between(
-                start=start_date,
-                end=end_date,
-                entry_type=entry_type,
+        if period not in ('day', 'hour',):
+            return error_json(400, "period must be 'day' or 'hour'", self.request)
+
+        if period == 'day':
+            return self.request.context.get_daily_summary(
+                start_date.date() if start_date is not None else None,
+                end_date.date() if end_date is not None else None,
             )
-        ]
+
+        return self.request.context.get_summary(start_date, end_date, period)
 
     @view_config(name='', request_method='PUT', permission=EDIT_PERMISSION)
     def edit(self):
@@ -464,11 +1370,10 @@ class BabyAPI(object):
                 return error_json(400, "Invalid dob date", self.request)
 
         baby = self.request.context
-        normalized_name = models.Baby.normalize_name(name)
-        baby_name = baby.__name__
 
-        for b in self.request.context.babies:
-            if b.__name__ != baby_name and b.__name__ == normalized_name:
+        if name:
+            existing = baby.user.find_baby(models.Baby.normalize_name(name))
+            if existing is not None and existing is not baby:
                 return error_json(409, u"Baby with name %s already exists" % name, self.request)
 
         if dob_date:
@@ -478,6 +1383,8 @@ class BabyAPI(object):
         if gender:
             baby.gender = gender
 
+        events.publish_changes(baby.id)
+
         return baby_json(baby, self.request)
 
     @view_config(name='', request_method='DELETE', permission=EDIT_PERMISSION)
@@ -505,6 +1412,8 @@ class BabyAPI(object):
         session.delete(baby)
         session.flush()
 
+        events.publish_changes(baby.id)
+
         return user_json(user, self.request)
 
     @view_config(name='', request_method='POST', permission=EDIT_PERMISSION)
@@ -554,61 +1463,167 @@ class BabyAPI(object):
         if not isinstance(body, dict):
             return error_json(400, "JSON object expected", self.request)
 
-        entry_type = body.get('entry_type')
-        start = body.get('start')
-        end = body.get('end')
-        note = body.get('note')
+        try:
+            entry = entry_from_json(body, self.request.context)
+        except ValueError, e:
+            return error_json(400, unicode(e), self.request)
+
+        session = models.DBSession()
+        session.add(entry)
+
+        events.publish_changes(self.request.context.id)
+
+        return entry_json(entry, self.request)
+
+    @view_config(name='entries', request_method='POST', permission=EDIT_PERMISSION)
+    def create_many(self):
+        """Create several entries at once, e.g. when a client that has been
+        offline synchronises.
+
+        POST /api/test@example.org/jill/@@entries
+        [
+            {
+                'entry_type': 'sleep',      // As for creating a single entry
+                'start': '2012-01-01 12:21:00',
+                ...
+            },
+            ...
+        ]
+
+        Valid entries are created even if others are invalid. The response
+        has one result per entry, in the same order:
 
-        start_date = end_date = None
+        200 -> [
+            {
+                'status': 201,
+                'entry': {
+                    'url'   : '/api/test@example.org/jill/1' // Entry URL
+                    'entry_type': 'sleep',
+                    ...
+                }
+            },
+            {
+                'status': 400,
+                'error': 'Invalid start date'
+            },
+            ...
+        ]
 
-        if not entry_type or not start:
-            return error_json(400, "JSON object with 'entry_type' and 'start' expected", self.request)
+        400 -> Not a list of entries, or too many entries
+        403 -> Not authorised to create entries for this baby
+        """
 
         try:
-            # XXX: This is not very nice - we strip timezone to make naive dates
-            start_date = dateutil.parser.parse(start).replace(tzinfo=None)
-        except ValueError:
-            return error_json(400, "Invalid start date", self.request)
+            body = self.request.json_body
+        except ValueError, e:
+            return error_json(400, str(e), self.request)
+
+        if not isinstance(body, list):
+            return error_json(400, "JSON list of entries expected", self.request)
+
+        if len(body) > MAX_BATCH_SIZE:
+            return error_json(400, "At most %d entries may be created at once" % MAX_BATCH_SIZE, self.request)
+
+        baby = self.request.context
+        results = []
+        entries = []
+
+        for item in body:
+            if not isinstance(item, dict):
+                results.append({'status': 400, 'error': "JSON object expected"})
+                continue
 
-        if end:
             try:
-                # XXX: This is not very nice - we strip timezone to make naive dates
-                end_date = dateutil.parser.parse(end).replace(tzinfo=None)
-            except ValueError:
-                return error_json(400, "Invalid end date", self.request)
+                entry = entry_from_json(item, baby)
+            except ValueError, e:
+                results.append({'status': 400, 'error': unicode(e)})
+                continue
+
+            results.append({'status': 201, 'entry': entry})
+            entries.append(entry)
+
+        # Write all entries in one flush, within the request's transaction
+        session = models.DBSession()
+        session.add_all(entries)
+        session.flush()
+
+        if entries:
+            events.publish_changes(baby.id)
+
+        for result in results:
+            if 'entry' in result:
+                result['entry'] = entry_json(result['entry'], self.request)
+
+        return results
+
+    @view_config(name='import', request_method='OPTIONS')
+    def import_options(self):
+        self.request.response.headers['Access-Control-Allow-Methods'] = 'POST'
+        return None
 
-        factory = models.lookup_entry_type(entry_type)
-        if factory is None:
-            return error_json(400, u"Unknown entry_type: %s" % entry_type, self.request)
+    @view_config(name='import', request_method='POST', permission=EDIT_PERMISSION)
+    def import_entries(self):
+        """Import a file of entries, e.g. when moving from another tracker
 
-        kwargs = {
-            'baby': self.request.context,
-            'start': start_date,
-            'end': end_date,
-            'note': note
+        POST /api/test@example.org/jill/@@import?offset=0
+        Content-Type: text/csv
+
+        entry_type,start,end,note,amount,left_duration,right_duration,topup,contents,duration
+        sleep,2012-01-01T12:21:00,2012-01-01T12:30:00,Note text,,,,,,9
+        ...
+
+        The body is CSV with a header row, as downloaded from @@export, or
+        newline-delimited JSON (Content-Type application/x-ndjson), with an
+        object per line as for creating a single entry. Pass format=csv or
+        format=ndjson to override the content type. Columns may be in any
+        order, and empty values are ignored.
+
+        The file is read as it is uploaded, and entries are created and
+        committed in batches. Invalid rows are skipped and reported. offset
+        is a number of rows to skip, for resuming an import which failed
+        part way through.
+
+        200 -> {
+            'offset': 5000,     // Rows dealt with, including those skipped
+            'imported': 4998,   // Entries created
+            'error_count': 2,   // Invalid rows
+            'errors': [         // The first 100 of them
+                {
+                    'row': 12,  // Counting from 1, not including the header
+                    'error': 'Invalid start date'
+                },
+                ...
+            ]
         }
 
-        for key, value in body.items():
-            if key not in kwargs and key != 'entry_type':
-                # Convert value to correct builtin type based on SQLAlchemy
-                # column spec
+        400 -> Unknown format or invalid offset
+        403 -> Not authorised to create entries for this baby
+        500 -> {'error': 'Import failed at row 4001: ...', 'offset': 4000, ...}
+               The entries before 'offset' were imported; import the
+               rest with that offset.
+        """
 
-                attr = getattr(factory, key, None)
-                if attr is None:
-                    return error_json(400, u"Unknown property %s of type %s" % (key, entry_type,), self.request)
+        format = self.request.GET.get('format') or IMPORT_CONTENT_TYPES.get(self.request.content_type)
+        if format not in importer.FORMATS:
+            return error_json(400, "Upload CSV or NDJSON, or give format=csv or format=ndjson", self.request)
 
-                try:
-                    value = attr.property.columns[0].type.python_type(value)
-                except (AttributeError, ValueError,), e:
-                    return error_json(400, u"Incompatible property %s of type %s: %s" % (key, entry_type, str(e)), self.request)
+        try:
+            offset = int(self.request.GET.get('offset', 0))
+        except ValueError:
+            return error_json(400, "Invalid offset", self.request)
+        if offset < 0:
+            return error_json(400, "offset must not be negative", self.request)
 
-                kwargs[key] = value
+        baby_id = self.request.context.id
 
-        session = models.DBSession()
-        entry = factory(**kwargs)
-        session.add(entry)
+        def progress(result):
+            log.info("Imported %d entries for baby %d, up to row %d", result.imported, baby_id, result.offset)
 
-        return entry_json(entry, self.request)
+        result = importer.import_entries(baby_id, self.request.body_file, format, offset, progress=progress)
+
+        if result.failed is not None:
+            self.request.response.status_int = 500
+        return result.to_json_dict()
 
 @view_defaults(context=models.Entry, route_name='api', renderer='json')
 class EntryAPI(object):
@@ -643,10 +1658,19 @@ class EntryAPI(object):
             'contents': 'wet',              // For 'dirty' or 'none', for 'nappy_change'
         }
 
+        304 -> Not modified since the ETag given in If-None-Match, or the
+               date given in If-Modified-Since
         403 -> Not authorised to view details about this entry
         """
 
-        return entry_json(self.request.context, self.request)
+        entry = self.request.context
+        baby = entry.baby
+        response = not_modified(self.request,
+            resource_etag('entry', entry.id, baby.id, baby.version), baby.modified)
+        if response is not None:
+            return response
+
+        return entry_json(entry, self.request)
 
     @view_config(name='', request_method='PUT', permission=EDIT_PERMISSION)
     def edit(self):
@@ -696,54 +1720,43 @@ class EntryAPI(object):
 
         entry = self.request.context
 
-        if 'start' in body:
-            start_date = None
-            if body['start'] is not None:
-                try:
-                    # XXX: This is not very nice - we strip timezone to make naive dates
-                    start_date = dateutil.parser.parse(body['start']).replace(tzinfo=None)
-                except ValueError:
-                    return error_json(400, "Invalid start date", self.request)
+        # Check everything before changing anything
+        changes = {}
 
-            entry.start = start_date
+        if 'start' in body:
+            # Entries are listed and paged by start, so it may not be removed
+            try:
+                # XXX: This is not very nice - we strip timezone to make naive dates
+                changes['start'] = dateutil.parser.parse(body['start']).replace(tzinfo=None)
+            except (AttributeError, TypeError, ValueError,):
+                return error_json(400, "Invalid start date", self.request)
 
         if 'end' in body:
-            end_date = None
+            changes['end'] = None
             if body['end'] is not None:
                 try:
                     # XXX: This is not very nice - we strip timezone to make naive dates
-                    end_date = dateutil.parser.parse(body['end']).replace(tzinfo=None)
-                except ValueError:
+                    changes['end'] = dateutil.parser.parse(body['end']).replace(tzinfo=None)
+                except (AttributeError, TypeError, ValueError,):
                     return error_json(400, "Invalid end date", self.request)
 
-            entry.end = end_date
-
         if 'note' in body:
             note = body['note']
             if note is not None and not isinstance(note, basestring):
                 return error_json(400, "Invalid note", self.request)
-            entry.note = note
+            changes['note'] = note
 
         for key, value in body.items():
-            if key not in ('id', 'type', 'start', 'end', 'note', 'baby', 'baby_id', 'url', 'entry_type',):
-                # Convert value to correct builtin type based on SQLAlchemy
-                # column spec
-
-                attr = getattr(entry.__class__, key, None)
-                if attr is None:
-                    return error_json(400, u"Unknown property %s of type %s" % (key, entry.type,), self.request)
-
-                type_ = attr.property.columns[0].type.python_type
-
+            if key not in ('start', 'end', 'note', 'url', 'entry_type',):
                 try:
-                    if type_ is datetime.timedelta:
-                        value = datetime.timedelta(minutes=int(value or 0))
-                    else:
-                        value = type_(value)
-                except (TypeError,AttributeError, ValueError,), e:
-                    return error_json(400, u"Incompatible property %s of type %s: %s" % (key, entry.type, str(e)), self.request)
+                    changes[key] = entry_property_from_json(entry.__class__, entry.type, key, value)
+                except ValueError, e:
+                    return error_json(400, unicode(e), self.request)
 
-                setattr(entry, key, value)
+        for key, value in changes.items():
+            setattr(entry, key, value)
+
+        events.publish_changes(entry.baby_id)
 
         return entry_json(entry, self.request)
 
@@ -770,4 +1783,6 @@ class EntryAPI(object):
         session.delete(entry)
         session.flush()
 
+        events.publish_changes(baby.id)
+
         return baby_json(baby, self.request)
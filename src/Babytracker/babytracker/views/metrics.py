@@ -0,0 +1,10 @@
+from babytracker.models import DBSession
+from babytracker.database import pool_metrics
+
+def metrics(request):
+    """Connection pool metrics, as JSON. Only registered when the
+    ``metrics`` setting is enabled.
+    """
+    return {
+        'pool': pool_metrics.snapshot(DBSession.bind),
+    }
@@ -54,6 +54,8 @@ class UserViews(object):
 
             if not baby_name:
                 errors['baby_name'] = u"Name is required"
+            elif user.find_baby(models.Baby.normalize_name(baby_name)) is not None:
+                errors['baby_name'] = u"You already have a baby with this name"
             if baby_gender not in ('m', 'f'):
                 errors['baby_gender'] = u"Invalid gender"
 
@@ -78,6 +80,10 @@ class UserViews(object):
 
             if not baby_name:
                 errors['edit_baby_name'] = u"Name is required"
+            else:
+                existing = user.find_baby(models.Baby.normalize_name(baby_name))
+                if existing is not None and existing.__name__ != baby_id:
+                    errors['edit_baby_name'] = u"You already have a baby with this name"
             if baby_gender not in ('m', 'f'):
                 errors['edit_baby_gender'] = u"Invalid gender"
 
@@ -89,12 +95,7 @@ class UserViews(object):
             if errors:
                 self.request.session.flash(u"Unable to edit baby. Please try again.", queue='error')
             else:
-                baby = None
-                for b in user.babies:
-                    if b.__name__ == baby_id:
-                        baby = b
-                        break
-
+                baby = user.find_baby(baby_id)
                 if baby is None:
                     self.request.session.flash(u"Baby not found. It may have been deleted already.", queue='error')
                 else:
@@ -113,12 +114,7 @@ class UserViews(object):
                 self.request.session.flash(u"Missing baby name - this should not happen", queue='error')
 
             else:
-                baby = None
-                for b in user.babies:
-                    if b.__name__ == baby_id:
-                        baby = b
-                        break
-
+                baby = user.find_baby(baby_id)
                 if baby is None:
                     self.request.session.flash(u"Baby not found. It may have been deleted already.", queue='error')
                 else:
@@ -0,0 +1,84 @@
+"""Benchmark the User-Agent matching done by
+``babytracker.utils.detect_mobile()`` over a corpus of real User-Agent
+strings.
+
+Requests are drawn from the corpus with a skewed distribution, since most
+traffic comes from a few browsers. Compares matching every request
+against the case-insensitive patterns, as ``detect_mobile()`` used to,
+with the cached, lower case matching it does now.
+
+Usage:
+
+    $venv/bin/python benchmarks/detect_mobile.py [requests]
+
+``requests`` defaults to 100,000.
+"""
+
+import re
+import sys
+import time
+import random
+
+from babytracker import utils
+
+USER_AGENTS = (
+    'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/535.7 (KHTML, like Gecko) Chrome/16.0.912.75 Safari/535.7',
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 5_0 like Mac OS X) AppleWebKit/534.46 (KHTML, like Gecko) Version/5.1 Mobile/9A334 Safari/7534.48.3',
+    'Mozilla/5.0 (Windows NT 6.1; WOW64; rv:9.0.1) Gecko/20100101 Firefox/9.0.1',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_7_2) AppleWebKit/534.52.7 (KHTML, like Gecko) Version/5.1.2 Safari/534.52.7',
+    'Mozilla/5.0 (Linux; U; Android 2.3.4; en-us; Nexus S Build/GRJ22) AppleWebKit/533.1 (KHTML, like Gecko) Version/4.0 Mobile Safari/533.1',
+    'Mozilla/5.0 (compatible; MSIE 9.0; Windows NT 6.1; WOW64; Trident/5.0)',
+    'Mozilla/5.0 (iPad; CPU OS 5_0_1 like Mac OS X) AppleWebKit/534.46 (KHTML, like Gecko) Version/5.1 Mobile/9A405 Safari/7534.48.3',
+    'Mozilla/4.0 (compatible; MSIE 8.0; Windows NT 5.1; Trident/4.0; .NET CLR 2.0.50727)',
+    'Mozilla/5.0 (Linux; U; Android 2.2; en-gb; GT-I9000 Build/FROYO) AppleWebKit/533.1 (KHTML, like Gecko) Version/4.0 Mobile Safari/533.1',
+    'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/535.7 (KHTML, like Gecko) Ubuntu/11.10 Chromium/16.0.912.63 Chrome/16.0.912.63 Safari/535.7',
+    'BlackBerry9700/5.0.0.862 Profile/MIDP-2.1 Configuration/CLDC-1.1 VendorID/167',
+    'Opera/9.80 (J2ME/MIDP; Opera Mini/4.2.14912/26.1069; U; en) Presto/2.5.25 Version/10.54',
+    'Mozilla/5.0 (compatible; MSIE 9.0; Windows Phone OS 7.5; Trident/5.0; IEMobile/9.0; NOKIA; Lumia 800)',
+    'Mozilla/5.0 (SymbianOS/9.4; Series60/5.0 NokiaN97-1/12.0.024; Profile/MIDP-2.1 Configuration/CLDC-1.1; en-us) AppleWebKit/525 (KHTML, like Gecko) BrowserNG/7.1.18124',
+    'Mozilla/5.0 (SAMSUNG; SAMSUNG-GT-S8500/S8500XXJL2; U; Bada/1.2; en-gb) AppleWebKit/533.1 (KHTML, like Gecko) Dolfin/2.2 Mobile WVGA SMM-MMS/1.2.0 OPN-B',
+    'Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)',
+)
+
+# The patterns as they were, matched case-insensitively on every request
+reg_b = re.compile(utils.reg_b.pattern, re.I|re.M)
+reg_v = re.compile(utils.reg_v.pattern, re.I|re.M)
+
+def uncached(user_agent):
+    return bool(reg_b.search(user_agent) or reg_v.search(user_agent[0:4]))
+
+def make_user_agents(num_requests):
+    random.seed(0)
+    weights = [1.0 / (i + 1) for i in range(len(USER_AGENTS))]
+    total = sum(weights)
+
+    user_agents = []
+    for i in xrange(num_requests):
+        r = random.random() * total
+        for user_agent, weight in zip(USER_AGENTS, weights):
+            r -= weight
+            if r <= 0:
+                break
+        user_agents.append(user_agent)
+    return user_agents
+
+def report(label, func, user_agents):
+    t = time.time()
+    for user_agent in user_agents:
+        func(user_agent)
+    elapsed = time.time() - t
+    print "%-20s %10.0f requests/s (%.2f us each)" % (label, len(user_agents) / elapsed, elapsed / len(user_agents) * 1000000)
+
+def main(argv=sys.argv):
+    num_requests = int(argv[1]) if len(argv) > 1 else 100000
+    user_agents = make_user_agents(num_requests)
+
+    for user_agent in USER_AGENTS:
+        assert uncached(user_agent) == utils.is_mobile_user_agent(user_agent), user_agent
+
+    report("Uncached", uncached, user_agents)
+    utils._mobile_user_agents.clear()
+    report("Cached", utils.is_mobile_user_agent, user_agents)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""Benchmark ``Baby.get_entries_between()`` against a large entries table.
+
+Builds a throwaway SQLite database with one baby holding ``num_entries``
+entries (one every few minutes, going back in time), then times a one-week
+range query with and without the composite indexes on ``entries``.
+
+Usage:
+
+    $venv/bin/python benchmarks/entries_query.py [num_entries]
+
+``num_entries`` defaults to 1,000,000. Building the database takes a while.
+"""
+
+import os
+import sys
+import time
+import shutil
+import datetime
+import tempfile
+import transaction
+
+from sqlalchemy import create_engine
+
+from babytracker.models import DBSession, User, Baby, Entry, upgrade_schema
+
+REPEAT = 20
+CHUNK_SIZE = 10000
+ENTRY_TYPES = ('breast_feed', 'bottle_feed', 'mixed_feed', 'sleep', 'nappy_change',)
+
+def populate(engine, num_entries):
+    with transaction.manager:
+        session = DBSession()
+        user = User(u'bench@example.org', u'Bench Mark', 'secret')
+        baby = Baby(user, datetime.date(2010, 1, 1), u"Bench", 'f')
+        session.add(baby)
+        session.flush()
+        baby_id = baby.id
+
+    now = datetime.datetime(2012, 1, 1)
+    table = Entry.__table__
+
+    for offset in xrange(0, num_entries, CHUNK_SIZE):
+        rows = []
+        for i in xrange(offset, min(offset + CHUNK_SIZE, num_entries)):
+            rows.append({
+                'baby_id': baby_id,
+                'type': ENTRY_TYPES[i % len(ENTRY_TYPES)],
+                'start': now - datetime.timedelta(minutes=7 * i),
+            })
+        engine.execute(table.insert(), rows)
+
+    return baby_id
+
+def time_query(baby_id, entry_type=None):
+    session = DBSession()
+    baby = session.query(Baby).get(baby_id)
+
+    end = datetime.datetime(2011, 6, 1)
+    start = end - datetime.timedelta(days=7)
+
+    timings = []
+    for i in range(REPEAT):
+        t = time.time()
+        count = len(baby.get_entries_between(start, end, entry_type=entry_type).all())
+        timings.append(time.time() - t)
+        session.expunge_all()
+        baby = session.query(Baby).get(baby_id)
+
+    timings.sort()
+    return count, timings[len(timings) // 2]
+
+def report(label, baby_id):
+    from babytracker.models import NappyChange
+
+    count, median = time_query(baby_id)
+    print "%-24s all types:    %5d rows, median %8.2f ms" % (label, count, median * 1000)
+    count, median = time_query(baby_id, NappyChange)
+    print "%-24s nappy_change: %5d rows, median %8.2f ms" % (label, count, median * 1000)
+
+def main(argv=sys.argv):
+    num_entries = int(argv[1]) if len(argv) > 1 else 1000000
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        engine = create_engine('sqlite:///%s' % os.path.join(tempdir, 'bench.db'))
+        DBSession.configure(bind=engine)
+        upgrade_schema(engine)
+
+        print "Populating %d entries..." % num_entries
+        baby_id = populate(engine, num_entries)
+        engine.execute('ANALYZE')
+
+        report("With indexes", baby_id)
+
+        for index in Entry.__table__.indexes:
+            index.drop(engine)
+        engine.execute('ANALYZE')
+
+        report("Without indexes", baby_id)
+    finally:
+        DBSession.remove()
+        shutil.rmtree(tempdir)
+
+if __name__ == '__main__':
+    main()
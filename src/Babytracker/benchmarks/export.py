@@ -0,0 +1,114 @@
+"""Benchmark streaming ``@@export`` of a baby's full history.
+
+Builds the application against a throwaway SQLite database with one baby
+holding ``num_entries`` entries, then downloads them through ``@@export`` as
+CSV and as NDJSON, reporting rows per second and the peak memory of the
+process. The export is streamed in batches, so memory stays flat however
+long the history is, unlike an unbounded ``@@entries`` request: compare
+the peak for different ``num_entries``.
+
+Usage:
+
+    $venv/bin/python benchmarks/export.py [num_entries]
+
+``num_entries`` defaults to 1,000,000. Building the database takes a while.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import datetime
+import resource
+import tempfile
+import transaction
+
+from webob import Request
+
+from babytracker import main as make_app
+from babytracker.models import DBSession, User, Baby, Entry
+
+CHUNK_SIZE = 10000
+ENTRY_TYPES = ('breast_feed', 'bottle_feed', 'mixed_feed', 'sleep', 'nappy_change',)
+
+def populate(engine, num_entries):
+    with transaction.manager:
+        session = DBSession()
+        user = User(u'bench@example.org', u'Bench Mark', 'secret')
+        baby = Baby(user, datetime.date(2010, 1, 1), u"Bench", 'f')
+        session.add(baby)
+        session.flush()
+        baby_id = baby.id
+
+    now = datetime.datetime(2012, 1, 1)
+    table = Entry.__table__
+
+    # Written directly, as many entries would take a long time to create
+    # through the ORM
+    for offset in xrange(0, num_entries, CHUNK_SIZE):
+        rows = []
+        for i in xrange(offset, min(offset + CHUNK_SIZE, num_entries)):
+            rows.append({
+                'baby_id': baby_id,
+                'type': ENTRY_TYPES[i % len(ENTRY_TYPES)],
+                'start': now - datetime.timedelta(minutes=7 * i),
+                'note': u"Entry %d" % i,
+            })
+        engine.execute(table.insert(), rows)
+
+def get_token(app):
+    request = Request.blank('/api/@@login', method='POST',
+        content_type='application/json',
+        body=json.dumps({'username': 'bench@example.org', 'password': 'secret'}),
+    )
+    return json.loads(request.get_response(app).body)['token']
+
+def peak_memory():
+    # Kilobytes on Linux, bytes on Mac OS X
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def export(app, token, format):
+    request = Request.blank('/api/bench@example.org/bench/@@export?format=' + format,
+        headers={'Authorization': 'Bearer ' + token})
+
+    t = time.time()
+
+    response = request.get_response(app)
+    assert response.status_int == 200, response.status
+
+    size = lines = 0
+    for chunk in response.app_iter:
+        size += len(chunk)
+        lines += chunk.count('\n')
+    if hasattr(response.app_iter, 'close'):
+        response.app_iter.close()
+
+    return lines, size, time.time() - t
+
+def main(argv=sys.argv):
+    num_entries = int(argv[1]) if len(argv) > 1 else 1000000
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        app = make_app({}, **{
+            'sqlalchemy.url': 'sqlite:///%s' % os.path.join(tempdir, 'bench.db'),
+            'pyramid.includes': 'pyramid_tm',
+            'password-iterations': '1000',
+            'database-auto-migrate': 'true',
+        })
+
+        print "Populating %d entries..." % num_entries
+        populate(DBSession.bind, num_entries)
+        token = get_token(app)
+
+        for format in ('csv', 'ndjson',):
+            lines, size, elapsed = export(app, token, format)
+            print "%-6s %8d lines, %7.1f MB in %6.2f s, %8.0f rows/s, peak memory %6.1f MB" % (
+                format, lines, size / 1048576.0, elapsed, num_entries / elapsed, peak_memory() / 1024.0)
+    finally:
+        DBSession.remove()
+        shutil.rmtree(tempdir)
+
+if __name__ == '__main__':
+    main()
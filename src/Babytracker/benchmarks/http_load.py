@@ -0,0 +1,102 @@
+"""Load test the main API endpoints of a running server.
+
+Logs in as an existing user to get a bearer token, finds their first baby,
+then for each endpoint has ``threads`` concurrent clients make requests for
+``seconds`` seconds, and reports requests per second and latencies. Run it
+against ``serve_Babytracker`` to compare worker counts and classes.
+
+Usage:
+
+    $venv/bin/python benchmarks/http_load.py <url> <email> <password> [threads] [seconds]
+
+e.g. ``http_load.py http://localhost:6543 jill@example.org secret``.
+``threads`` defaults to 10 and ``seconds`` to 10.
+"""
+
+import sys
+import json
+import time
+import urllib2
+import urlparse
+import datetime
+import threading
+
+def request(url, token=None, data=None):
+    req = urllib2.Request(url, data)
+    if token is not None:
+        req.add_header('Authorization', 'Bearer ' + token)
+    if data is not None:
+        req.add_header('Content-Type', 'application/json')
+    response = urllib2.urlopen(req)
+    try:
+        return response.read()
+    finally:
+        response.close()
+
+def client(url, token, deadline, timings, failures):
+    while time.time() < deadline:
+        t = time.time()
+        try:
+            request(url, token)
+        except (urllib2.URLError, IOError), e:
+            failures.append(e)
+        else:
+            timings.append(time.time() - t)
+
+def run(url, token, num_threads, seconds):
+    timings = []
+    failures = []
+    deadline = time.time() + seconds
+    threads = [threading.Thread(target=client, args=(url, token, deadline, timings, failures,))
+        for i in range(num_threads)]
+
+    t = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return timings, failures, time.time() - t
+
+def main(argv=sys.argv):
+    if len(argv) < 4:
+        print __doc__
+        sys.exit(1)
+
+    base_url, email, password = argv[1:4]
+    num_threads = int(argv[4]) if len(argv) > 4 else 10
+    seconds = int(argv[5]) if len(argv) > 5 else 10
+
+    login = json.loads(request(urlparse.urljoin(base_url, '/api/@@login'),
+        data=json.dumps({'username': email, 'password': password})))
+    token = login['token']
+
+    user_url = urlparse.urljoin(base_url, '/api/%s' % email)
+    user = json.loads(request(user_url, token))
+    if not user['babies']:
+        print "%s has no babies to request" % email
+        sys.exit(1)
+    baby_url = urlparse.urljoin(base_url, user['babies'][0]['url'])
+
+    end = datetime.date.today() + datetime.timedelta(days=1)
+    start = end - datetime.timedelta(days=7)
+    endpoints = (
+        ('user', user_url,),
+        ('baby', baby_url,),
+        ('entries', baby_url + '/@@entries',),
+        ('summary', baby_url + '/@@summary?period=day&start=%s&end=%s' % (start, end,),),
+    )
+
+    for name, url in endpoints:
+        timings, failures, elapsed = run(url, token, num_threads, seconds)
+        if not timings:
+            print "%-8s all %d requests failed, e.g. %s" % (name, len(failures), failures[0],)
+            continue
+
+        timings.sort()
+        total = len(timings)
+        print "%-8s %7.1f requests/s, median %6.1f ms, 95th percentile %6.1f ms, %d failed" % (
+            name, total / elapsed, timings[total // 2] * 1000, timings[int(total * 0.95)] * 1000,
+            len(failures))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+"""Load test the API and report connection pool metrics.
+
+Builds the application against ``database_url`` (by default a throwaway
+SQLite database), creates a user with a baby and a week of entries, then
+has ``threads`` concurrent threads each make ``requests`` API requests with
+a bearer token, as a threaded server would for that many simultaneous
+clients. Reports requests per second, latency percentiles and the pool
+metrics: checkouts, time spent waiting for a connection, overflow and
+timeouts.
+
+Usage:
+
+    $venv/bin/python benchmarks/load_api.py [database_url] [threads] [requests] [pool_size] [max_overflow]
+
+``threads`` defaults to 20, ``requests`` (per thread) to 50, and the pool
+settings to the ``database-pool-size`` and ``database-max-overflow``
+defaults. Use a Postgres URL, e.g. ``postgresql://localhost/loadtest``, to
+exercise the pool; its tables are created and NOT dropped afterwards.
+SQLite does not share connections between threads, so there are no waits
+to measure.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import datetime
+import tempfile
+import threading
+import transaction
+
+from webob import Request
+
+from babytracker import main as make_app
+from babytracker.database import pool_metrics
+from babytracker.models import DBSession, User, Baby, BreastFeed, Sleep
+
+def populate():
+    with transaction.manager:
+        session = DBSession()
+        user = session.query(User).filter_by(email=u'load@example.org').first()
+        if user is None:
+            user = User(u'load@example.org', u'Load Test', 'secret')
+            baby = Baby(user, datetime.date(2011, 11, 25), u"Load", 'f')
+            session.add(baby)
+
+            start = datetime.datetime(2012, 1, 1)
+            for i in xrange(7 * 8):
+                session.add(BreastFeed(baby, start=start + datetime.timedelta(hours=3 * i)))
+                session.add(Sleep(baby, start=start + datetime.timedelta(hours=3 * i, minutes=30),
+                    duration=datetime.timedelta(hours=2)))
+            session.flush()
+
+        return '/api/%s/%s' % (user.__name__, user.babies[0].__name__,)
+
+def get_token(app):
+    request = Request.blank('/api/@@login', method='POST',
+        content_type='application/json',
+        body=json.dumps({'username': 'load@example.org', 'password': 'secret'}),
+    )
+    return json.loads(request.get_response(app).body)['token']
+
+def client(app, paths, token, num_requests, timings, failures):
+    for i in xrange(num_requests):
+        request = Request.blank(paths[i % len(paths)], headers={'Authorization': 'Bearer ' + token})
+        t = time.time()
+        response = request.get_response(app)
+        timings.append(time.time() - t)
+        if response.status_int != 200:
+            failures.append(response.status)
+
+def main(argv=sys.argv):
+    database_url = argv[1] if len(argv) > 1 else None
+    num_threads = int(argv[2]) if len(argv) > 2 else 20
+    num_requests = int(argv[3]) if len(argv) > 3 else 50
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        settings = {
+            'sqlalchemy.url': database_url or 'sqlite:///%s' % os.path.join(tempdir, 'load.db'),
+            'pyramid.includes': 'pyramid_tm',
+            'password-iterations': '1000',
+            'database-auto-migrate': 'true',
+        }
+        if len(argv) > 4:
+            settings['database-pool-size'] = argv[4]
+        if len(argv) > 5:
+            settings['database-max-overflow'] = argv[5]
+
+        app = make_app({}, **settings)
+        baby_path = populate()
+        token = get_token(app)
+        paths = [
+            baby_path,
+            baby_path + '/@@entries',
+            baby_path + '/@@summary?period=day&start=2012-01-01&end=2012-01-08',
+        ]
+
+        pool_metrics.reset()
+        timings = []
+        failures = []
+        threads = [threading.Thread(target=client, args=(app, paths, token, num_requests, timings, failures,))
+            for i in range(num_threads)]
+
+        t = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - t
+
+        assert not failures, "%d requests failed, e.g. %s" % (len(failures), failures[0],)
+
+        timings.sort()
+        total = len(timings)
+        print "%d threads: %d requests in %.2f s, %.1f requests/s, median %.1f ms, 95th percentile %.1f ms" % (
+            num_threads, total, elapsed, total / elapsed,
+            timings[total // 2] * 1000, timings[int(total * 0.95)] * 1000)
+
+        metrics = pool_metrics.snapshot(DBSession.bind)
+        print "pool: %d checkouts, %d connects, %.1f ms waiting (max %.1f ms), %d timeouts" % (
+            metrics['checkouts'], metrics['connects'], metrics['wait_time'] * 1000,
+            metrics['max_wait_time'] * 1000, metrics['timeouts'])
+        if 'pool_size' in metrics:
+            print "pool: size %d, %d checked in, %d overflow" % (
+                metrics['pool_size'], metrics['checked_in'], metrics['overflow'])
+    finally:
+        DBSession.remove()
+        shutil.rmtree(tempdir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""Benchmark login throughput at a given password hashing cost.
+
+Creates a throwaway SQLite database with one user, then authenticates
+that user repeatedly from ``threads`` concurrent threads, as a threaded
+worker would for a burst of logins. Reports logins per second for the
+worker, which can be compared with the expected login rate to decide how
+many workers are needed.
+
+Usage:
+
+    $venv/bin/python benchmarks/login.py [iterations] [threads] [logins]
+
+``iterations`` defaults to the ``password-iterations`` default, ``threads``
+to the number of CPUs, and ``logins`` (per thread) to 20. The number of
+concurrent hashes is bounded by ``password-hashing-threads``, which is set
+to ``threads`` here.
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import multiprocessing
+import transaction
+
+from sqlalchemy import create_engine
+
+from babytracker.models import DBSession, User, upgrade_schema
+from babytracker import passwords
+
+def login(num_logins, failures):
+    for i in xrange(num_logins):
+        with transaction.manager:
+            if User.authenticate(u'bench@example.org', 'secret') is None:
+                failures.append(i)
+    DBSession.remove()
+
+def main(argv=sys.argv):
+    iterations = int(argv[1]) if len(argv) > 1 else passwords.DEFAULT_ITERATIONS
+    num_threads = int(argv[2]) if len(argv) > 2 else multiprocessing.cpu_count()
+    num_logins = int(argv[3]) if len(argv) > 3 else 20
+
+    passwords.configure_password_hashing({
+        'password-iterations': iterations,
+        'password-hashing-threads': num_threads,
+    })
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        engine = create_engine('sqlite:///%s' % os.path.join(tempdir, 'bench.db'))
+        DBSession.configure(bind=engine)
+        upgrade_schema(engine)
+
+        with transaction.manager:
+            DBSession().add(User(u'bench@example.org', u'Bench Mark', 'secret'))
+        DBSession.remove()
+
+        failures = []
+        threads = [threading.Thread(target=login, args=(num_logins, failures,)) for i in range(num_threads)]
+
+        t = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - t
+
+        assert not failures, "%d logins failed" % len(failures)
+
+        total = num_threads * num_logins
+        print "%d iterations, %d threads: %d logins in %.2f s, %.1f logins/s, %.1f ms each" % (
+            iterations, num_threads, total, elapsed, total / elapsed, elapsed / total * 1000)
+    finally:
+        DBSession.remove()
+        shutil.rmtree(tempdir)
+
+if __name__ == '__main__':
+    main()
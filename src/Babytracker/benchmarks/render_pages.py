@@ -0,0 +1,90 @@
+"""Benchmark rendering the ``user.pt`` and ``entries.pt`` pages.
+
+Runs the full application against a throwaway SQLite database, logs in
+and times requests for each page, with the layout macro cached for the
+process (the default) and looked up again for every render, as it used to
+be.
+
+Usage:
+
+    $venv/bin/python benchmarks/render_pages.py [requests]
+
+``requests`` is the number of timed requests per page and mode, and
+defaults to 200.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import datetime
+import tempfile
+import transaction
+
+from webob import Request
+
+from babytracker import main as make_app
+from babytracker import hooks
+from babytracker.models import DBSession, User, Baby
+
+PAGES = (
+    ('user.pt', '/bench@example.org'),
+    ('entries.pt', '/bench@example.org/@@entries'),
+)
+
+def login(app):
+    request = Request.blank('/api/@@login', method='POST',
+        content_type='application/json',
+        body=json.dumps({'username': 'bench@example.org', 'password': 'secret'}),
+    )
+    response = request.get_response(app)
+    assert response.status_int == 200, response.status
+    return '; '.join([value.split(';')[0] for name, value in response.headerlist if name == 'Set-Cookie'])
+
+def time_page(app, cookie, path, num_requests, cache_layout):
+    timings = []
+    for i in xrange(num_requests):
+        if not cache_layout:
+            hooks._layout = None
+
+        request = Request.blank(path, headers={'Cookie': cookie})
+        t = time.time()
+        response = request.get_response(app)
+        timings.append(time.time() - t)
+        assert response.status_int == 200, response.status
+
+    timings.sort()
+    return timings[len(timings) // 2]
+
+def main(argv=sys.argv):
+    num_requests = int(argv[1]) if len(argv) > 1 else 200
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        app = make_app({}, **{
+            'sqlalchemy.url': 'sqlite:///%s' % os.path.join(tempdir, 'bench.db'),
+            'pyramid.includes': 'pyramid_tm',
+            'password-iterations': '1000',
+            'database-auto-migrate': 'true',
+        })
+
+        with transaction.manager:
+            user = User(u'bench@example.org', u'Bench Mark', 'secret')
+            DBSession().add(Baby(user, datetime.date(2011, 11, 25), u"Bench", 'f'))
+
+        cookie = login(app)
+
+        for name, path in PAGES:
+            # Warm up templates
+            time_page(app, cookie, path, 5, True)
+
+            before = time_page(app, cookie, path, num_requests, False)
+            after = time_page(app, cookie, path, num_requests, True)
+            print "%-12s layout per render: %7.2f ms, cached layout: %7.2f ms" % (name, before * 1000, after * 1000)
+    finally:
+        DBSession.remove()
+        shutil.rmtree(tempdir)
+
+if __name__ == '__main__':
+    main()
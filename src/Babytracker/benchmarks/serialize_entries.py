@@ -0,0 +1,96 @@
+"""Benchmark serialising a list of entries to JSON, as ``BabyAPI.entries``
+does.
+
+Compares building each entry's data with ``entry_json()`` and encoding it
+with the standard library's ``json`` module against the ``EntrySerializer``
+and ``babytracker.renderers.dumps()`` used by the API, and reports entries
+serialised per second. Entries are created in memory, so no database is
+needed.
+
+Usage:
+
+    $venv/bin/python benchmarks/serialize_entries.py [num_entries]
+
+``num_entries`` defaults to 10,000.
+"""
+
+import sys
+import json
+import time
+import datetime
+
+from pyramid import testing
+from pyramid.interfaces import IRoutesMapper
+
+from babytracker.models import User, Baby
+from babytracker.models import BreastFeed, BottleFeed, MixedFeed, Sleep, NappyChange
+from babytracker.views.api import entry_json, EntrySerializer
+from babytracker.renderers import dumps
+
+REPEAT = 5
+
+def make_entries(num_entries):
+    user = User(u'bench@example.org', u'Bench Mark', 'secret')
+    user.id = 1
+    baby = Baby(user, datetime.date(2010, 1, 1), u"Bench", 'f')
+    baby.id = 1
+
+    now = datetime.datetime(2012, 1, 1)
+    factories = (
+        lambda start: BreastFeed(baby, start, datetime.timedelta(minutes=10), datetime.timedelta(minutes=5)),
+        lambda start: BottleFeed(baby, start, 120),
+        lambda start: MixedFeed(baby, start, datetime.timedelta(minutes=10), datetime.timedelta(minutes=5), 60),
+        lambda start: Sleep(baby, start, datetime.timedelta(minutes=90)),
+        lambda start: NappyChange(baby, start, 'wet'),
+    )
+
+    entries = []
+    for i in xrange(num_entries):
+        entry = factories[i % len(factories)](now - datetime.timedelta(minutes=7 * i))
+        entry.id = i + 1
+        entries.append(entry)
+
+    return baby, entries
+
+def make_request(baby):
+    config = testing.setUp()
+    config.add_route('api', '/api/*traverse')
+    request = testing.DummyRequest()
+    request.context = baby
+    request.matchdict = {}
+    request.matched_route = config.registry.getUtility(IRoutesMapper).get_route('api')
+    return request
+
+def baseline(baby, entries, request):
+    return json.dumps([entry_json(entry, request) for entry in entries])
+
+def fast(baby, entries, request):
+    serializer = EntrySerializer(baby, request)
+    return dumps([serializer(entry) for entry in entries])
+
+def report(label, func, baby, entries, request):
+    timings = []
+    for i in range(REPEAT):
+        t = time.time()
+        func(baby, entries, request)
+        timings.append(time.time() - t)
+
+    best = min(timings)
+    print "%-20s %10.0f entries/s (%8.2f ms)" % (label, len(entries) / best, best * 1000)
+
+def main(argv=sys.argv):
+    num_entries = int(argv[1]) if len(argv) > 1 else 10000
+
+    baby, entries = make_entries(num_entries)
+    request = make_request(baby)
+
+    try:
+        assert json.loads(baseline(baby, entries, request)) == json.loads(fast(baby, entries, request))
+
+        report("entry_json()", baseline, baby, entries, request)
+        report("EntrySerializer", fast, baby, entries, request)
+    finally:
+        testing.tearDown()
+
+if __name__ == '__main__':
+    main()
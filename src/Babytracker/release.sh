@@ -0,0 +1,13 @@
+#!/bin/bash
+
+# For Heroku; Procfile is:
+#
+# web: ./src/Babytracker/run.sh
+# release: ./src/Babytracker/release.sh
+#
+# The release phase runs once per deploy, before any web dynos are started
+# on the new version, so migrations are never run by two dynos at once.
+
+cd src/Babytracker
+../../bin/python setup.py develop
+../../bin/migrate_Babytracker production.ini
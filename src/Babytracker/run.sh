@@ -1,10 +1,14 @@
 #!/bin/bash
 
-# For Heroku; Pocfile is:
+# For Heroku; Procfile is:
 #
 # web: ./src/Babytracker/run.sh
+# release: ./src/Babytracker/release.sh
 #
+# The schema is migrated by release.sh, not here: every web dyno runs this
+# script as it boots.
 
 cd src/Babytracker
 ../../bin/python setup.py develop
-../../bin/python runapp.py
+../../bin/build_static_Babytracker production.ini
+../../bin/serve_Babytracker production.ini
@@ -1,9 +1,6 @@
-import os
+import sys
 
-from paste.deploy import loadapp
-from gunicorn.app.pasterapp import paste_server
+from babytracker.scripts.serve import main
 
 if __name__ == "__main__":
-    port = int(os.environ.get("PORT", 5000))
-    wsgi_app = loadapp('config:production.ini', relative_to='.')
-    paste_server(wsgi_app, host='0.0.0.0', port=port)
+    main([sys.argv[0], 'production.ini'])
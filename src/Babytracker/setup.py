@@ -44,6 +44,11 @@ setup(name='Babytracker',
       main = babytracker:main
       [console_scripts]
       populate_Babytracker = babytracker.scripts.populate:main
+      rebuild_summaries_Babytracker = babytracker.scripts.rebuild_summaries:main
+      build_static_Babytracker = babytracker.scripts.build_static:main
+      migrate_Babytracker = babytracker.scripts.migrate:main
+      serve_Babytracker = babytracker.scripts.serve:main
+      import_Babytracker = babytracker.scripts.import_entries:main
       """,
       )
 